@@ -11,11 +11,14 @@ from datetime import datetime
 # Импорты из database
 from database import (
     # Пользователи
-    get_all_users, get_user,
+    get_user, get_users_page, count_users, search_users,
     # Галерея
     get_gallery_items, get_gallery_item_by_id, add_gallery_item, delete_gallery_item,
     # Заказы цветов
-    get_flower_orders, get_flower_order_by_id, update_flower_order_status
+    get_flower_orders, get_flower_orders_page, get_flower_order_status_counts,
+    get_flower_order_by_id, update_flower_order_status,
+    # Режим соединения для списков и счётчиков
+    ANALYTICS
     # Техподдержка - TODO: добавить функции в database.py
     # get_support_messages, get_support_message_by_id, get_user_support_messages,
     # send_support_message_to_user
@@ -34,6 +37,10 @@ ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16 МБ
 
+# Размер страницы в списках
+ORDERS_PAGE_SIZE = 50
+USERS_PAGE_SIZE = 50
+
 # =================================================================
 # АВТОРИЗАЦИЯ
 # =================================================================
@@ -85,16 +92,15 @@ def logout():
 def index():
     """Дашборд"""
     # Статистика
-    users = get_all_users()
-    orders = get_flower_orders(status='new')
+    order_counts = get_flower_order_status_counts(mode=ANALYTICS)
 
     # TODO: Восстановить после добавления функций поддержки
     # support_messages = get_support_messages()
     # unread_support = [msg for msg in support_messages if not msg.get('admin_reply')]
 
     stats = {
-        'users_total': len(users),
-        'orders_new': len(orders),
+        'users_total': count_users(ANALYTICS),
+        'orders_new': order_counts.get('new', 0),
         'support_unread': 0,  # Временно 0, пока нет функций поддержки
     }
 
@@ -194,15 +200,24 @@ def gallery_delete(photo_id):
 @bp.route('/orders')
 @login_required
 def orders_list():
-    """Список заказов"""
-    status_filter = request.args.get('status', 'all')
-
-    if status_filter == 'all':
-        orders = get_flower_orders()
-    else:
-        orders = get_flower_orders(status=status_filter)
-
-    return render_template('orders/list.html', orders=orders, status_filter=status_filter)
+    """Список заказов (постранично, новые сверху)"""
+    status_filter = request.args.get('status', 'all') or 'all'
+    after = request.args.get('after')
+
+    page = get_flower_orders_page(
+        after=after,
+        limit=ORDERS_PAGE_SIZE,
+        status=None if status_filter == 'all' else status_filter,
+        mode=ANALYTICS
+    )
+
+    return render_template('orders/list.html',
+                         orders=page['items'],
+                         status_filter=status_filter,
+                         status='' if status_filter == 'all' else status_filter,
+                         status_counts=get_flower_order_status_counts(mode=ANALYTICS),
+                         next_cursor=page['next_cursor'],
+                         is_first_page=not after)
 
 
 @bp.route('/orders/<int:order_id>')
@@ -228,8 +243,10 @@ def order_update_status(order_id):
         flash('Недопустимый статус', 'error')
         return redirect(url_for('order_detail', order_id=order_id))
 
-    # Обновить статус с отправкой уведомления
-    update_flower_order_status(order_id, new_status, send_notification=True)
+    # Обновить статус с отправкой уведомления (архивные заказы не меняются)
+    if not update_flower_order_status(order_id, new_status, send_notification=True):
+        flash('Статус не изменён: заказ в архиве (только просмотр) или не найден', 'error')
+        return redirect(url_for('order_detail', order_id=order_id))
 
     flash(f'Статус заказа обновлен на: {new_status}', 'success')
     return redirect(url_for('order_detail', order_id=order_id))
@@ -242,9 +259,22 @@ def order_update_status(order_id):
 @bp.route('/users')
 @login_required
 def users_list():
-    """Список пользователей"""
-    users = get_all_users()
-    return render_template('users/list.html', users=users)
+    """Список пользователей (постранично, новые сверху)"""
+    search = request.args.get('search', '').strip()
+    after = request.args.get('after')
+
+    if search:
+        # Поиск: релевантные первыми, без постраничной навигации
+        page = {'items': search_users(search, limit=USERS_PAGE_SIZE, mode=ANALYTICS), 'next_cursor': None}
+    else:
+        page = get_users_page(after=after, limit=USERS_PAGE_SIZE, mode=ANALYTICS)
+
+    return render_template('users/list.html',
+                         users=page['items'],
+                         search=search,
+                         total_users=count_users(ANALYTICS),
+                         next_cursor=page['next_cursor'],
+                         is_first_page=not after)
 
 
 @bp.route('/users/<int:user_id>')
@@ -8,7 +8,7 @@ from datetime import datetime, timedelta
 from telegram import Bot
 from telegram.constants import ParseMode
 from config import TELEGRAM_BOT_TOKEN, ADMIN_ID
-from database import get_connection
+from database import get_connection, ANALYTICS, refresh_stats_rollups, get_daily_stats, get_hourly_stats, group_stats
 
 async def send_alert(message: str, emoji: str = "⚠️"):
     """Отправить срочное уведомление собственнику"""
@@ -28,10 +28,21 @@ async def send_alert(message: str, emoji: str = "⚠️"):
 async def check_critical_alerts():
     """Проверить критические ситуации и отправить алерты"""
 
-    conn = get_connection()
-    cursor = conn.cursor()
     today = datetime.now().date()
 
+    # Счётчики за последние дни - из дневных роллапов
+    refresh_stats_rollups()
+    daily = get_daily_stats(today - timedelta(days=7), today)
+
+    def day_stats(days_ago: int) -> dict:
+        return daily.get(str(today - timedelta(days=days_ago)), {})
+
+    def sum_days(metric: str, days: int) -> int:
+        return sum(day_stats(n).get(metric, 0) for n in range(days + 1))
+
+    conn = get_connection(ANALYTICS)
+    cursor = conn.cursor()
+
     alerts = []
 
     # ========================================
@@ -39,28 +50,18 @@ async def check_critical_alerts():
     # ========================================
 
     # Выручка упала более чем на 50% по сравнению со вчера
-    cursor.execute("""
-        SELECT
-            (SELECT COALESCE(SUM(total_amount), 0)
-             FROM flower_orders
-             WHERE DATE(created_at) = DATE('now', '-1 day') AND status = 'completed') as yesterday,
-            (SELECT COALESCE(SUM(total_amount), 0)
-             FROM flower_orders
-             WHERE DATE(created_at) = DATE('now') AND status = 'completed') as today
-    """)
-    row = cursor.fetchone()
+    row = (
+        day_stats(1).get('flowers.revenue.completed', 0),
+        day_stats(0).get('flowers.revenue.completed', 0),
+    )
     if row[0] > 0 and row[1] < row[0] * 0.5:
         alerts.append({
             'emoji': '📉',
             'message': f"<b>Падение выручки!</b>\n\nВчера: {row[0]:,}₽\nСегодня: {row[1]:,}₽\nПадение: {(1 - row[1]/row[0])*100:.0f}%"
         })
 
-    # Много неоплаченных заказов (>10 за день)
-    cursor.execute("""
-        SELECT COUNT(*) FROM flower_orders
-        WHERE DATE(created_at) = ? AND status = 'pending'
-    """, (today,))
-    pending = cursor.fetchone()[0]
+    # Много необработанных заказов (>10 за день)
+    pending = day_stats(0).get('flowers.orders.new', 0)
     if pending > 10:
         alerts.append({
             'emoji': '💸',
@@ -72,25 +73,15 @@ async def check_critical_alerts():
     # ========================================
 
     # Нет новых регистраций уже 2 дня
-    cursor.execute("""
-        SELECT COUNT(*) FROM users
-        WHERE DATE(registration_date) >= DATE('now', '-2 days')
-    """)
-    if cursor.fetchone()[0] == 0:
+    if sum_days('users.new', 2) == 0:
         alerts.append({
             'emoji': '🚫',
             'message': "<b>Нет новых пользователей!</b>\n\nУже 2 дня нет регистраций.\n\nПроверьте рекламу и каналы привлечения."
         })
 
     # Много отмененных записей (>30% от общего числа за день)
-    cursor.execute("""
-        SELECT
-            COUNT(*) as total,
-            SUM(CASE WHEN status = 'cancelled' THEN 1 ELSE 0 END) as cancelled
-        FROM salon_appointments
-        WHERE DATE(appointment_date) = ?
-    """, (today,))
-    row = cursor.fetchone()
+    appointments = group_stats(day_stats(0), 'salon.appointments')
+    row = (sum(appointments.values()), appointments.get('cancelled', 0))
     if row[0] > 0 and row[1] / row[0] > 0.3:
         alerts.append({
             'emoji': '❌',
@@ -102,12 +93,7 @@ async def check_critical_alerts():
     # ========================================
 
     # Реферальная программа не работает (0 рефералов за неделю)
-    cursor.execute("""
-        SELECT COUNT(*) FROM users
-        WHERE DATE(registration_date) >= DATE('now', '-7 days')
-        AND referred_by IS NOT NULL
-    """)
-    if cursor.fetchone()[0] == 0:
+    if sum_days('users.referral', 7) == 0:
         alerts.append({
             'emoji': '👥',
             'message': "<b>Реферальная программа не работает!</b>\n\nЗа неделю 0 регистраций по реферальным ссылкам.\n\nНапомните клиентам о программе."
@@ -194,18 +180,15 @@ async def check_critical_alerts():
 async def send_hourly_summary():
     """Краткая сводка каждый час (опционально)"""
 
-    conn = get_connection()
-    cursor = conn.cursor()
-
-    # Статистика за последний час
-    cursor.execute("""
-        SELECT
-            (SELECT COUNT(*) FROM users WHERE registration_date >= datetime('now', '-1 hour')) as new_users,
-            (SELECT COUNT(*) FROM flower_orders WHERE created_at >= datetime('now', '-1 hour')) as new_orders,
-            (SELECT COALESCE(SUM(total_amount), 0) FROM flower_orders
-             WHERE created_at >= datetime('now', '-1 hour') AND status = 'completed') as revenue
-    """)
-    row = cursor.fetchone()
+    # Статистика за последний завершённый час (время событий в БД - UTC)
+    refresh_stats_rollups()
+    hour = (datetime.utcnow() - timedelta(hours=1)).strftime('%Y-%m-%d %H')
+    metrics = get_hourly_stats(hour)
+    row = (
+        metrics.get('users.new', 0),
+        sum(group_stats(metrics, 'flowers.orders').values()),
+        metrics.get('flowers.revenue.completed', 0),
+    )
 
     if any(row):  # Если есть какая-то активность
         message = f"""
@@ -222,13 +205,11 @@ async def send_hourly_summary():
             parse_mode=ParseMode.HTML
         )
 
-    conn.close()
-
 
 async def check_business_opportunities():
     """Поиск возможностей для роста бизнеса"""
 
-    conn = get_connection()
+    conn = get_connection(ANALYTICS)
     cursor = conn.cursor()
 
     opportunities = []
@@ -250,24 +231,21 @@ async def check_business_opportunities():
             f"   Запустите win-back кампанию с промокодом"
         )
 
-    # Популярные товары заканчиваются
+    # Популярные товары (>5 заказов за неделю) не в наличии
     cursor.execute("""
-        SELECT name FROM products
-        WHERE stock_quantity < 5
-        AND id IN (
-            SELECT json_extract(value, '$.id')
-            FROM flower_orders, json_each(items_json)
-            WHERE created_at >= DATE('now', '-7 days')
-            GROUP BY json_extract(value, '$.id')
-            HAVING COUNT(*) > 5
-        )
+        SELECT p.name FROM products p
+        WHERE NOT p.in_stock
+        AND (
+            SELECT COUNT(DISTINCT oi.order_id) FROM order_items oi
+            WHERE oi.product_id = p.id AND oi.created_at >= DATE('now', '-7 days')
+        ) > 5
         LIMIT 3
     """)
     low_stock = cursor.fetchall()
     if low_stock:
         products = ", ".join([p[0] for p in low_stock])
         opportunities.append(
-            f"📦 Популярные товары заканчиваются: {products}\n"
+            f"📦 Популярные товары закончились: {products}\n"
             f"   Срочно пополните запас!"
         )
 
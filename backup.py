@@ -0,0 +1,386 @@
+"""
+Резервное копирование базы данных.
+
+Копия снимается через sqlite3 backup API порциями по BACKUP_PAGES_PER_STEP
+страниц с паузой между шагами: бот продолжает читать и писать, пока идёт
+копирование. Источник держит одну читающую транзакцию на всё время
+копирования, поэтому копия согласована и не перезапускается из-за
+записей бота (WAL). Копируются рабочая БД и архив закрытых записей.
+
+Каждая копия проверяется PRAGMA integrity_check и сжимается gzip.
+Файлы одного запуска имеют общую метку времени:
+    data/backups/beauty_salon-20261016-030000.db.gz
+    data/backups/beauty_salon_archive-20261016-030000.db.gz
+
+Хранятся BACKUP_KEEP_DAILY последних копий и по одной (последней)
+за каждую из BACKUP_KEEP_WEEKLY последних недель, остальные удаляются.
+
+CLI:
+    python backup.py create            - снять копию и выполнить ротацию
+    python backup.py list              - список копий
+    python backup.py restore latest    - восстановить последнюю копию
+    python backup.py restore 20261016-030000
+
+Восстановление перезаписывает рабочую БД: бота и админку перед ним
+нужно остановить. Схема восстановленной копии догоняется миграциями
+при следующем запуске.
+"""
+
+import os
+import re
+import sys
+import gzip
+import time
+import shutil
+import sqlite3
+import logging
+import argparse
+from datetime import datetime
+from typing import Dict, List, Optional
+
+if __name__ == "__main__":
+    # Восстановление не должно начинаться с миграции старой схемы
+    os.environ.setdefault("DB_AUTO_MIGRATE", "0")
+
+import database
+from database import archive_path
+from config import (
+    DB_BUSY_TIMEOUT_MS, BACKUP_DIR, BACKUP_PAGES_PER_STEP, BACKUP_STEP_SLEEP_SECONDS,
+    BACKUP_KEEP_DAILY, BACKUP_KEEP_WEEKLY
+)
+
+logger = logging.getLogger(__name__)
+
+STAMP_FORMAT = "%Y%m%d-%H%M%S"
+BACKUP_FILE_RE = re.compile(r'^(?P<name>.+)-(?P<stamp>\d{8}-\d{6})\.db\.gz$')
+
+
+class BackupError(Exception):
+    """Копия не прошла проверку или не найдена."""
+
+
+def _database_files() -> Dict[str, str]:
+    """Файлы для копирования: {имя в копии: путь к БД}."""
+    main_path = database.DB_PATH
+    files = {}
+    for path in (main_path, archive_path(main_path)):
+        name = os.path.splitext(os.path.basename(path))[0]
+        files[name] = path
+    return files
+
+
+def _integrity_check(path: str):
+    """Проверить файл БД (PRAGMA integrity_check), при ошибке - BackupError."""
+    conn = sqlite3.connect(path)
+    try:
+        problems = [row[0] for row in conn.execute("PRAGMA integrity_check")]
+    finally:
+        conn.close()
+    if problems != ['ok']:
+        raise BackupError(f"{os.path.basename(path)}: {'; '.join(problems[:5])}")
+
+
+def _copy_database(source_path: str, target_path: str) -> int:
+    """
+    Скопировать БД через backup API порциями с паузами.
+
+    Returns:
+        int: Количество скопированных страниц
+    """
+    source = sqlite3.connect(source_path, timeout=DB_BUSY_TIMEOUT_MS / 1000)
+    target = sqlite3.connect(target_path)
+    try:
+        # Читающая транзакция фиксирует снимок: записи бота идут в WAL
+        # и не заставляют backup начинать заново
+        source.execute("BEGIN")
+        source.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()
+
+        pages = [0]
+
+        def progress(status, remaining, total):
+            # sleep= в backup() срабатывает только на SQLITE_BUSY,
+            # пауза между обычными шагами - здесь
+            pages[0] = total
+            if remaining:
+                time.sleep(BACKUP_STEP_SLEEP_SECONDS)
+
+        source.backup(
+            target,
+            pages=BACKUP_PAGES_PER_STEP,
+            progress=progress,
+            sleep=BACKUP_STEP_SLEEP_SECONDS
+        )
+        source.rollback()
+
+        # Копия - самостоятельный файл, без -wal/-shm рядом
+        target.execute("PRAGMA journal_mode=DELETE")
+        return pages[0]
+    finally:
+        target.close()
+        source.close()
+
+
+def _compress(source_path: str, target_path: str):
+    """Сжать файл gzip (через временный файл, чтобы не оставить обрезанную копию)."""
+    tmp_path = target_path + ".tmp"
+    with open(source_path, 'rb') as src, gzip.open(tmp_path, 'wb', compresslevel=6) as dst:
+        shutil.copyfileobj(src, dst, 1024 * 1024)
+    os.replace(tmp_path, target_path)
+
+
+def _decompress(source_path: str, target_path: str):
+    """Распаковать gzip-копию."""
+    with gzip.open(source_path, 'rb') as src, open(target_path, 'wb') as dst:
+        shutil.copyfileobj(src, dst, 1024 * 1024)
+
+
+def list_backups(backup_dir: str = BACKUP_DIR) -> List[dict]:
+    """
+    Получить список копий (новые первыми).
+
+    Args:
+        backup_dir: Каталог копий
+
+    Returns:
+        List[dict]: stamp, created_at, files {имя: путь}, size (байт, сжатые)
+    """
+    if not os.path.isdir(backup_dir):
+        return []
+
+    sets = {}
+    for filename in os.listdir(backup_dir):
+        match = BACKUP_FILE_RE.match(filename)
+        if not match:
+            continue
+        stamp = match.group('stamp')
+        path = os.path.join(backup_dir, filename)
+        entry = sets.setdefault(stamp, {
+            'stamp': stamp,
+            'created_at': datetime.strptime(stamp, STAMP_FORMAT),
+            'files': {},
+            'size': 0,
+        })
+        entry['files'][match.group('name')] = path
+        entry['size'] += os.path.getsize(path)
+
+    return sorted(sets.values(), key=lambda entry: entry['stamp'], reverse=True)
+
+
+def rotate_backups(backup_dir: str = BACKUP_DIR, keep_daily: int = BACKUP_KEEP_DAILY,
+                   keep_weekly: int = BACKUP_KEEP_WEEKLY) -> int:
+    """
+    Удалить копии сверх политики хранения.
+
+    Хранятся keep_daily последних копий и последняя копия каждой
+    из keep_weekly последних недель.
+
+    Returns:
+        int: Количество удалённых копий
+    """
+    backups = list_backups(backup_dir)
+
+    keep = {entry['stamp'] for entry in backups[:keep_daily]}
+    weeks = set()
+    for entry in backups:
+        week = entry['created_at'].isocalendar()[:2]
+        if week in weeks:
+            continue
+        if len(weeks) >= keep_weekly:
+            break
+        weeks.add(week)
+        keep.add(entry['stamp'])
+
+    removed = 0
+    for entry in backups:
+        if entry['stamp'] in keep:
+            continue
+        for path in entry['files'].values():
+            os.remove(path)
+        removed += 1
+
+    # Остатки прерванных запусков
+    for filename in os.listdir(backup_dir):
+        if filename.endswith('.tmp'):
+            os.remove(os.path.join(backup_dir, filename))
+
+    return removed
+
+
+def create_backup(backup_dir: str = BACKUP_DIR) -> dict:
+    """
+    Снять проверенную сжатую копию рабочей БД и архива, затем выполнить ротацию.
+
+    Args:
+        backup_dir: Каталог копий
+
+    Returns:
+        dict: stamp, files {имя: путь}, pages, size, compressed_size,
+              copy_ms, check_ms, compress_ms, total_ms, removed
+    """
+    started = time.perf_counter()
+    os.makedirs(backup_dir, exist_ok=True)
+    stamp = datetime.now().strftime(STAMP_FORMAT)
+
+    metrics = {
+        'stamp': stamp, 'files': {}, 'pages': 0, 'size': 0, 'compressed_size': 0,
+        'copy_ms': 0, 'check_ms': 0, 'compress_ms': 0,
+    }
+
+    for name, source_path in _database_files().items():
+        if not os.path.exists(source_path):
+            continue
+
+        raw_path = os.path.join(backup_dir, f"{name}-{stamp}.db.tmp")
+        target_path = os.path.join(backup_dir, f"{name}-{stamp}.db.gz")
+        try:
+            t0 = time.perf_counter()
+            metrics['pages'] += _copy_database(source_path, raw_path)
+            t1 = time.perf_counter()
+            _integrity_check(raw_path)
+            t2 = time.perf_counter()
+            _compress(raw_path, target_path)
+            t3 = time.perf_counter()
+        finally:
+            if os.path.exists(raw_path):
+                metrics['size'] += os.path.getsize(raw_path)
+                os.remove(raw_path)
+
+        metrics['copy_ms'] += int((t1 - t0) * 1000)
+        metrics['check_ms'] += int((t2 - t1) * 1000)
+        metrics['compress_ms'] += int((t3 - t2) * 1000)
+        metrics['compressed_size'] += os.path.getsize(target_path)
+        metrics['files'][name] = target_path
+
+    metrics['removed'] = rotate_backups(backup_dir)
+    metrics['total_ms'] = int((time.perf_counter() - started) * 1000)
+
+    logger.info(
+        f"Резервная копия {stamp}: {metrics['pages']} стр., "
+        f"{metrics['size'] // 1024} КиБ -> {metrics['compressed_size'] // 1024} КиБ; "
+        f"копирование {metrics['copy_ms']} мс, проверка {metrics['check_ms']} мс, "
+        f"сжатие {metrics['compress_ms']} мс, всего {metrics['total_ms']} мс; "
+        f"удалено старых копий: {metrics['removed']}"
+    )
+    return metrics
+
+
+def run_scheduled_backup() -> Optional[dict]:
+    """
+    Снять копию из планировщика (ошибка логируется, не прерывает цикл).
+
+    Returns:
+        Optional[dict]: Метрики create_backup() или None при ошибке
+    """
+    try:
+        return create_backup()
+
+    except Exception as e:
+        logger.error(f"Ошибка резервного копирования: {e}")
+        return None
+
+
+def restore_backup(stamp: str = 'latest', backup_dir: str = BACKUP_DIR) -> dict:
+    """
+    Восстановить рабочую БД и архив из копии.
+
+    Каждый файл копии распаковывается и проверяется до того, как
+    затронута рабочая БД; запись идёт через backup API, поэтому
+    -wal/-shm рабочей БД остаются согласованными.
+
+    Args:
+        stamp: Метка копии или 'latest'
+        backup_dir: Каталог копий
+
+    Returns:
+        dict: stamp, files {имя: путь к восстановленной БД}
+    """
+    backups = list_backups(backup_dir)
+    if stamp == 'latest':
+        entry = backups[0] if backups else None
+    else:
+        entry = next((b for b in backups if b['stamp'] == stamp), None)
+    if entry is None:
+        raise BackupError(f"Копия {stamp} не найдена в {backup_dir}")
+
+    targets = _database_files()
+    unknown = set(entry['files']) - set(targets)
+    if unknown:
+        raise BackupError(f"Копия {entry['stamp']} не относится к {database.DB_PATH}: {sorted(unknown)}")
+
+    raw_paths = {}
+    try:
+        for name, path in entry['files'].items():
+            raw_paths[name] = os.path.join(backup_dir, f"{name}-{entry['stamp']}.restore.tmp")
+            _decompress(path, raw_paths[name])
+            _integrity_check(raw_paths[name])
+
+        database.close_pool()
+        for name, raw_path in raw_paths.items():
+            source = sqlite3.connect(raw_path)
+            target = sqlite3.connect(targets[name], timeout=DB_BUSY_TIMEOUT_MS / 1000)
+            try:
+                source.backup(target)
+            finally:
+                target.close()
+                source.close()
+    finally:
+        for raw_path in raw_paths.values():
+            if os.path.exists(raw_path):
+                os.remove(raw_path)
+
+    logger.info(f"Восстановлена резервная копия {entry['stamp']}: {', '.join(sorted(raw_paths))}")
+    return {'stamp': entry['stamp'], 'files': {name: targets[name] for name in raw_paths}}
+
+
+# =================================================================
+# CLI
+# =================================================================
+
+def main(argv: Optional[List[str]] = None) -> int:
+    """
+    Точка входа CLI.
+
+    Args:
+        argv: Аргументы командной строки
+
+    Returns:
+        int: Код возврата
+    """
+    parser = argparse.ArgumentParser(description="Резервные копии базы данных")
+    parser.add_argument("--dir", default=BACKUP_DIR, help="каталог копий")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.add_parser("create", help="снять копию и выполнить ротацию")
+    subparsers.add_parser("list", help="список копий")
+    restore_parser = subparsers.add_parser("restore", help="восстановить БД из копии (бот должен быть остановлен)")
+    restore_parser.add_argument("stamp", nargs="?", default="latest", help="метка копии или latest")
+
+    args = parser.parse_args(argv)
+
+    try:
+        if args.command == "create":
+            metrics = create_backup(args.dir)
+            print(f"✅ Копия {metrics['stamp']}: {metrics['compressed_size'] // 1024} КиБ "
+                  f"за {metrics['total_ms']} мс")
+            return 0
+
+        if args.command == "restore":
+            result = restore_backup(args.stamp, args.dir)
+            print(f"✅ Восстановлена копия {result['stamp']}")
+            for name, path in result['files'].items():
+                print(f"  {name} -> {path}")
+            return 0
+
+    except BackupError as e:
+        print(f"❌ {e}")
+        return 1
+
+    backups = list_backups(args.dir)
+    if not backups:
+        print(f"Копий нет ({args.dir})")
+    for entry in backups:
+        print(f"  {entry['stamp']}  {entry['size'] // 1024:>8} КиБ  {', '.join(sorted(entry['files']))}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,182 @@
+"""
+Нагрузочный тест /start при всплеске трафика с рекламной кампании.
+
+Сравнивает прежнюю цепочку вызовов (add_user, save_user_utm,
+update_utm_campaign_stats, add_bonus_points - каждый со своим commit)
+и register_user (одна транзакция). Запросы идут из пула потоков того же
+размера, что и в боте (DB_EXECUTOR_WORKERS), на временной БД.
+
+Запуск:
+    python bench_registration.py                      # 2000 /start
+    python bench_registration.py --users 10000 --workers 8
+"""
+
+import os
+import sys
+import time
+import random
+import logging
+import argparse
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+
+# Тест работает на временной БД, рабочую не трогаем
+os.environ.setdefault("DB_AUTO_MIGRATE", "0")
+
+import database
+from config import DB_EXECUTOR_WORKERS, REFERRAL_BONUS
+from migrations import apply_migrations
+
+CAMPAIGN_PARAM = "utm_vk__post__spring_sale____"
+REFERRERS = 50
+
+
+def legacy_start(user_id: int, first_name: str, start_param: Optional[str]):
+    """Прежний /start: отдельное соединение и commit на каждый шаг."""
+    utm_params = database.parse_utm_from_start_param(start_param)
+
+    referred_by = None
+    if start_param and start_param.startswith('REF'):
+        referred_by = database.get_user_by_referral_code(start_param)
+
+    is_new_user = database.add_user(user_id, None, first_name, referred_by)
+    if is_new_user:
+        database.save_user_utm(user_id, utm_params)
+        if utm_params['source_type'] == 'utm':
+            database.update_utm_campaign_stats(start_param, 'registration')
+
+    if is_new_user and referred_by:
+        database.add_bonus_points(referred_by, REFERRAL_BONUS, f"Реферальная программа: пригласил {first_name}")
+        database.add_bonus_points(user_id, REFERRAL_BONUS, "Регистрация по реферальной ссылке")
+
+
+def batched_start(user_id: int, first_name: str, start_param: Optional[str]):
+    """Новый /start: register_user одной транзакцией."""
+    database.register_user(user_id, None, first_name, start_param, referral_bonus=REFERRAL_BONUS)
+
+
+def prepare_db(path: str) -> List[str]:
+    """
+    Создать схему, кампанию и рефереров.
+
+    Returns:
+        List[str]: Реферальные коды рефереров
+    """
+    database.DB_PATH = path
+    apply_migrations()
+
+    with database.transaction() as cursor:
+        cursor.execute('''
+            INSERT INTO utm_campaigns (name, utm_source, utm_medium, utm_campaign, generated_link, utm_code)
+            VALUES ('bench', 'vk', 'post', 'spring_sale', ?, ?)
+        ''', (f"https://t.me/bench_bot?start={CAMPAIGN_PARAM}", CAMPAIGN_PARAM))
+
+        codes = []
+        for i in range(REFERRERS):
+            codes.append(database._insert_user(cursor, 1_000_000 + i, None, f"Referrer{i}"))
+    return codes
+
+
+def build_burst(users: int, codes: List[str], seed: int) -> list:
+    """
+    Сценарий всплеска: 70% по UTM-ссылке, 20% по реферальной,
+    10% органика; каждый пятый пользователь нажимает /start повторно.
+    """
+    rng = random.Random(seed)
+    burst = []
+    for user_id in range(1, users + 1):
+        roll = rng.random()
+        if roll < 0.7:
+            param = CAMPAIGN_PARAM
+        elif roll < 0.9:
+            param = rng.choice(codes)
+        else:
+            param = None
+        burst.append((user_id, f"User{user_id}", param))
+        if user_id % 5 == 0:
+            burst.append((user_id, f"User{user_id}", param))
+    rng.shuffle(burst)
+    return burst
+
+
+def run(mode: str, func, users: int, workers: int, seed: int) -> dict:
+    """Прогнать один сценарий на свежей БД и собрать метрики."""
+    tmpdir = tempfile.mkdtemp(prefix="bench_registration_")
+    codes = prepare_db(os.path.join(tmpdir, f"{mode}.db"))
+    burst = build_burst(users, codes, seed)
+    latencies = []
+
+    def call(args):
+        started = time.perf_counter()
+        func(*args)
+        latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(call, burst))
+    elapsed = time.perf_counter() - started
+
+    database.flush_utm_stats()
+    conn = database.get_connection()
+    registered = conn.execute('SELECT COUNT(*) FROM users WHERE user_id < 1000000').fetchone()[0]
+    clicks, registrations = conn.execute(
+        'SELECT clicks, registrations FROM utm_campaigns'
+    ).fetchone()
+    conn.close()
+    database.close_pool()
+
+    latencies.sort()
+    return {
+        'mode': mode,
+        'requests': len(burst),
+        'elapsed': elapsed,
+        'rps': len(burst) / elapsed,
+        'p50_ms': latencies[len(latencies) // 2] * 1000,
+        'p95_ms': latencies[int(len(latencies) * 0.95)] * 1000,
+        'registered': registered,
+        'expected': users,
+        'clicks': clicks,
+        'registrations': registrations,
+    }
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    """
+    Точка входа CLI.
+
+    Args:
+        argv: Аргументы командной строки
+
+    Returns:
+        int: Код возврата (1, если новая регистрация потеряла пользователей)
+    """
+    parser = argparse.ArgumentParser(description="Нагрузочный тест /start")
+    parser.add_argument("--users", type=int, default=2000, help="уникальных пользователей во всплеске")
+    parser.add_argument("--workers", type=int, default=DB_EXECUTOR_WORKERS, help="потоков БД")
+    parser.add_argument("--seed", type=int, default=7472, help="seed сценария")
+    args = parser.parse_args(argv)
+
+    # Логи INFO на каждую регистрацию искажают замер
+    logging.disable(logging.INFO)
+
+    results = [
+        run("legacy", legacy_start, args.users, args.workers, args.seed),
+        run("batched", batched_start, args.users, args.workers, args.seed),
+    ]
+
+    print(f"{'режим':<8} {'запросов':>8} {'сек':>7} {'/start в с':>10} {'p50 мс':>7} {'p95 мс':>7} "
+          f"{'зарег.':>7} {'клики':>6} {'рег.UTM':>7}")
+    for r in results:
+        print(f"{r['mode']:<8} {r['requests']:>8} {r['elapsed']:>7.2f} {r['rps']:>10.0f} "
+              f"{r['p50_ms']:>7.2f} {r['p95_ms']:>7.2f} {r['registered']:>7} "
+              f"{r['clicks']:>6} {r['registrations']:>7}")
+
+    legacy, batched = results
+    print()
+    print(f"Ускорение: x{batched['rps'] / legacy['rps']:.1f}")
+    return 0 if batched['registered'] == batched['expected'] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
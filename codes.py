@@ -0,0 +1,165 @@
+"""
+Генерация уникальных кодов (реферальные коды, сертификаты).
+
+Код - это номер из последовательности, пропущенный через обратимую
+перестановку: разные номера всегда дают разные коды, поэтому проверять
+уникальность запросом к БД не нужно. Перестановка - шифр Фейстеля
+с секретом последовательности, поэтому соседние номера дают непохожие
+коды и следующий код нельзя угадать по предыдущему.
+
+Номера выдаются блоками: одно обновление строки code_sequences
+резервирует сразу count номеров (пакетная выдача сертификатов).
+
+Использование (внутри транзакции, см. database.transaction):
+    codes = reserve_codes(cursor, 'certificate', count=10, length=8)
+"""
+
+import hashlib
+import secrets
+import string
+from typing import List
+
+ALPHABET = string.digits + string.ascii_uppercase
+BASE = len(ALPHABET)
+ROUNDS = 4
+
+
+class CodeSpaceExhausted(Exception):
+    """Все коды заданной длины уже выданы - нужно увеличить длину."""
+
+
+def _round_value(secret: bytes, round_no: int, half: int, half_bits: int) -> int:
+    """Раундовая функция Фейстеля: ключевой хэш половины блока."""
+    digest = hashlib.blake2b(
+        half.to_bytes(16, 'big') + bytes([round_no]), key=secret, digest_size=16
+    ).digest()
+    return int.from_bytes(digest, 'big') & ((1 << half_bits) - 1)
+
+
+def _feistel(value: int, secret: bytes, half_bits: int) -> int:
+    """Один проход сбалансированного шифра Фейстеля по 2 * half_bits битам."""
+    mask = (1 << half_bits) - 1
+    left, right = value >> half_bits, value & mask
+    for round_no in range(ROUNDS):
+        left, right = right, left ^ _round_value(secret, round_no, right, half_bits)
+    return (left << half_bits) | right
+
+
+def _feistel_inverse(value: int, secret: bytes, half_bits: int) -> int:
+    """Обратный проход шифра Фейстеля."""
+    mask = (1 << half_bits) - 1
+    left, right = value >> half_bits, value & mask
+    for round_no in reversed(range(ROUNDS)):
+        left, right = right ^ _round_value(secret, round_no, left, half_bits), left
+    return (left << half_bits) | right
+
+
+def _half_bits(space: int) -> int:
+    """Половина ширины блока, покрывающего [0, space)."""
+    bits = max(2, (space - 1).bit_length())
+    return (bits + 1) // 2
+
+
+def permute(value: int, length: int, secret: bytes) -> int:
+    """
+    Обратимо перемешать номер внутри [0, BASE ** length).
+
+    Блок Фейстеля шире пространства кодов не более чем в 4 раза, значения
+    за пределами пространства шифруются повторно (cycle walking).
+
+    Args:
+        value: Номер из последовательности
+        length: Длина кода в символах
+        secret: Секрет последовательности
+
+    Returns:
+        int: Перемешанный номер из того же диапазона
+    """
+    space = BASE ** length
+    if not 0 <= value < space:
+        raise CodeSpaceExhausted(f"Номер {value} вне пространства кодов длины {length}")
+
+    half_bits = _half_bits(space)
+    value = _feistel(value, secret, half_bits)
+    while value >= space:
+        value = _feistel(value, secret, half_bits)
+    return value
+
+
+def unpermute(value: int, length: int, secret: bytes) -> int:
+    """Обратное к permute() преобразование (номер по коду)."""
+    space = BASE ** length
+    half_bits = _half_bits(space)
+    value = _feistel_inverse(value, secret, half_bits)
+    while value >= space:
+        value = _feistel_inverse(value, secret, half_bits)
+    return value
+
+
+def encode(value: int, length: int, secret: bytes) -> str:
+    """
+    Получить код фиксированной длины по номеру.
+
+    Args:
+        value: Номер из последовательности
+        length: Длина кода в символах
+        secret: Секрет последовательности
+
+    Returns:
+        str: Код из цифр и заглавных латинских букв
+    """
+    value = permute(value, length, secret)
+    chars = []
+    for _ in range(length):
+        value, digit = divmod(value, BASE)
+        chars.append(ALPHABET[digit])
+    return ''.join(reversed(chars))
+
+
+def decode(code: str, secret: bytes) -> int:
+    """Получить номер по коду (для проверки и отладки)."""
+    value = 0
+    for char in code.upper():
+        value = value * BASE + ALPHABET.index(char)
+    return unpermute(value, len(code), secret)
+
+
+def reserve_codes(cursor, sequence: str, count: int = 1, length: int = 6) -> List[str]:
+    """
+    Выдать count новых уникальных кодов.
+
+    Вызывается внутри открытой транзакции: блок номеров резервируется
+    одним UPDATE, дальше коды вычисляются без обращений к БД. У каждой
+    длины своя последовательность, поэтому смена длины не даёт повторов.
+
+    Args:
+        cursor: Курсор транзакции
+        sequence: Имя последовательности ('referral', 'certificate')
+        count: Сколько кодов выдать
+        length: Длина кода в символах
+
+    Returns:
+        List[str]: Коды без префикса
+
+    Raises:
+        CodeSpaceExhausted: Если коды этой длины закончились
+    """
+    name = f"{sequence}:{length}"
+
+    cursor.execute('''
+        INSERT OR IGNORE INTO code_sequences (name, next_value, secret)
+        VALUES (?, 0, ?)
+    ''', (name, secrets.token_hex(16)))
+
+    cursor.execute('''
+        UPDATE code_sequences SET next_value = next_value + ? WHERE name = ?
+    ''', (count, name))
+    next_value, secret = cursor.execute(
+        'SELECT next_value, secret FROM code_sequences WHERE name = ?', (name,)
+    ).fetchone()
+
+    if next_value > BASE ** length:
+        raise CodeSpaceExhausted(f"Коды последовательности {sequence} длины {length} закончились")
+
+    key = bytes.fromhex(secret)
+    return [encode(value, length, key) for value in range(next_value - count, next_value)]
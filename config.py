@@ -79,6 +79,14 @@ BONUS_PERCENT = 5                # 5% от суммы заказа
 BONUS_THRESHOLD = 3000           # Минимальная сумма для начисления бонусов
 MAX_BONUS_PAYMENT_PERCENT = 50   # Максимум 50% оплаты бонусами
 REFERRAL_BONUS = 500            # Бонусы за реферальную программу
+BONUS_HOLD_TTL_MINUTES = 30     # Сколько держится резерв бонусов при оформлении заказа
+
+# =================================================================
+# КОДЫ (РЕФЕРАЛЬНЫЕ, СЕРТИФИКАТЫ)
+# =================================================================
+
+REFERRAL_CODE_LENGTH = 6         # REF + 6 символов (36^6 ≈ 2 млрд кодов)
+CERTIFICATE_CODE_LENGTH = 8      # CERT-XXXX-XXXX
 
 # =================================================================
 # ССЫЛКИ НА ОТЗЫВЫ
@@ -170,11 +178,39 @@ DB_PATH = "data/beauty_salon.db"
 BOT_DATA_PATH = "data/bot_data.pickle"
 CREDENTIALS_PATH = "credentials.json"
 
+# =================================================================
+# НАСТРОЙКИ БАЗЫ ДАННЫХ
+# =================================================================
+
+DB_POOL_SIZE = 8                   # Сколько свободных соединений держать в пуле
+DB_BUSY_TIMEOUT_MS = 5000          # Ожидание снятия блокировки (мс)
+DB_CACHE_SIZE = -16000             # Кэш страниц на соединение (отрицательное = КиБ, ~16 МБ)
+DB_MMAP_SIZE = 128 * 1024 * 1024   # Размер memory-mapped I/O (байт)
+DB_EXECUTOR_WORKERS = 4            # Потоков для запросов к БД из async-обработчиков
+UTM_STATS_FLUSH_SECONDS = 5        # Как часто счётчики UTM-кампаний сбрасываются в БД
+CHANGE_POLL_SECONDS = 2            # Как часто проверять изменения каталога и настроек из других процессов
+STATS_REFRESH_BATCH_DAYS = 31      # Сколько дней роллапов статистики пересчитывать за одну транзакцию
+ARCHIVE_AFTER_DAYS = 365           # Закрытые записи старше этого срока переносятся в архивную БД
+ARCHIVE_BATCH_SIZE = 1000          # Сколько строк переносить в архив за одну транзакцию
+DB_ANALYTICS_SNAPSHOT_SECONDS = 0  # Отчёты читают снимок БД, обновляемый раз в N секунд (0 - рабочий файл только на чтение)
+GROUP_COMMIT_WINDOW_MS = 2         # Сколько ждать попутных записей перед общим commit (мс)
+GROUP_COMMIT_MAX_BATCH = 200       # Максимум записей в одном групповом commit
+BACKUP_DIR = "data/backups"        # Куда складывать сжатые резервные копии
+BACKUP_PAGES_PER_STEP = 256        # Страниц за шаг копирования (между шагами БД свободна)
+BACKUP_STEP_SLEEP_SECONDS = 0.05   # Пауза между шагами копирования
+BACKUP_KEEP_DAILY = 7              # Сколько последних копий хранить всегда
+BACKUP_KEEP_WEEKLY = 4             # Сколько недель хранить по одной (последней за неделю) копии
+
+# Применять миграции схемы при импорте database (0 - только через python migrations.py apply)
+DB_AUTO_MIGRATE = os.getenv('DB_AUTO_MIGRATE', '1') != '0'
+
 # =================================================================
 # НАСТРОЙКИ КЭШИРОВАНИЯ
 # =================================================================
 
 CACHE_TTL_SECONDS = 300  # 5 минут кэш для Google Sheets
+PROFILE_SNAPSHOT_TTL_SECONDS = 30  # Подэкраны профиля используют данные главного экрана
+PRICING_PROFILE_TTL_SECONDS = 300  # Профиль цен (скидки подписки) на время оформления заказа
 # =================================================================
 # PAYMENT CONFIGURATION
 # =================================================================
@@ -3,22 +3,36 @@
 Автоматическая отправка комплексной аналитики в Telegram
 """
 
+import argparse
 import asyncio
 from datetime import datetime, timedelta
 from telegram import Bot
 from telegram.constants import ParseMode
 from config import TELEGRAM_BOT_TOKEN, ADMIN_ID
-from database import get_connection
+from database import (
+    get_connection, ANALYTICS, count_users, refresh_stats_rollups, rebuild_stats_rollups,
+    get_daily_stats, group_stats, FLOWER_ORDER_DONE_STATUSES
+)
 
 def get_daily_statistics():
-    """Получить полную статистику за день"""
+    """
+    Получить полную статистику за день.
 
-    conn = get_connection()
-    cursor = conn.cursor()
+    Счётчики и суммы читаются из дневных роллапов (stats_daily), которые
+    перед чтением догоняются по изменившимся дням. Напрямую к таблицам
+    идут только рейтинги дня и текущее состояние (всего пользователей,
+    активные подписки) - запросами по индексам.
+    """
+
+    refresh_stats_rollups()
 
     today = datetime.now().date()
     yesterday = today - timedelta(days=1)
 
+    daily = get_daily_stats(yesterday, today)
+    day = daily.get(str(today), {})
+    prev = daily.get(str(yesterday), {})
+
     stats = {
         'date': today.strftime('%d.%m.%Y'),
         'users': {},
@@ -35,87 +49,29 @@ def get_daily_statistics():
     # 1. ПОЛЬЗОВАТЕЛИ
     # =====================================================
 
-    # Новые регистрации за день
-    cursor.execute("""
-        SELECT COUNT(*) FROM users
-        WHERE DATE(registration_date) = ?
-    """, (today,))
-    stats['users']['new_today'] = cursor.fetchone()[0]
-
-    # Новые за вчера (для сравнения)
-    cursor.execute("""
-        SELECT COUNT(*) FROM users
-        WHERE DATE(registration_date) = ?
-    """, (yesterday,))
-    stats['users']['new_yesterday'] = cursor.fetchone()[0]
-
-    # Всего пользователей
-    cursor.execute("SELECT COUNT(*) FROM users")
-    stats['users']['total'] = cursor.fetchone()[0]
-
-    # Активные пользователи (совершили действие за день)
-    cursor.execute("""
-        SELECT COUNT(DISTINCT user_id) FROM (
-            SELECT user_id FROM salon_appointments WHERE DATE(created_at) = ?
-            UNION
-            SELECT user_id FROM flower_orders WHERE DATE(created_at) = ?
-            UNION
-            SELECT user_id FROM loyalty_transactions WHERE DATE(created_at) = ?
-        )
-    """, (today, today, today))
-    stats['users']['active_today'] = cursor.fetchone()[0]
+    stats['users']['new_today'] = day.get('users.new', 0)
+    stats['users']['new_yesterday'] = prev.get('users.new', 0)
+    stats['users']['total'] = count_users(ANALYTICS)
+    stats['users']['active_today'] = day.get('users.active', 0)
 
     # =====================================================
     # 2. ВЫРУЧКА
     # =====================================================
 
-    # Выручка салона за день
-    cursor.execute("""
-        SELECT COALESCE(SUM(total_amount), 0)
-        FROM salon_appointments
-        WHERE DATE(appointment_date) = ? AND status IN ('completed', 'confirmed')
-    """, (today,))
-    stats['revenue']['salon_today'] = cursor.fetchone()[0]
-
-    # Выручка салона вчера
-    cursor.execute("""
-        SELECT COALESCE(SUM(total_amount), 0)
-        FROM salon_appointments
-        WHERE DATE(appointment_date) = ? AND status IN ('completed', 'confirmed')
-    """, (yesterday,))
-    stats['revenue']['salon_yesterday'] = cursor.fetchone()[0]
+    def salon_revenue(metrics):
+        revenue = group_stats(metrics, 'salon.revenue')
+        return revenue.get('completed', 0) + revenue.get('confirmed', 0)
 
-    # Выручка цветов за день
-    cursor.execute("""
-        SELECT COALESCE(SUM(total_amount), 0)
-        FROM flower_orders
-        WHERE DATE(created_at) = ? AND status IN ('completed', 'paid')
-    """, (today,))
-    stats['revenue']['flowers_today'] = cursor.fetchone()[0]
+    def flower_revenue(metrics):
+        revenue = group_stats(metrics, 'flowers.revenue')
+        return sum(revenue.get(status, 0) for status in FLOWER_ORDER_DONE_STATUSES)
 
-    # Выручка цветов вчера
-    cursor.execute("""
-        SELECT COALESCE(SUM(total_amount), 0)
-        FROM flower_orders
-        WHERE DATE(created_at) = ? AND status IN ('completed', 'paid')
-    """, (yesterday,))
-    stats['revenue']['flowers_yesterday'] = cursor.fetchone()[0]
-
-    # Выручка сертификатов за день
-    cursor.execute("""
-        SELECT COALESCE(SUM(amount), 0)
-        FROM certificates
-        WHERE DATE(created_at) = ? AND status = 'active'
-    """, (today,))
-    stats['revenue']['certificates_today'] = cursor.fetchone()[0]
-
-    # Выручка подписок за день
-    cursor.execute("""
-        SELECT COALESCE(SUM(payment_amount), 0)
-        FROM user_subscriptions
-        WHERE DATE(created_at) = ?
-    """, (today,))
-    stats['revenue']['subscriptions_today'] = cursor.fetchone()[0]
+    stats['revenue']['salon_today'] = salon_revenue(day)
+    stats['revenue']['salon_yesterday'] = salon_revenue(prev)
+    stats['revenue']['flowers_today'] = flower_revenue(day)
+    stats['revenue']['flowers_yesterday'] = flower_revenue(prev)
+    stats['revenue']['certificates_today'] = day.get('certificates.revenue', 0)
+    stats['revenue']['subscriptions_today'] = day.get('subscriptions.revenue', 0)
 
     # Общая выручка
     stats['revenue']['total_today'] = (
@@ -134,82 +90,41 @@ def get_daily_statistics():
     # 3. ЗАКАЗЫ
     # =====================================================
 
-    # Заказы цветов
-    cursor.execute("""
-        SELECT
-            COUNT(*) as total,
-            SUM(CASE WHEN status = 'pending' THEN 1 ELSE 0 END) as pending,
-            SUM(CASE WHEN status = 'completed' THEN 1 ELSE 0 END) as completed,
-            SUM(CASE WHEN status = 'cancelled' THEN 1 ELSE 0 END) as cancelled
-        FROM flower_orders
-        WHERE DATE(created_at) = ?
-    """, (today,))
-    row = cursor.fetchone()
+    flower_orders = group_stats(day, 'flowers.orders')
+    completed = sum(flower_orders.get(status, 0) for status in FLOWER_ORDER_DONE_STATUSES)
+    cancelled = flower_orders.get('cancelled', 0)
+    total = sum(flower_orders.values())
     stats['orders']['flowers'] = {
-        'total': row[0],
-        'pending': row[1] or 0,
-        'completed': row[2] or 0,
-        'cancelled': row[3] or 0
+        'total': total,
+        'pending': total - completed - cancelled,
+        'completed': completed,
+        'cancelled': cancelled
     }
 
     # Средний чек цветов
-    cursor.execute("""
-        SELECT AVG(total_amount)
-        FROM flower_orders
-        WHERE DATE(created_at) = ? AND status = 'completed'
-    """, (today,))
-    stats['orders']['avg_flower_order'] = cursor.fetchone()[0] or 0
+    stats['orders']['avg_flower_order'] = (
+        stats['revenue']['flowers_today'] / completed if completed else 0
+    )
 
     # =====================================================
     # 4. САЛОН КРАСОТЫ
     # =====================================================
 
-    # Записи в салон
-    cursor.execute("""
-        SELECT
-            COUNT(*) as total,
-            SUM(CASE WHEN status = 'pending' THEN 1 ELSE 0 END) as pending,
-            SUM(CASE WHEN status = 'confirmed' THEN 1 ELSE 0 END) as confirmed,
-            SUM(CASE WHEN status = 'completed' THEN 1 ELSE 0 END) as completed,
-            SUM(CASE WHEN status = 'cancelled' THEN 1 ELSE 0 END) as cancelled
-        FROM salon_appointments
-        WHERE DATE(appointment_date) = ?
-    """, (today,))
-    row = cursor.fetchone()
+    appointments = group_stats(day, 'salon.appointments')
     stats['salon']['appointments'] = {
-        'total': row[0],
-        'pending': row[1] or 0,
-        'confirmed': row[2] or 0,
-        'completed': row[3] or 0,
-        'cancelled': row[4] or 0
+        'total': sum(appointments.values()),
+        'pending': appointments.get('pending', 0),
+        'confirmed': appointments.get('confirmed', 0),
+        'completed': appointments.get('completed', 0),
+        'cancelled': appointments.get('cancelled', 0)
     }
 
     # Средний чек салона
-    cursor.execute("""
-        SELECT AVG(total_amount)
-        FROM salon_appointments
-        WHERE DATE(appointment_date) = ? AND status = 'completed'
-    """, (today,))
-    stats['salon']['avg_check'] = cursor.fetchone()[0] or 0
-
-    # Топ услуги дня
-    cursor.execute("""
-        SELECT s.name, COUNT(*) as cnt
-        FROM salon_appointments sa
-        JOIN services s ON sa.service_id = s.id
-        WHERE DATE(sa.appointment_date) = ?
-        GROUP BY s.name
-        ORDER BY cnt DESC
-        LIMIT 3
-    """, (today,))
-    stats['salon']['top_services'] = cursor.fetchall()
+    completed = appointments.get('completed', 0)
+    stats['salon']['avg_check'] = day.get('salon.revenue.completed', 0) / completed if completed else 0
 
     # Загруженность (% занятых слотов)
-    cursor.execute("""
-        SELECT COUNT(*) FROM salon_appointments
-        WHERE DATE(appointment_date) = ? AND status != 'cancelled'
-    """, (today,))
-    booked_slots = cursor.fetchone()[0]
+    booked_slots = sum(appointments.values()) - appointments.get('cancelled', 0)
     total_slots = 12 * 8  # 12 часов работы * 8 слотов в час (примерно)
     stats['salon']['occupancy'] = (booked_slots / total_slots * 100) if total_slots > 0 else 0
 
@@ -217,143 +132,107 @@ def get_daily_statistics():
     # 5. МАРКЕТИНГ
     # =====================================================
 
-    # UTM-кампании
-    cursor.execute("""
-        SELECT
-            utm_source,
-            COUNT(DISTINCT user_id) as registrations,
-            SUM(conversions) as conversions,
-            SUM(conversion_amount) as revenue
-        FROM user_utm_tracking
-        WHERE DATE(first_visit) = ?
-        GROUP BY utm_source
-        ORDER BY conversions DESC
-        LIMIT 5
-    """, (today,))
-    stats['marketing']['utm_sources'] = cursor.fetchall()
-
-    # Реферальная программа за день
-    cursor.execute("""
-        SELECT COUNT(*) FROM users
-        WHERE DATE(registration_date) = ? AND referred_by IS NOT NULL
-    """, (today,))
-    stats['marketing']['referral_signups'] = cursor.fetchone()[0]
-
-    # Начислено реферальных бонусов
-    cursor.execute("""
-        SELECT COALESCE(SUM(points), 0)
-        FROM loyalty_transactions
-        WHERE DATE(created_at) = ?
-        AND description LIKE '%Реферальная%'
-    """, (today,))
-    stats['marketing']['referral_bonuses'] = cursor.fetchone()[0]
+    # Каналы привлечения: регистрации, конверсии и выручка за день
+    registrations = group_stats(day, 'users.source')
+    conversions = group_stats(day, 'channel.conversions')
+    channel_revenue = group_stats(day, 'channel.revenue')
+    sources = set(registrations) | set(conversions)
+    stats['marketing']['utm_sources'] = sorted(
+        (
+            (source, registrations.get(source, 0), conversions.get(source, 0), channel_revenue.get(source, 0))
+            for source in sources
+        ),
+        key=lambda row: (row[2], row[1]),
+        reverse=True
+    )[:5]
+
+    stats['marketing']['referral_signups'] = day.get('users.referral', 0)
+    stats['marketing']['referral_bonuses'] = day.get('bonuses.referral', 0)
 
     # =====================================================
     # 6. ПОДПИСКИ
     # =====================================================
 
-    # Новые подписки за день
-    cursor.execute("""
-        SELECT sp.name, COUNT(*) as cnt
-        FROM user_subscriptions us
-        JOIN subscription_plans sp ON us.plan_id = sp.id
-        WHERE DATE(us.created_at) = ?
-        GROUP BY sp.name
-    """, (today,))
-    stats['subscriptions']['new_today'] = cursor.fetchall()
-
-    # Всего активных подписок
-    cursor.execute("""
-        SELECT COUNT(*) FROM user_subscriptions
-        WHERE status = 'active' AND end_date >= ?
-    """, (today,))
-    stats['subscriptions']['active_total'] = cursor.fetchone()[0]
+    stats['subscriptions']['new_today'] = sorted(group_stats(day, 'subscriptions.new').items())
 
-    # Использование подписок сегодня
-    cursor.execute("""
-        SELECT
-            SUM(CASE WHEN type = 'flower' THEN 1 ELSE 0 END) as flowers_used,
-            SUM(CASE WHEN type = 'service' THEN 1 ELSE 0 END) as services_used
-        FROM subscription_usage
-        WHERE DATE(used_at) = ?
-    """, (today,))
-    row = cursor.fetchone()
+    usage = group_stats(day, 'subscriptions.usage')
     stats['subscriptions']['usage_today'] = {
-        'flowers': row[0] or 0,
-        'services': row[1] or 0
+        'flowers': usage.get('flower', 0),
+        'services': usage.get('service', 0)
     }
 
     # =====================================================
     # 7. БОНУСНАЯ СИСТЕМА
     # =====================================================
 
-    # Начислено бонусов
-    cursor.execute("""
-        SELECT COALESCE(SUM(points), 0)
-        FROM loyalty_transactions
-        WHERE DATE(created_at) = ? AND points > 0
-    """, (today,))
-    stats['bonuses']['earned_today'] = cursor.fetchone()[0]
+    stats['bonuses']['earned_today'] = day.get('bonuses.earned', 0)
+    stats['bonuses']['spent_today'] = day.get('bonuses.spent', 0)
+    stats['bonuses']['paid_with_bonuses'] = day.get('bonuses.spent', 0)
 
-    # Потрачено бонусов
-    cursor.execute("""
-        SELECT COALESCE(SUM(ABS(points)), 0)
-        FROM loyalty_transactions
-        WHERE DATE(created_at) = ? AND points < 0
-    """, (today,))
-    stats['bonuses']['spent_today'] = cursor.fetchone()[0]
+    # =====================================================
+    # 8. ТЕКУЩЕЕ СОСТОЯНИЕ И РЕЙТИНГИ ДНЯ
+    # =====================================================
+
+    # Тяжёлые агрегаты - через соединение только для чтения
+    conn = get_connection(ANALYTICS)
+    cursor = conn.cursor()
 
-    # Сумма оплаченная бонусами
+    day_start, day_end = str(today), str(today + timedelta(days=1))
+
+    # Всего активных подписок
     cursor.execute("""
-        SELECT COALESCE(SUM(bonus_used), 0)
-        FROM (
-            SELECT bonus_used FROM salon_appointments WHERE DATE(appointment_date) = ?
-            UNION ALL
-            SELECT bonus_used FROM flower_orders WHERE DATE(created_at) = ?
-        )
-    """, (today, today))
-    stats['bonuses']['paid_with_bonuses'] = cursor.fetchone()[0]
+        SELECT COUNT(*) FROM user_subscriptions
+        WHERE status = 'active' AND end_date >= ?
+    """, (day_start,))
+    stats['subscriptions']['active_total'] = cursor.fetchone()[0]
 
-    # =====================================================
-    # 8. ТОП ИСПОЛНИТЕЛИ
-    # =====================================================
+    # Топ услуги дня
+    cursor.execute("""
+        SELECT service_name, COUNT(*) as cnt
+        FROM salon_appointments
+        WHERE appointment_date = ?
+        GROUP BY service_name
+        ORDER BY cnt DESC
+        LIMIT 3
+    """, (day_start,))
+    stats['salon']['top_services'] = cursor.fetchall()
 
     # Топ клиенты по выручке за день
-    cursor.execute("""
+    done_placeholders = ', '.join('?' * len(FLOWER_ORDER_DONE_STATUSES))
+    cursor.execute(f"""
         SELECT
             u.first_name,
             u.user_id,
             SUM(total) as revenue
         FROM (
-            SELECT user_id, total_amount as total
+            SELECT user_id, COALESCE(price, 0) as total
             FROM salon_appointments
-            WHERE DATE(appointment_date) = ? AND status = 'completed'
+            WHERE appointment_date = ? AND status = 'completed'
             UNION ALL
             SELECT user_id, total_amount as total
             FROM flower_orders
-            WHERE DATE(created_at) = ? AND status = 'completed'
+            WHERE created_at >= ? AND created_at < ? AND status IN ({done_placeholders})
         ) as orders
         JOIN users u ON orders.user_id = u.user_id
         GROUP BY u.user_id, u.first_name
         ORDER BY revenue DESC
         LIMIT 5
-    """, (today, today))
+    """, (day_start, day_start, day_end, *FLOWER_ORDER_DONE_STATUSES))
     stats['top_performers']['clients'] = cursor.fetchall()
 
     # Топ товары за день
     cursor.execute("""
         SELECT
             p.name,
-            COUNT(*) as quantity,
-            SUM(p.price * quantity) as revenue
-        FROM flower_orders fo
-        CROSS JOIN json_each(fo.items_json) as item
-        JOIN products p ON json_extract(item.value, '$.id') = p.id
-        WHERE DATE(fo.created_at) = ?
-        GROUP BY p.name
+            SUM(oi.quantity) as quantity,
+            SUM(oi.unit_price * oi.quantity) as revenue
+        FROM order_items oi
+        JOIN products p ON oi.product_id = p.id
+        WHERE oi.created_at >= ? AND oi.created_at < ?
+        GROUP BY p.id, p.name
         ORDER BY revenue DESC
         LIMIT 5
-    """, (today,))
+    """, (day_start, day_end))
     stats['top_performers']['products'] = cursor.fetchall()
 
     conn.close()
@@ -546,7 +425,22 @@ async def send_daily_report():
 
 
 def main():
-    """Главная функция для запуска"""
+    """
+    Главная функция для запуска.
+
+    python daily_report.py                           - отправить отчёт за сегодня
+    python daily_report.py --backfill [--since ДАТА] - перестроить роллапы статистики из истории
+    """
+    parser = argparse.ArgumentParser(description="Ежедневный отчёт собственнику")
+    parser.add_argument("--backfill", action="store_true", help="перестроить роллапы статистики из истории")
+    parser.add_argument("--since", default=None, help="первый день перестроения (YYYY-MM-DD)")
+    args = parser.parse_args()
+
+    if args.backfill:
+        days = rebuild_stats_rollups(args.since)
+        print(f"✅ Роллапы статистики перестроены: {days} дн.")
+        return
+
     asyncio.run(send_daily_report())
 
 
@@ -6,13 +6,33 @@
 import sqlite3
 import logging
 import os
-import random
-import string
+import re
+import atexit
 import json
-from datetime import datetime
-from typing import Optional, List, Tuple
-
-from config import DB_PATH
+import base64
+import queue
+import threading
+import time
+from urllib.parse import quote
+from collections import namedtuple
+from concurrent.futures import Future
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from typing import Dict, Optional, List, Tuple
+
+from codes import reserve_codes
+from records import (
+    fetch_records, fetch_record, Product, Appointment, ScheduleAppointment, FlowerOrder, Review, UserSummary,
+    BonusSettings, ReferralSettings, FeedbackSettings, ProfileSnapshot
+)
+from config import (
+    DB_PATH, DB_POOL_SIZE, DB_BUSY_TIMEOUT_MS, DB_CACHE_SIZE, DB_MMAP_SIZE,
+    DB_AUTO_MIGRATE, BONUS_HOLD_TTL_MINUTES, REFERRAL_CODE_LENGTH, CERTIFICATE_CODE_LENGTH,
+    UTM_STATS_FLUSH_SECONDS, CHANGE_POLL_SECONDS, STATS_REFRESH_BATCH_DAYS,
+    ARCHIVE_AFTER_DAYS, ARCHIVE_BATCH_SIZE, DB_ANALYTICS_SNAPSHOT_SECONDS,
+    BACKUP_PAGES_PER_STEP, BACKUP_STEP_SLEEP_SECONDS,
+    GROUP_COMMIT_WINDOW_MS, GROUP_COMMIT_MAX_BATCH
+)
 
 # Настройка логирования
 logging.basicConfig(
@@ -22,533 +42,660 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
-def get_connection():
+# =================================================================
+# ПУЛ СОЕДИНЕНИЙ
+# =================================================================
+
+class _PooledConnection:
     """
-    Получить соединение с базой данных.
+    Обёртка над sqlite3.Connection из пула.
 
-    Returns:
-        sqlite3.Connection: Объект соединения с БД
+    Ведёт себя как обычное соединение, но close() не закрывает его,
+    а возвращает в пул. Благодаря этому существующий код вида
+    conn = get_connection() ... conn.close() работает без изменений.
     """
-    # Создать папку data/ если её нет
-    os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
-    return sqlite3.connect(DB_PATH)
 
+    __slots__ = ('_conn', '_pool')
 
-def init_db():
-    """
-    Инициализация базы данных.
-    Создание всех необходимых таблиц.
-    """
-    try:
-        conn = get_connection()
-        cursor = conn.cursor()
+    def __init__(self, conn: sqlite3.Connection, pool: "_ConnectionPool"):
+        object.__setattr__(self, '_conn', conn)
+        object.__setattr__(self, '_pool', pool)
 
-        # Таблица пользователей
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                user_id INTEGER PRIMARY KEY,
-                username TEXT,
-                first_name TEXT,
-                phone TEXT,
-                registration_date DATETIME DEFAULT CURRENT_TIMESTAMP,
-                bonus_points INTEGER DEFAULT 0,
-                referral_code TEXT UNIQUE,
-                referred_by INTEGER
-            )
-        ''')
+    def __getattr__(self, name):
+        conn = object.__getattribute__(self, '_conn')
+        if conn is None:
+            raise sqlite3.ProgrammingError("Cannot operate on a closed database.")
+        return getattr(conn, name)
 
-        # Таблица адресов доставки
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS addresses (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                address TEXT,
-                is_default BOOLEAN DEFAULT FALSE,
-                FOREIGN KEY (user_id) REFERENCES users(user_id)
-            )
-        ''')
+    def __setattr__(self, name, value):
+        # row_factory, text_factory и т.п. выставляются на само соединение
+        setattr(self._conn, name, value)
 
-        # Таблица транзакций лояльности
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS loyalty_transactions (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                points INTEGER,
-                description TEXT,
-                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users(user_id)
-            )
-        ''')
+    def __enter__(self):
+        self._conn.__enter__()
+        return self
 
-        # Таблица журнала уведомлений
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS notifications_log (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                notification_type TEXT,
-                sent_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users(user_id)
-            )
-        ''')
+    def __exit__(self, exc_type, exc_value, traceback):
+        return self._conn.__exit__(exc_type, exc_value, traceback)
 
-        # Таблица услуг салона
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS services (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                category TEXT NOT NULL,
-                name TEXT NOT NULL,
-                price INTEGER NOT NULL,
-                description TEXT,
-                duration_minutes INTEGER NOT NULL,
-                active BOOLEAN DEFAULT TRUE
-            )
-        ''')
+    def close(self):
+        """Вернуть соединение в пул."""
+        conn = self._conn
+        if conn is not None:
+            object.__setattr__(self, '_conn', None)
+            self._pool.release(conn)
 
-        # Таблица товаров (цветы)
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS products (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                category TEXT NOT NULL,
-                name TEXT NOT NULL,
-                price INTEGER NOT NULL,
-                photo_url TEXT,
-                description TEXT,
-                in_stock BOOLEAN DEFAULT TRUE,
-                active BOOLEAN DEFAULT TRUE
-            )
-        ''')
+    def __del__(self):
+        # Соединения, не закрытые в ветке except, тоже возвращаются в пул
+        try:
+            self.close()
+        except Exception:
+            pass
+
+
+class _ConnectionPool:
+    """
+    Пул заранее настроенных соединений с SQLite.
+
+    PRAGMA применяются один раз при создании соединения. Пул не блокирует
+    вызывающий код: если свободных соединений нет, открывается новое,
+    а при возврате лишние (сверх DB_POOL_SIZE) закрываются.
+
+    Пул только для чтения (readonly) открывает файл с mode=ro и query_only:
+    такие соединения не берут блокировку на запись и не могут что-либо
+    изменить даже по ошибке.
+    """
+
+    def __init__(self, db_path: str, max_idle: int, readonly: bool = False,
+                 version: Optional[int] = None):
+        self.db_path = db_path
+        self.max_idle = max_idle
+        self.readonly = readonly
+        self.version = version  # Версия снимка (mtime), по которой пул пересоздаётся
+        self.pid = os.getpid()
+        self._idle: List[sqlite3.Connection] = []
+        self._lock = threading.Lock()
+        self._stats = {
+            'created': 0,
+            'reused': 0,
+            'released': 0,
+            'discarded': 0,
+            'in_use': 0,
+            'peak_in_use': 0,
+        }
 
-        # Таблица записей в салон
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS salon_appointments (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                user_name TEXT NOT NULL,
-                phone TEXT NOT NULL,
-                service_id INTEGER NOT NULL,
-                service_name TEXT NOT NULL,
-                appointment_date TEXT NOT NULL,
-                time_slot TEXT NOT NULL,
-                status TEXT DEFAULT 'pending',
-                prepaid BOOLEAN DEFAULT FALSE,
-                comment TEXT,
-                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users(user_id),
-                FOREIGN KEY (service_id) REFERENCES services(id)
-            )
-        ''')
+        directory = os.path.dirname(db_path)
+        if directory and not readonly:
+            os.makedirs(directory, exist_ok=True)
+
+    def _connect(self) -> sqlite3.Connection:
+        """Открыть новое соединение и применить PRAGMA."""
+        if self.readonly:
+            return self._connect_readonly()
+
+        conn = sqlite3.connect(
+            self.db_path,
+            timeout=DB_BUSY_TIMEOUT_MS / 1000,
+            check_same_thread=False
+        )
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(f"PRAGMA busy_timeout={int(DB_BUSY_TIMEOUT_MS)}")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA cache_size={int(DB_CACHE_SIZE)}")
+        conn.execute(f"PRAGMA mmap_size={int(DB_MMAP_SIZE)}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        # Архив закрытых записей: таблицы в нём создаёт архивация,
+        # чтение истории идёт через временные представления *_history
+        conn.execute("ATTACH DATABASE ? AS archive", (archive_path(self.db_path),))
+        _ensure_history(conn)
+        return conn
+
+    def _connect_readonly(self) -> sqlite3.Connection:
+        """
+        Открыть соединение только для чтения.
+
+        Журнал WAL задаёт пишущая сторона, архив не подключается:
+        *_history читаются через транзакционные соединения.
+        """
+        conn = sqlite3.connect(
+            f"file:{quote(os.path.abspath(self.db_path))}?mode=ro",
+            uri=True,
+            timeout=DB_BUSY_TIMEOUT_MS / 1000,
+            check_same_thread=False
+        )
+        conn.execute(f"PRAGMA busy_timeout={int(DB_BUSY_TIMEOUT_MS)}")
+        conn.execute(f"PRAGMA cache_size={int(DB_CACHE_SIZE)}")
+        conn.execute(f"PRAGMA mmap_size={int(DB_MMAP_SIZE)}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA query_only=1")
+        return conn
+
+    def acquire(self) -> _PooledConnection:
+        """Взять соединение из пула (или открыть новое)."""
+        conn = None
+        with self._lock:
+            if self._idle:
+                conn = self._idle.pop()
+                self._stats['reused'] += 1
+            self._stats['in_use'] += 1
+            if self._stats['in_use'] > self._stats['peak_in_use']:
+                self._stats['peak_in_use'] = self._stats['in_use']
+
+        if conn is None:
+            try:
+                conn = self._connect()
+            except Exception:
+                with self._lock:
+                    self._stats['in_use'] -= 1
+                raise
+            with self._lock:
+                self._stats['created'] += 1
+
+        return _PooledConnection(conn, self)
+
+    def release(self, conn: sqlite3.Connection):
+        """Вернуть соединение в пул, откатив незавершённую транзакцию."""
+        keep = os.getpid() == self.pid
+        if keep:
+            try:
+                if conn.in_transaction:
+                    conn.rollback()
+                conn.row_factory = None
+            except sqlite3.Error:
+                keep = False
+
+        with self._lock:
+            self._stats['in_use'] -= 1
+            self._stats['released'] += 1
+            if keep and len(self._idle) < self.max_idle:
+                self._idle.append(conn)
+                return
+            self._stats['discarded'] += 1
 
-        # Таблица заказов цветов
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS flower_orders (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                user_name TEXT NOT NULL,
-                phone TEXT NOT NULL,
-                items TEXT NOT NULL,
-                total_amount INTEGER NOT NULL,
-                delivery_type TEXT NOT NULL,
-                delivery_address TEXT,
-                delivery_time TEXT,
-                anonymous BOOLEAN DEFAULT FALSE,
-                card_text TEXT,
-                recipient_name TEXT,
-                recipient_phone TEXT,
-                status TEXT DEFAULT 'new',
-                paid BOOLEAN DEFAULT FALSE,
-                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users(user_id)
-            )
-        ''')
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+
+    def close_all(self):
+        """Закрыть все свободные соединения пула."""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            try:
+                conn.close()
+            except sqlite3.Error:
+                pass
+
+    def stats(self) -> dict:
+        """Снимок статистики пула."""
+        with self._lock:
+            stats = dict(self._stats)
+            stats['idle'] = len(self._idle)
+        stats['max_idle'] = self.max_idle
+        stats['db_path'] = self.db_path
+        return stats
+
+
+# Режимы соединений: запросы бота и админки (чтение + запись) и тяжёлые
+# отчёты (только чтение, при DB_ANALYTICS_SNAPSHOT_SECONDS > 0 - из снимка)
+TRANSACTIONAL = 'transactional'
+ANALYTICS = 'analytics'
+
+_pool: Optional[_ConnectionPool] = None
+_analytics_pool: Optional[_ConnectionPool] = None
+_pool_lock = threading.Lock()
+_snapshot_lock = threading.Lock()
+
+
+def _get_pool() -> _ConnectionPool:
+    """Получить пул текущего процесса (после fork создаётся новый)."""
+    global _pool
+    pool = _pool
+    if pool is None or pool.pid != os.getpid() or pool.db_path != DB_PATH:
+        with _pool_lock:
+            pool = _pool
+            if pool is None or pool.pid != os.getpid() or pool.db_path != DB_PATH:
+                if pool is not None and pool.pid == os.getpid():
+                    pool.close_all()
+                pool = _ConnectionPool(DB_PATH, DB_POOL_SIZE)
+                _pool = pool
+    return pool
+
+
+def snapshot_path(db_path: str) -> str:
+    """Путь к снимку для аналитики: data/beauty_salon.db -> data/beauty_salon_snapshot.db."""
+    root, ext = os.path.splitext(db_path)
+    return f"{root}_snapshot{ext or '.db'}"
+
+
+def refresh_analytics_snapshot(db_path: Optional[str] = None, force: bool = False) -> bool:
+    """
+    Обновить снимок рабочей БД для аналитики.
+
+    Копия снимается backup API порциями по BACKUP_PAGES_PER_STEP страниц
+    с паузами в рамках одной читающей транзакции (согласованный снимок,
+    бот продолжает писать) во временный файл и подменяется атомарно
+    (os.replace): уже открытые соединения дочитывают старый файл.
+    Снимок общий для всех процессов: свежий (моложе
+    DB_ANALYTICS_SNAPSHOT_SECONDS) не переснимается.
 
-        # Таблица сертификатов
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS certificates (
-                code TEXT PRIMARY KEY,
-                amount INTEGER NOT NULL,
-                buyer_user_id INTEGER NOT NULL,
-                purchase_date DATETIME DEFAULT CURRENT_TIMESTAMP,
-                used BOOLEAN DEFAULT FALSE,
-                used_by_user_id INTEGER,
-                used_date DATETIME,
-                FOREIGN KEY (buyer_user_id) REFERENCES users(user_id)
-            )
-        ''')
+    Args:
+        db_path: Рабочая БД (по умолчанию DB_PATH)
+        force: Обновить, даже если снимок свежий
 
-        # Таблица галереи
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS gallery (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                category TEXT NOT NULL,
-                description TEXT,
-                photo_url TEXT NOT NULL,
-                price INTEGER DEFAULT 0,
-                created_at DATETIME DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
+    Returns:
+        bool: True если снимок обновлён
+    """
+    db_path = db_path or DB_PATH
+    path = snapshot_path(db_path)
 
-        # Миграция: добавить created_at если его нет
-        try:
-            cursor.execute("SELECT created_at FROM gallery LIMIT 1")
-        except:
-            # SQLite не позволяет DEFAULT CURRENT_TIMESTAMP при ALTER TABLE
-            # Используем NULL как значение по умолчанию, а затем обновим существующие записи
-            cursor.execute("ALTER TABLE gallery ADD COLUMN created_at DATETIME")
-            cursor.execute("UPDATE gallery SET created_at = CURRENT_TIMESTAMP WHERE created_at IS NULL")
-            logger.info("Добавлен столбец created_at в таблицу gallery")
-
-        # Миграция: добавить price если его нет
+    with _snapshot_lock:
+        if not force:
+            try:
+                age = time.time() - os.stat(path).st_mtime
+                if age < DB_ANALYTICS_SNAPSHOT_SECONDS:
+                    return False
+            except OSError:
+                pass
+
+        started = time.perf_counter()
+        tmp_path = f"{path}.{os.getpid()}.tmp"
         try:
-            cursor.execute("SELECT price FROM gallery LIMIT 1")
-        except:
-            cursor.execute("ALTER TABLE gallery ADD COLUMN price INTEGER DEFAULT 0")
-            logger.info("Добавлен столбец price в таблицу gallery")
+            source = sqlite3.connect(db_path, timeout=DB_BUSY_TIMEOUT_MS / 1000)
+            target = sqlite3.connect(tmp_path)
+            try:
+                source.execute("BEGIN")
+                source.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()
+                source.backup(
+                    target,
+                    pages=BACKUP_PAGES_PER_STEP,
+                    progress=lambda status, remaining, total: remaining and time.sleep(BACKUP_STEP_SLEEP_SECONDS),
+                )
+                source.rollback()
+                target.execute("PRAGMA journal_mode=DELETE")
+            finally:
+                target.close()
+                source.close()
+            os.replace(tmp_path, path)
 
-        # Миграция: добавить price и duration_minutes в salon_appointments
-        try:
-            cursor.execute("SELECT price FROM salon_appointments LIMIT 1")
-        except:
-            cursor.execute("ALTER TABLE salon_appointments ADD COLUMN price INTEGER DEFAULT 0")
-            # Обновить цены из услуг
-            cursor.execute("""
-                UPDATE salon_appointments
-                SET price = (SELECT price FROM services WHERE services.id = salon_appointments.service_id)
-                WHERE price = 0 OR price IS NULL
-            """)
-            logger.info("Добавлен столбец price в таблицу salon_appointments")
+        except Exception as e:
+            logger.error(f"Ошибка обновления снимка БД для аналитики: {e}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return False
 
-        try:
-            cursor.execute("SELECT duration_minutes FROM salon_appointments LIMIT 1")
-        except:
-            cursor.execute("ALTER TABLE salon_appointments ADD COLUMN duration_minutes INTEGER DEFAULT 60")
-            # Обновить длительность из услуг
-            cursor.execute("""
-                UPDATE salon_appointments
-                SET duration_minutes = (SELECT duration_minutes FROM services WHERE services.id = salon_appointments.service_id)
-                WHERE duration_minutes = 60 OR duration_minutes IS NULL
-            """)
-            logger.info("Добавлен столбец duration_minutes в таблицу salon_appointments")
-
-        # Миграция: добавить поля источников привлечения в users
-        try:
-            cursor.execute("SELECT utm_source FROM users LIMIT 1")
-        except:
-            cursor.execute("ALTER TABLE users ADD COLUMN utm_source TEXT")
-            cursor.execute("ALTER TABLE users ADD COLUMN utm_medium TEXT")
-            cursor.execute("ALTER TABLE users ADD COLUMN utm_campaign TEXT")
-            cursor.execute("ALTER TABLE users ADD COLUMN utm_content TEXT")
-            cursor.execute("ALTER TABLE users ADD COLUMN utm_term TEXT")
-            cursor.execute("ALTER TABLE users ADD COLUMN source_type TEXT DEFAULT 'organic'")
-            logger.info("Добавлены столбцы UTM-меток в таблицу users")
-
-        # Миграция: добавить поле дня рождения и флаг заполнения профиля
-        try:
-            cursor.execute("SELECT birthday FROM users LIMIT 1")
-        except:
-            cursor.execute("ALTER TABLE users ADD COLUMN birthday DATE")
-            cursor.execute("ALTER TABLE users ADD COLUMN profile_filled BOOLEAN DEFAULT FALSE")
-            logger.info("Добавлены поля birthday и profile_filled в таблицу users")
+    logger.info(f"Снимок БД для аналитики обновлён за {int((time.perf_counter() - started) * 1000)} мс")
+    return True
 
-        # Таблица реферальных наград
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS referral_rewards (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                referrer_user_id INTEGER NOT NULL,
-                referred_user_id INTEGER NOT NULL,
-                reward_type TEXT NOT NULL,
-                reward_amount INTEGER NOT NULL,
-                trigger_order_id INTEGER,
-                trigger_order_amount INTEGER,
-                status TEXT DEFAULT 'pending',
-                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                paid_at DATETIME,
-                FOREIGN KEY (referrer_user_id) REFERENCES users(user_id),
-                FOREIGN KEY (referred_user_id) REFERENCES users(user_id)
-            )
-        ''')
 
-        # Таблица UTM-кампаний (для генерации ссылок)
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS utm_campaigns (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name TEXT NOT NULL UNIQUE,
-                utm_source TEXT NOT NULL,
-                utm_medium TEXT,
-                utm_campaign TEXT,
-                utm_content TEXT,
-                utm_term TEXT,
-                generated_link TEXT,
-                clicks INTEGER DEFAULT 0,
-                registrations INTEGER DEFAULT 0,
-                conversions INTEGER DEFAULT 0,
-                revenue INTEGER DEFAULT 0,
-                active BOOLEAN DEFAULT TRUE,
-                created_at DATETIME DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
+class _SnapshotRefresher:
+    """
+    Фоновый поток, обновляющий снимок для аналитики.
 
-        # Таблица платежей
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS payments (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                order_id TEXT NOT NULL,
-                order_type TEXT NOT NULL,
-                user_id INTEGER NOT NULL,
-                amount INTEGER NOT NULL,
-                currency TEXT DEFAULT 'RUB',
-                provider TEXT NOT NULL,
-                payment_method TEXT,
-                payment_id TEXT UNIQUE,
-                payment_url TEXT,
-                status TEXT DEFAULT 'pending',
-                paid_at DATETIME,
-                metadata TEXT,
-                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users(user_id)
-            )
-        ''')
+    Запускается при первом запросе ANALYTICS-соединения, просыпается раз
+    в DB_ANALYTICS_SNAPSHOT_SECONDS. Запросы снимок не ждут: они берут
+    последний готовый файл.
+    """
 
-        # Индексы для платежей
-        cursor.execute('''
-            CREATE INDEX IF NOT EXISTS idx_payments_order
-            ON payments(order_id, order_type)
-        ''')
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self._thread = None
 
-        cursor.execute('''
-            CREATE INDEX IF NOT EXISTS idx_payments_status
-            ON payments(status)
-        ''')
+    def ensure_running(self):
+        """Запустить поток, если он ещё не работает в этом процессе."""
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._thread = None
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._run, name="db-analytics-snapshot", daemon=True
+                )
+                self._thread.start()
 
-        # Таблица настроек реферальной программы
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS referral_settings (
-                id INTEGER PRIMARY KEY CHECK (id = 1),
-                enabled BOOLEAN DEFAULT TRUE,
-                reward_type TEXT DEFAULT 'fixed',
-                reward_amount INTEGER DEFAULT 500,
-                reward_percent INTEGER DEFAULT 10,
-                min_order_amount INTEGER DEFAULT 1000,
-                max_reward_amount INTEGER DEFAULT 5000,
-                reward_on_first_order_only BOOLEAN DEFAULT TRUE,
-                auto_approve BOOLEAN DEFAULT FALSE,
-                updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
+    def _run(self):
+        """Цикл обновления снимка."""
+        while DB_ANALYTICS_SNAPSHOT_SECONDS > 0:
+            if self._pid != os.getpid():
+                return
+            try:
+                refresh_analytics_snapshot()
+            except Exception as e:
+                logger.error(f"Ошибка обновления снимка БД для аналитики: {e}")
+            threading.Event().wait(DB_ANALYTICS_SNAPSHOT_SECONDS)
 
-        # Вставить настройки реферальной программы по умолчанию
-        cursor.execute('''
-            INSERT OR IGNORE INTO referral_settings
-            (id, enabled, reward_type, reward_amount, min_order_amount, reward_on_first_order_only, auto_approve)
-            VALUES (1, 1, 'fixed', 500, 1000, 1, 0)
-        ''')
 
-        # Таблица отзывов
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS reviews (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                user_name TEXT NOT NULL,
-                rating INTEGER NOT NULL,
-                text TEXT,
-                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users(user_id)
-            )
-        ''')
+_snapshot_refresher = _SnapshotRefresher()
 
-        # Таблица логов согласия на обработку данных
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS consent_logs (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                user_name TEXT NOT NULL,
-                phone TEXT NOT NULL,
-                consent_type TEXT NOT NULL,
-                ip_address TEXT,
-                user_agent TEXT,
-                consent_date DATETIME DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users(user_id)
-            )
-        ''')
 
-        # Таблица настроек бонусной программы
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS bonus_settings (
-                id INTEGER PRIMARY KEY CHECK (id = 1),
-                bonus_percent INTEGER DEFAULT 5,
-                bonus_threshold INTEGER DEFAULT 3000,
-                max_bonus_payment_percent INTEGER DEFAULT 50,
-                referral_bonus INTEGER DEFAULT 500,
-                bonus_expiry_days INTEGER DEFAULT 0,
-                updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
+def _current_snapshot(db_path: str) -> Tuple[str, Optional[int]]:
+    """
+    Последний готовый снимок и его версия (mtime).
 
-        # Вставить настройки по умолчанию если их нет
-        cursor.execute('''
-            INSERT OR IGNORE INTO bonus_settings (id, bonus_percent, bonus_threshold, max_bonus_payment_percent, referral_bonus, bonus_expiry_days)
-            VALUES (1, 5, 3000, 50, 500, 0)
-        ''')
+    Пока первый снимок не снят, аналитика читает рабочую БД (mode=ro).
+    """
+    path = snapshot_path(db_path)
+    try:
+        return path, os.stat(path).st_mtime_ns
+    except OSError:
+        return db_path, None
+
+
+def _get_analytics_pool() -> _ConnectionPool:
+    """Получить пул соединений только для чтения (рабочая БД или снимок)."""
+    global _analytics_pool
+    db_path, version = DB_PATH, None
+    if DB_ANALYTICS_SNAPSHOT_SECONDS > 0:
+        _snapshot_refresher.ensure_running()
+        db_path, version = _current_snapshot(DB_PATH)
+
+    pool = _analytics_pool
+    if (pool is None or pool.pid != os.getpid() or pool.db_path != db_path
+            or pool.version != version):
+        with _pool_lock:
+            pool = _analytics_pool
+            if (pool is None or pool.pid != os.getpid() or pool.db_path != db_path
+                    or pool.version != version):
+                if pool is not None and pool.pid == os.getpid():
+                    pool.close_all()
+                pool = _ConnectionPool(db_path, DB_POOL_SIZE, readonly=True, version=version)
+                _analytics_pool = pool
+    return pool
+
+
+def _pool_for(mode: str) -> _ConnectionPool:
+    """Пул для режима соединения."""
+    if mode == TRANSACTIONAL:
+        return _get_pool()
+    if mode == ANALYTICS:
+        return _get_analytics_pool()
+    raise ValueError(f"Неизвестный режим соединения: {mode}")
+
+
+def get_connection(mode: str = TRANSACTIONAL):
+    """
+    Получить соединение с базой данных из пула.
+
+    Соединение уже настроено (WAL, busy_timeout, synchronous=NORMAL,
+    cache_size, mmap_size). Вызов close() возвращает его в пул.
+
+    Отчёты и списки админки явно берут ANALYTICS: соединение только
+    для чтения (mode=ro, query_only), которое не конкурирует за
+    блокировку с оформлением заказов и записей. При
+    DB_ANALYTICS_SNAPSHOT_SECONDS > 0 оно читает последний готовый
+    снимок, который обновляет фоновый поток (см. refresh_analytics_snapshot).
 
-        # Таблица запросов отзывов
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS feedback_requests (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                order_type TEXT NOT NULL,
-                order_id INTEGER NOT NULL,
-                scheduled_date DATE NOT NULL,
-                sent_at DATETIME,
-                status TEXT DEFAULT 'pending',
-                FOREIGN KEY (user_id) REFERENCES users(user_id)
-            )
-        ''')
+    Args:
+        mode: TRANSACTIONAL (по умолчанию) или ANALYTICS
 
-        # Таблица настроек рекомендательной системы
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS feedback_settings (
-                id INTEGER PRIMARY KEY CHECK (id = 1),
-                enabled BOOLEAN DEFAULT TRUE,
-                delay_days INTEGER DEFAULT 1,
-                message_template TEXT DEFAULT 'Здравствуйте! Как вам наши услуги/товары? Будем рады вашему отзыву! 💐',
-                updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
+    Returns:
+        sqlite3.Connection: Объект соединения с БД
+    """
+    return _pool_for(mode).acquire()
 
-        # Вставить настройки по умолчанию если их нет
-        cursor.execute('''
-            INSERT OR IGNORE INTO feedback_settings (id, enabled, delay_days, message_template)
-            VALUES (1, 1, 1, 'Здравствуйте! Как вам наши услуги/товары? Будем рады вашему отзыву! 💐')
-        ''')
 
-        # Таблица тарифных планов подписок
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS subscription_plans (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name TEXT NOT NULL,
-                description TEXT,
-                type TEXT NOT NULL,
-                price INTEGER NOT NULL,
-                duration_months INTEGER NOT NULL,
-                benefits TEXT,
-                monthly_flowers_included INTEGER DEFAULT 0,
-                monthly_service_included BOOLEAN DEFAULT FALSE,
-                service_discount_percent INTEGER DEFAULT 0,
-                flower_discount_percent INTEGER DEFAULT 0,
-                active BOOLEAN DEFAULT TRUE,
-                created_at DATETIME DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
+def get_pool_stats(mode: str = TRANSACTIONAL) -> dict:
+    """
+    Получить статистику пула соединений.
 
-        # Таблица активных подписок пользователей
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS user_subscriptions (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                plan_id INTEGER NOT NULL,
-                start_date DATE NOT NULL,
-                end_date DATE NOT NULL,
-                status TEXT DEFAULT 'active',
-                flowers_used_this_month INTEGER DEFAULT 0,
-                service_used_this_month BOOLEAN DEFAULT FALSE,
-                last_benefit_reset DATE,
-                payment_amount INTEGER NOT NULL,
-                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users(user_id),
-                FOREIGN KEY (plan_id) REFERENCES subscription_plans(id)
-            )
-        ''')
+    Args:
+        mode: TRANSACTIONAL или ANALYTICS
 
-        # Таблица истории использования подписок
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS subscription_usage (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                subscription_id INTEGER NOT NULL,
-                user_id INTEGER NOT NULL,
-                usage_type TEXT NOT NULL,
-                order_id INTEGER,
-                used_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (subscription_id) REFERENCES user_subscriptions(id),
-                FOREIGN KEY (user_id) REFERENCES users(user_id)
-            )
-        ''')
+    Returns:
+        dict: created, reused, released, discarded, in_use, peak_in_use, idle, max_idle, db_path
+    """
+    return _pool_for(mode).stats()
 
-        # Добавить дефолтные планы подписок
-        cursor.execute('''
-            INSERT OR IGNORE INTO subscription_plans
-            (id, name, description, type, price, duration_months, benefits, monthly_flowers_included, monthly_service_included, service_discount_percent, flower_discount_percent)
-            VALUES
-            (1, 'Красота + Цветы', 'Годовая карта с букетом каждый месяц и скидками на услуги', 'premium', 5000, 12,
-             '✅ 1 букет в месяц (до 1500₽)\n✅ 15% скидка на все услуги салона\n✅ Приоритетная запись',
-             1, 0, 15, 0),
-            (2, 'Карта привилегий', 'Накопительные скидки и бонусы', 'privilege', 2000, 12,
-             '✅ 10% скидка на все услуги\n✅ 20% скидка на цветы\n✅ Двойные бонусы\n✅ Приоритетная поддержка',
-             0, 0, 10, 20),
-            (3, 'Цветочная VIP подписка', 'Премиум подписка с максимальными привилегиями', 'vip', 10000, 1,
-             '✅ 4 букета премиум класса в месяц\n✅ 1 услуга салона включена\n✅ Персональный менеджер\n✅ VIP обслуживание',
-             4, 1, 0, 0),
-            (4, 'Пакет для мужчин', 'Готовое решение: букет + услуга', 'gift_package', 4500, 0,
-             '✅ Премиум букет (до 2000₽)\n✅ Услуга на выбор (маникюр/педикюр)\n✅ Красивая упаковка',
-             1, 1, 0, 0)
-        ''')
 
-        # ====================================================================
-        # ТАБЛИЦЫ МАСТЕРОВ И ГРАФИКОВ
-        # ====================================================================
+def close_pool():
+    """
+    Закрыть все свободные соединения пулов (при остановке процесса).
+    Перед закрытием в БД сбрасываются буфер статистики UTM и очередь записи.
+    """
+    global _pool, _analytics_pool
+    flush_utm_stats()
+    flush_writes()
+    with _pool_lock:
+        for pool in (_pool, _analytics_pool):
+            if pool is not None:
+                pool.close_all()
+        _pool = None
+        _analytics_pool = None
 
-        # Таблица мастеров
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS masters (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name TEXT NOT NULL,
-                phone TEXT,
-                specialization TEXT,
-                photo_url TEXT,
-                description TEXT,
-                color TEXT DEFAULT '#3498db',
-                active BOOLEAN DEFAULT TRUE,
-                created_at DATETIME DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
 
-        # Таблица графиков работы мастеров
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS master_schedules (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                master_id INTEGER NOT NULL,
-                work_date DATE NOT NULL,
-                start_time TIME NOT NULL,
-                end_time TIME NOT NULL,
-                is_day_off BOOLEAN DEFAULT FALSE,
-                note TEXT,
-                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (master_id) REFERENCES masters(id),
-                UNIQUE(master_id, work_date)
-            )
-        ''')
+@contextmanager
+def transaction():
+    """
+    Единица работы: несколько операций в одной транзакции.
 
-        # Миграция: добавить master_id в salon_appointments
-        try:
-            cursor.execute("SELECT master_id FROM salon_appointments LIMIT 1")
-        except:
-            cursor.execute("ALTER TABLE salon_appointments ADD COLUMN master_id INTEGER")
-            cursor.execute("ALTER TABLE salon_appointments ADD COLUMN master_name TEXT")
-            logger.info("Добавлены поля master_id и master_name в salon_appointments")
+    Все запросы внутри блока выполняются на одном соединении и
+    фиксируются одним commit (один fsync). При исключении всё
+    откатывается, соединение возвращается в пул.
 
-        # Добавить примерных мастеров
-        cursor.execute('''
-            INSERT OR IGNORE INTO masters
-            (id, name, phone, specialization, color, active)
-            VALUES
-            (1, 'Анна Иванова', '+79001234567', 'Маникюр, педикюр', '#e74c3c', TRUE),
-            (2, 'Мария Петрова', '+79001234568', 'Стрижки, окрашивание', '#3498db', TRUE),
-            (3, 'Елена Сидорова', '+79001234569', 'Визаж, брови', '#2ecc71', TRUE),
-            (4, 'Ольга Козлова', '+79001234570', 'Универсал', '#f39c12', TRUE)
-        ''')
+    Пример:
+        with transaction() as cursor:
+            cursor.execute(...)
+            cursor.execute(...)
 
+    Yields:
+        sqlite3.Cursor: Курсор соединения с открытой транзакцией
+    """
+    conn = get_connection()
+    try:
+        # IMMEDIATE: блокировка на запись берётся сразу, поэтому
+        # прочитанные внутри транзакции балансы и настройки не устаревают
+        conn.execute("BEGIN IMMEDIATE")
+        yield conn.cursor()
         conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    finally:
         conn.close()
-        logger.info("База данных инициализирована успешно")
+
+
+class _GroupCommitWriter:
+    """
+    Очередь мелких записей с групповой фиксацией.
+
+    Операции (функции вида op(cursor, *args)) ставятся в очередь, отдельный
+    поток собирает всё, что накопилось за GROUP_COMMIT_WINDOW_MS (не больше
+    GROUP_COMMIT_MAX_BATCH), и выполняет одной транзакцией: один BEGIN
+    IMMEDIATE и один commit (fsync) на пачку вместо одного на запись.
+    Каждая операция идёт в своей точке сохранения, поэтому ошибка одной
+    не откатывает остальные. Вызывающий получает Future с результатом op.
+
+    Операция не должна сама ждать записи через очередь - это взаимоблокировка.
+    """
+
+    def __init__(self, window_ms: float, max_batch: int):
+        self.window = window_ms / 1000
+        self.max_batch = max_batch
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self._queue = queue.SimpleQueue()
+        self._thread = None
+        self._stats = self._empty_stats()
+
+    @staticmethod
+    def _empty_stats() -> dict:
+        return {
+            'writes': 0, 'failed': 0, 'batches': 0, 'peak_queue_depth': 0,
+            'last_commit_ms': 0.0, 'max_commit_ms': 0.0, 'total_commit_ms': 0.0,
+        }
+
+    def _check_fork(self):
+        """После fork очередь и поток принадлежат родителю - начать заново."""
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._queue = queue.SimpleQueue()
+            self._thread = None
+            self._stats = self._empty_stats()
+
+    def submit(self, op, *args) -> Future:
+        """Поставить операцию в очередь (без обращения к БД)."""
+        future = Future()
+        inline = False
+        with self._lock:
+            self._check_fork()
+            self._queue.put((future, op, args))
+            depth = self._queue.qsize()
+            if depth > self._stats['peak_queue_depth']:
+                self._stats['peak_queue_depth'] = depth
+
+            if self._thread is None or not self._thread.is_alive():
+                thread = threading.Thread(target=self._run, name="db-group-commit", daemon=True)
+                try:
+                    thread.start()
+                    self._thread = thread
+                except RuntimeError:
+                    # Интерпретатор завершается (atexit) - записать без потока
+                    inline = True
+
+        if inline:
+            batch = []
+            while True:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            batch = [item for item in batch if item[0].set_running_or_notify_cancel()]
+            if batch:
+                self._commit(batch)
+        return future
+
+    def _next_batch(self, write_queue) -> list:
+        """Дождаться первой операции и добрать пачку в пределах окна."""
+        batch = [write_queue.get()]
+        deadline = time.monotonic() + self.window
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.monotonic()
+            try:
+                batch.append(write_queue.get(timeout=timeout) if timeout > 0 else write_queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        """Фоновый цикл записи."""
+        write_queue = self._queue
+        while True:
+            batch = self._next_batch(write_queue)
+            if self._pid != os.getpid():
+                return
+            batch = [item for item in batch if item[0].set_running_or_notify_cancel()]
+            if batch:
+                self._commit(batch)
+
+    def _commit(self, batch: list):
+        """Выполнить пачку одной транзакцией и разрешить Future."""
+        started = time.perf_counter()
+        results = []
+        try:
+            with transaction() as cursor:
+                for _, op, args in batch:
+                    cursor.execute("SAVEPOINT group_commit_op")
+                    try:
+                        results.append((op(cursor, *args), None))
+                    except Exception as e:
+                        cursor.execute("ROLLBACK TO group_commit_op")
+                        results.append((None, e))
+                    cursor.execute("RELEASE group_commit_op")
+
+        except Exception as e:
+            logger.error(f"Ошибка групповой записи ({len(batch)} операций): {e}")
+            results = [(None, e)] * len(batch)
+
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        failed = 0
+        for (future, _, _), (result, error) in zip(batch, results):
+            if error is None:
+                future.set_result(result)
+            else:
+                failed += 1
+                future.set_exception(error)
+
+        with self._lock:
+            stats = self._stats
+            stats['writes'] += len(batch)
+            stats['failed'] += failed
+            stats['batches'] += 1
+            stats['last_commit_ms'] = elapsed_ms
+            stats['max_commit_ms'] = max(stats['max_commit_ms'], elapsed_ms)
+            stats['total_commit_ms'] += elapsed_ms
+
+    def flush(self):
+        """Дождаться записи всего, что уже стоит в очереди."""
+        if self._pid == os.getpid() and self._thread is not None:
+            self.submit(lambda cursor: None).result()
+
+    def stats(self) -> dict:
+        """Глубина очереди, число пачек и время фиксации."""
+        with self._lock:
+            self._check_fork()
+            stats = dict(self._stats)
+            stats['queue_depth'] = self._queue.qsize()
+        batches = stats['batches']
+        stats['avg_batch'] = round(stats['writes'] / batches, 2) if batches else 0.0
+        stats['avg_commit_ms'] = round(stats.pop('total_commit_ms') / batches, 2) if batches else 0.0
+        stats['last_commit_ms'] = round(stats['last_commit_ms'], 2)
+        stats['max_commit_ms'] = round(stats['max_commit_ms'], 2)
+        return stats
+
+
+_group_writer = _GroupCommitWriter(GROUP_COMMIT_WINDOW_MS, GROUP_COMMIT_MAX_BATCH)
+
+
+def submit_write(op, *args) -> Future:
+    """
+    Поставить мелкую запись в очередь групповой фиксации.
+
+    Args:
+        op: Функция op(cursor, *args), работающая в текущей транзакции (без commit)
+        *args: Аргументы op
+
+    Returns:
+        Future: Результат op после commit пачки (или её исключение)
+    """
+    return _group_writer.submit(op, *args)
+
+
+def flush_writes():
+    """Дождаться фиксации всех поставленных в очередь записей."""
+    try:
+        _group_writer.flush()
+
+    except Exception as e:
+        logger.error(f"Ошибка сброса очереди записи: {e}")
+
+
+def get_write_queue_stats() -> dict:
+    """
+    Получить статистику очереди групповой записи.
+
+    Returns:
+        dict: queue_depth, peak_queue_depth, writes, failed, batches, avg_batch,
+              last_commit_ms, avg_commit_ms, max_commit_ms
+    """
+    return _group_writer.stats()
+
+
+atexit.register(flush_writes)
+
+
+def init_db():
+    """
+    Инициализация базы данных.
+    Применение недостающих миграций схемы (см. migrations.py).
+    Если схема актуальна, выполняется только чтение PRAGMA user_version.
+    """
+    try:
+        from migrations import apply_migrations
+        applied = apply_migrations()
+        if applied:
+            logger.info(f"База данных инициализирована, применено миграций: {len(applied)}")
 
     except Exception as e:
         logger.error(f"Ошибка инициализации базы данных: {e}")
@@ -559,6 +706,112 @@ def init_db():
 # РАБОТА С ПОЛЬЗОВАТЕЛЯМИ
 # =================================================================
 
+def _new_referral_code(cursor) -> str:
+    """Новый реферальный код формата REF + REFERRAL_CODE_LENGTH символов."""
+    return 'REF' + reserve_codes(cursor, 'referral', 1, REFERRAL_CODE_LENGTH)[0]
+
+
+def _insert_user(cursor, user_id: int, username: Optional[str], first_name: Optional[str],
+                 referred_by: Optional[int] = None, utm_params: Optional[dict] = None,
+                 attempts: int = 10) -> str:
+    """
+    Вставить пользователя в текущей транзакции (без commit).
+
+    Реферальный код берётся из последовательности (codes.py) и уникален
+    без проверки. Совпасть он может только со старым случайным кодом:
+    тогда UNIQUE-индекс отклоняет INSERT и берётся следующий код.
+
+    Returns:
+        str: Присвоенный реферальный код
+    """
+    utm_params = utm_params or {}
+
+    for _ in range(attempts):
+        referral_code = _new_referral_code(cursor)
+        try:
+            cursor.execute('''
+                INSERT INTO users
+                (user_id, username, first_name, referral_code, referred_by,
+                 utm_source, utm_medium, utm_campaign, utm_content, utm_term, source_type)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (
+                user_id, username, first_name, referral_code, referred_by,
+                utm_params.get('utm_source'),
+                utm_params.get('utm_medium'),
+                utm_params.get('utm_campaign'),
+                utm_params.get('utm_content'),
+                utm_params.get('utm_term'),
+                utm_params.get('source_type', 'organic')
+            ))
+            return referral_code
+
+        except sqlite3.IntegrityError as e:
+            if 'referral_code' not in str(e):
+                raise
+
+    raise sqlite3.IntegrityError("Не удалось подобрать уникальный реферальный код")
+
+
+def register_user(user_id: int, username: Optional[str], first_name: Optional[str],
+                  start_param: Optional[str] = None, referral_bonus: int = 0) -> dict:
+    """
+    Обработать /start одной транзакцией.
+
+    Клик по UTM-ссылке, поиск реферера, создание пользователя вместе
+    с UTM-метками, статистика регистраций и реферальные бонусы обеим
+    сторонам фиксируются одним commit. Для уже зарегистрированного
+    пользователя учитывается только клик.
+
+    Args:
+        user_id: Telegram ID пользователя
+        username: Username пользователя
+        first_name: Имя пользователя
+        start_param: Параметр deep link (REF... или utm_...)
+        referral_bonus: Сколько баллов начислить рефереру и новому пользователю
+
+    Returns:
+        dict: is_new (bool), referred_by (ID или None), utm (UTM-параметры), error (None или 'db_error')
+    """
+    utm_params = _parse_start_param(start_param)
+    result = {'is_new': False, 'referred_by': None, 'utm': utm_params, 'error': None}
+
+    try:
+        if utm_params['source_type'] == 'utm':
+            _utm_stats.add(start_param, 'click')
+
+        with transaction() as cursor:
+            cursor.execute('SELECT 1 FROM users WHERE user_id = ?', (user_id,))
+            if cursor.fetchone():
+                return result
+
+            referred_by = None
+            if utm_params['source_type'] == 'referral':
+                cursor.execute('SELECT user_id FROM users WHERE referral_code = ?', (start_param,))
+                row = cursor.fetchone()
+                referred_by = row[0] if row else None
+
+            _insert_user(cursor, user_id, username, first_name, referred_by, utm_params)
+
+            if referred_by and referral_bonus > 0:
+                _credit_bonus(
+                    cursor, referred_by, referral_bonus,
+                    f"Реферальная программа: пригласил пользователя {first_name}"
+                )
+                _credit_bonus(cursor, user_id, referral_bonus, "Регистрация по реферальной ссылке")
+
+        if utm_params['source_type'] == 'utm':
+            _utm_stats.add(start_param, 'registration')
+
+        result.update(is_new=True, referred_by=referred_by)
+        logger.info(f"Пользователь {user_id} ({first_name}) зарегистрирован, источник: {utm_params['source_type']}")
+
+    except Exception as e:
+        logger.error(f"Ошибка регистрации пользователя {user_id}: {e}")
+        result['error'] = 'db_error'
+
+    return result
+
+
 def generate_referral_code(user_id: int) -> str:
     """
     Генерация уникального реферального кода.
@@ -567,20 +820,10 @@ def generate_referral_code(user_id: int) -> str:
         user_id: ID пользователя
 
     Returns:
-        str: Реферальный код формата REF + 6 случайных символов
+        str: Реферальный код формата REF + REFERRAL_CODE_LENGTH символов
     """
-    while True:
-        code = 'REF' + ''.join(random.choices(string.ascii_uppercase + string.digits, k=6))
-
-        # Проверить уникальность
-        conn = get_connection()
-        cursor = conn.cursor()
-        cursor.execute('SELECT user_id FROM users WHERE referral_code = ?', (code,))
-        exists = cursor.fetchone()
-        conn.close()
-
-        if not exists:
-            return code
+    with transaction() as cursor:
+        return _new_referral_code(cursor)
 
 
 def add_user(user_id: int, username: Optional[str], first_name: Optional[str],
@@ -598,26 +841,13 @@ def add_user(user_id: int, username: Optional[str], first_name: Optional[str],
         bool: True если пользователь добавлен, False если уже существует
     """
     try:
-        conn = get_connection()
-        cursor = conn.cursor()
-
-        # Проверить существование пользователя
-        cursor.execute('SELECT user_id FROM users WHERE user_id = ?', (user_id,))
-        if cursor.fetchone():
-            conn.close()
-            return False
-
-        # Генерировать реферальный код
-        referral_code = generate_referral_code(user_id)
-
-        # Добавить пользователя
-        cursor.execute('''
-            INSERT INTO users (user_id, username, first_name, referral_code, referred_by)
-            VALUES (?, ?, ?, ?, ?)
-        ''', (user_id, username, first_name, referral_code, referred_by))
+        with transaction() as cursor:
+            # Проверить существование пользователя
+            cursor.execute('SELECT user_id FROM users WHERE user_id = ?', (user_id,))
+            if cursor.fetchone():
+                return False
 
-        conn.commit()
-        conn.close()
+            _insert_user(cursor, user_id, username, first_name, referred_by)
 
         logger.info(f"Пользователь {user_id} ({first_name}) добавлен в БД")
         return True
@@ -816,66 +1046,175 @@ def is_profile_filled(user_id: int) -> bool:
         return False
 
 
-def get_user_by_referral_code(code: str) -> Optional[int]:
+def get_profile_snapshot(user_id: int) -> Optional[ProfileSnapshot]:
     """
-    Получить ID пользователя по реферальному коду.
+    Получить данные для экрана профиля одним запросом.
+
+    Пользователь, баланс, число приглашённых и активная подписка
+    (последняя по дате окончания, как в get_user_active_subscription).
 
     Args:
-        code: Реферальный код
+        user_id: ID пользователя
 
     Returns:
-        int: ID пользователя или None
+        ProfileSnapshot: Запись с именованными полями или None, если пользователя нет
     """
     try:
         conn = get_connection()
         cursor = conn.cursor()
 
-        cursor.execute('SELECT user_id FROM users WHERE referral_code = ?', (code,))
-        result = cursor.fetchone()
+        cursor.execute('''
+            SELECT u.user_id, u.username, u.first_name, u.phone, u.birthday,
+                   COALESCE(u.profile_filled, 0) AS profile_filled,
+                   u.referral_code, u.bonus_points, u.bonus_held,
+                   (SELECT COUNT(*) FROM users r WHERE r.referred_by = u.user_id) AS referrals_count,
+                   sp.name AS plan_name, us.end_date AS plan_end_date,
+                   sp.monthly_flowers_included, us.flowers_used_this_month,
+                   sp.monthly_service_included, us.service_used_this_month
+            FROM users u
+            LEFT JOIN user_subscriptions us ON us.id = (
+                SELECT id FROM user_subscriptions
+                WHERE user_id = u.user_id AND status = 'active' AND end_date >= date('now')
+                ORDER BY end_date DESC
+                LIMIT 1
+            )
+            LEFT JOIN subscription_plans sp ON sp.id = us.plan_id
+            WHERE u.user_id = ?
+        ''', (user_id,))
 
+        snapshot = fetch_record(cursor, ProfileSnapshot)
         conn.close()
-
-        if result:
-            return result[0]
-        return None
+        return snapshot
 
     except Exception as e:
-        logger.error(f"Ошибка поиска пользователя по коду: {e}")
+        logger.error(f"Ошибка получения профиля: {e}")
+        return None
+
+
+def get_user_by_referral_code(code: str) -> Optional[int]:
+    """
+    Получить ID пользователя по реферальному коду.
+
+    Args:
+        code: Реферальный код
+
+    Returns:
+        int: ID пользователя или None
+    """
+    try:
+        conn = get_connection()
+        cursor = conn.cursor()
+
+        cursor.execute('SELECT user_id FROM users WHERE referral_code = ?', (code,))
+        result = cursor.fetchone()
+
+        conn.close()
+
+        if result:
+            return result[0]
+        return None
+
+    except Exception as e:
+        logger.error(f"Ошибка поиска пользователя по коду: {e}")
         return None
 
 
 # =================================================================
-# РАБОТА С БОНУСАМИ
-# =================================================================
+# РАБОТА С БОНУСАМИ
+# =================================================================
+
+class _InsufficientBonus(Exception):
+    """Баллов на балансе меньше, чем клиент хочет списать."""
+
+
+def _credit_bonus(cursor, user_id: int, points: int, description: str):
+    """
+    Начислить баллы в текущей транзакции (без commit).
+    Начисление попадает в реестр со сроком из bonus_settings.
+    """
+    cursor.execute('''
+        UPDATE users
+        SET bonus_points = bonus_points + ?
+        WHERE user_id = ?
+    ''', (points, user_id))
+
+    cursor.execute('''
+        INSERT INTO loyalty_transactions (user_id, points, description)
+        VALUES (?, ?, ?)
+    ''', (user_id, points, description))
+
+    cursor.execute('''
+        INSERT INTO bonus_credits (user_id, transaction_id, points, remaining, expires_at)
+        VALUES (?, ?, ?, ?, (
+            SELECT CASE WHEN bonus_expiry_days > 0
+                        THEN datetime('now', '+' || bonus_expiry_days || ' days') END
+            FROM bonus_settings WHERE id = 1
+        ))
+    ''', (user_id, cursor.lastrowid, points, points))
+
+
+def _consume_bonus_credits(cursor, user_id: int, points: int):
+    """
+    Списать баллы из реестра по FIFO: сначала самые старые начисления.
+    Читаются только открытые начисления, которых хватает на сумму.
+    """
+    cursor.execute('''
+        SELECT id, remaining FROM bonus_credits
+        WHERE user_id = ? AND remaining > 0
+        ORDER BY created_at, id
+    ''', (user_id,))
+
+    updates = []
+    for credit_id, remaining in cursor:
+        if points <= 0:
+            break
+        taken = min(remaining, points)
+        points -= taken
+        updates.append((taken, credit_id))
+
+    cursor.executemany('UPDATE bonus_credits SET remaining = remaining - ? WHERE id = ?', updates)
+
+
+def _debit_bonus(cursor, user_id: int, points: int, description: str) -> bool:
+    """
+    Списать баллы в текущей транзакции (без commit).
+    Проверка баланса (без учёта зарезервированных) и списание - один UPDATE.
+
+    Returns:
+        bool: False если баллов недостаточно
+    """
+    cursor.execute('''
+        UPDATE users
+        SET bonus_points = bonus_points - ?
+        WHERE user_id = ? AND bonus_points - bonus_held >= ?
+    ''', (points, user_id, points))
+
+    if cursor.rowcount == 0:
+        return False
+
+    cursor.execute('''
+        INSERT INTO loyalty_transactions (user_id, points, description)
+        VALUES (?, ?, ?)
+    ''', (user_id, -points, description))
+
+    _consume_bonus_credits(cursor, user_id, points)
+    return True
+
 
 def add_bonus_points(user_id: int, points: int, description: str):
     """
     Начислить бонусные баллы пользователю.
 
+    Начисление идёт через очередь групповой записи; функция возвращается
+    после commit, баланс сразу можно читать.
+
     Args:
         user_id: ID пользователя
         points: Количество баллов
         description: Описание транзакции
     """
     try:
-        conn = get_connection()
-        cursor = conn.cursor()
-
-        # Обновить баланс
-        cursor.execute('''
-            UPDATE users
-            SET bonus_points = bonus_points + ?
-            WHERE user_id = ?
-        ''', (points, user_id))
-
-        # Записать транзакцию
-        cursor.execute('''
-            INSERT INTO loyalty_transactions (user_id, points, description)
-            VALUES (?, ?, ?)
-        ''', (user_id, points, description))
-
-        conn.commit()
-        conn.close()
+        submit_write(_credit_bonus, user_id, points, description).result()
 
         logger.info(f"Пользователю {user_id} начислено {points} бонусов: {description}")
 
@@ -896,32 +1235,9 @@ def subtract_bonus_points(user_id: int, points: int, description: str) -> bool:
         bool: True если списание успешно, False если недостаточно баллов
     """
     try:
-        conn = get_connection()
-        cursor = conn.cursor()
-
-        # Проверить баланс
-        cursor.execute('SELECT bonus_points FROM users WHERE user_id = ?', (user_id,))
-        result = cursor.fetchone()
-
-        if not result or result[0] < points:
-            conn.close()
-            return False
-
-        # Списать баллы
-        cursor.execute('''
-            UPDATE users
-            SET bonus_points = bonus_points - ?
-            WHERE user_id = ?
-        ''', (points, user_id))
-
-        # Записать транзакцию
-        cursor.execute('''
-            INSERT INTO loyalty_transactions (user_id, points, description)
-            VALUES (?, ?, ?)
-        ''', (user_id, -points, description))
-
-        conn.commit()
-        conn.close()
+        with transaction() as cursor:
+            if not _debit_bonus(cursor, user_id, points, description):
+                return False
 
         logger.info(f"У пользователя {user_id} списано {points} бонусов: {description}")
         return True
@@ -959,6 +1275,205 @@ def get_bonus_balance(user_id: int) -> int:
         return 0
 
 
+def get_available_bonus(user_id: int) -> int:
+    """
+    Получить баланс, доступный для оплаты (за вычетом активных резервов).
+
+    Args:
+        user_id: ID пользователя
+
+    Returns:
+        int: Количество бонусов, которые можно зарезервировать
+    """
+    try:
+        conn = get_connection()
+        cursor = conn.cursor()
+
+        cursor.execute('SELECT bonus_points - bonus_held FROM users WHERE user_id = ?', (user_id,))
+        result = cursor.fetchone()
+
+        conn.close()
+        return max(0, result[0]) if result else 0
+
+    except Exception as e:
+        logger.error(f"Ошибка получения доступного баланса бонусов: {e}")
+        return 0
+
+
+def _release_holds(cursor, where: str, params: tuple, status: str) -> int:
+    """
+    Снять активные резервы по условию в текущей транзакции (без commit).
+
+    Returns:
+        int: Количество снятых резервов
+    """
+    cursor.execute(f'''
+        SELECT id, user_id, points FROM bonus_holds
+        WHERE status = 'active' AND {where}
+    ''', params)
+    holds = cursor.fetchall()
+
+    if holds:
+        cursor.executemany(
+            'UPDATE bonus_holds SET status = ? WHERE id = ?',
+            [(status, hold_id) for hold_id, _, _ in holds]
+        )
+        cursor.executemany(
+            'UPDATE users SET bonus_held = MAX(0, bonus_held - ?) WHERE user_id = ?',
+            [(points, user_id) for _, user_id, points in holds]
+        )
+    return len(holds)
+
+
+def hold_bonus_points(user_id: int, points: int, ttl_minutes: int = BONUS_HOLD_TTL_MINUTES) -> Optional[int]:
+    """
+    Зарезервировать бонусы под оформляемый заказ.
+
+    Проверка доступного остатка и резервирование - один условный UPDATE,
+    поэтому параллельные сессии не могут зарезервировать больше баланса.
+    Просроченные резервы пользователя перед этим освобождаются.
+
+    Args:
+        user_id: ID пользователя
+        points: Сколько баллов зарезервировать
+        ttl_minutes: Через сколько минут резерв снимается сам
+
+    Returns:
+        Optional[int]: ID резерва или None, если баллов недостаточно
+    """
+    try:
+        with transaction() as cursor:
+            _release_holds(
+                cursor, "user_id = ? AND expires_at <= datetime('now')", (user_id,), 'expired'
+            )
+
+            cursor.execute('''
+                UPDATE users
+                SET bonus_held = bonus_held + ?
+                WHERE user_id = ? AND bonus_points - bonus_held >= ?
+            ''', (points, user_id, points))
+
+            if cursor.rowcount == 0:
+                return None
+
+            cursor.execute('''
+                INSERT INTO bonus_holds (user_id, points, expires_at)
+                VALUES (?, ?, datetime('now', ?))
+            ''', (user_id, points, f"{int(ttl_minutes):+d} minutes"))
+            hold_id = cursor.lastrowid
+
+        logger.info(f"Зарезервировано {points} бонусов пользователя {user_id} (резерв #{hold_id})")
+        return hold_id
+
+    except Exception as e:
+        logger.error(f"Ошибка резервирования бонусов: {e}")
+        return None
+
+
+def release_bonus_hold(hold_id: int, user_id: int) -> bool:
+    """
+    Отменить резерв (клиент передумал платить бонусами).
+
+    Args:
+        hold_id: ID резерва
+        user_id: ID пользователя (владелец резерва)
+
+    Returns:
+        bool: True если резерв был активен и снят
+    """
+    try:
+        with transaction() as cursor:
+            released = _release_holds(cursor, "id = ? AND user_id = ?", (hold_id, user_id), 'released')
+        return released > 0
+
+    except Exception as e:
+        logger.error(f"Ошибка отмены резерва бонусов: {e}")
+        return False
+
+
+def _confirm_hold(cursor, hold_id: int, user_id: int, order_id: int, description: str) -> int:
+    """
+    Списать зарезервированные баллы в текущей транзакции (без commit).
+
+    Резерв, у которого истёк срок, но который ещё не снят, тоже
+    подтверждается: баллы всё это время оставались недоступны.
+
+    Returns:
+        int: Списанные баллы или 0, если резерв не активен
+    """
+    cursor.execute('''
+        SELECT points FROM bonus_holds
+        WHERE id = ? AND user_id = ? AND status = 'active'
+    ''', (hold_id, user_id))
+    row = cursor.fetchone()
+    if not row:
+        return 0
+
+    points = row[0]
+    cursor.execute('''
+        UPDATE bonus_holds SET status = 'confirmed', order_id = ? WHERE id = ?
+    ''', (order_id, hold_id))
+    cursor.execute('''
+        UPDATE users SET bonus_held = MAX(0, bonus_held - ?) WHERE user_id = ?
+    ''', (points, user_id))
+
+    if not _debit_bonus(cursor, user_id, points, description):
+        return 0
+    return points
+
+
+def confirm_bonus_hold(hold_id: int, user_id: int, order_id: int, description: str) -> bool:
+    """
+    Списать зарезервированные бонусы (заказ оформлен).
+
+    Args:
+        hold_id: ID резерва
+        user_id: ID пользователя
+        order_id: ID заказа, в оплату которого идут бонусы
+        description: Описание транзакции
+
+    Returns:
+        bool: True если списание выполнено
+    """
+    try:
+        with transaction() as cursor:
+            points = _confirm_hold(cursor, hold_id, user_id, order_id, description)
+            if not points:
+                # Откатить частичные изменения резерва
+                raise _InsufficientBonus()
+
+        logger.info(f"У пользователя {user_id} списано {points} зарезервированных бонусов: {description}")
+        return True
+
+    except _InsufficientBonus:
+        logger.warning(f"Резерв бонусов #{hold_id} пользователя {user_id} не активен")
+        return False
+
+    except Exception as e:
+        logger.error(f"Ошибка подтверждения резерва бонусов: {e}")
+        return False
+
+
+def release_expired_bonus_holds() -> int:
+    """
+    Снять все просроченные резервы (брошенные оформления заказа).
+
+    Returns:
+        int: Количество снятых резервов
+    """
+    try:
+        with transaction() as cursor:
+            released = _release_holds(cursor, "expires_at <= datetime('now')", (), 'expired')
+
+        if released:
+            logger.info(f"Снято просроченных резервов бонусов: {released}")
+        return released
+
+    except Exception as e:
+        logger.error(f"Ошибка снятия просроченных резервов: {e}")
+        return 0
+
+
 def get_loyalty_transactions(user_id: int, limit: int = 10) -> List[Tuple]:
     """
     Получить историю транзакций лояльности.
@@ -974,9 +1489,10 @@ def get_loyalty_transactions(user_id: int, limit: int = 10) -> List[Tuple]:
         conn = get_connection()
         cursor = conn.cursor()
 
+        _ensure_history(cursor)
         cursor.execute('''
             SELECT points, description, created_at
-            FROM loyalty_transactions
+            FROM loyalty_transactions_history
             WHERE user_id = ?
             ORDER BY created_at DESC
             LIMIT ?
@@ -1121,123 +1637,337 @@ def delete_address(address_id: int):
 
 
 # =================================================================
-# РАБОТА С УСЛУГАМИ
+# КЭШ КАТАЛОГА
 # =================================================================
 
-def add_service(category: str, name: str, price: int, description: str = "", duration_minutes: int = 60) -> int:
+class _ChangeLog:
     """
-    Добавить новую услугу салона.
-
-    Args:
-        category: Категория услуги
-        name: Название услуги
-        price: Цена в рублях
-        description: Описание услуги
-        duration_minutes: Длительность в минутах
+    Версии разделов из таблицы change_log.
 
-    Returns:
-        int: ID добавленной услуги
+    Таблица общая для всех процессов (бот, админка): триггеры увеличивают
+    версию раздела при любой записи в его таблицы. Версии перечитываются
+    не чаще раза в CHANGE_POLL_SECONDS - один запрос к таблице из
+    нескольких строк.
     """
-    try:
+
+    def __init__(self, poll_seconds: float):
+        self.poll_seconds = poll_seconds
+        self._lock = threading.Lock()
+        self._versions = {}
+        self._checked_at = None  # (DB_PATH, time.monotonic())
+
+    def versions(self, force: bool = False) -> dict:
+        """
+        Версии разделов {section: version}.
+
+        Args:
+            force: Перечитать сразу, не дожидаясь интервала опроса
+        """
+        now = time.monotonic()
+        with self._lock:
+            checked = self._checked_at
+            if (not force and checked is not None and checked[0] == DB_PATH
+                    and now - checked[1] < self.poll_seconds):
+                return self._versions
+
         conn = get_connection()
-        cursor = conn.cursor()
+        try:
+            versions = dict(conn.execute('SELECT section, version FROM change_log').fetchall())
+        finally:
+            conn.close()
 
-        cursor.execute('''
-            INSERT INTO services (category, name, price, description, duration_minutes, active)
-            VALUES (?, ?, ?, ?, ?, TRUE)
-        ''', (category, name, price, description, duration_minutes))
+        with self._lock:
+            self._versions = versions
+            self._checked_at = (DB_PATH, now)
+        return versions
 
-        service_id = cursor.lastrowid
-        conn.commit()
-        conn.close()
 
-        logger.info(f"Услуга '{name}' добавлена с ID {service_id}")
-        return service_id
+_change_log = _ChangeLog(CHANGE_POLL_SECONDS)
 
-    except Exception as e:
-        logger.error(f"Ошибка добавления услуги: {e}")
-        return 0
+# Снимок раздела каталога: строки в порядке выдачи, индекс по id
+# и отсортированные категории активных позиций
+_CatalogSnapshot = namedtuple('_CatalogSnapshot', ('rows', 'by_id', 'categories'))
 
+_SERVICE_FIELDS = ('id', 'category', 'name', 'price', 'description', 'duration_minutes', 'active')
+_GALLERY_FIELDS = ('id', 'category', 'description', 'photo_url', 'price', 'created_at')
 
-def get_services(category: Optional[str] = None, active_only: bool = True) -> List[dict]:
-    """
-    Получить список услуг.
 
-    Args:
-        category: Фильтр по категории (если None - все категории)
-        active_only: Только активные услуги
+class _SnapshotCache:
+    """
+    Кэш неизменяемых снимков по разделам (каталог, настройки) в памяти процесса.
 
-    Returns:
-        list: Список словарей с данными услуг
+    Раздел каталога хранится снимком всех строк таблицы, фильтры по
+    категории и активности применяются к снимку. Снимок сбрасывается:
+    - сразу, если запись сделана в этом процессе (invalidate());
+    - при смене версии раздела в change_log (запись из другого процесса).
+    Снимок, загрузка которого началась до инвалидации, не сохраняется.
     """
-    try:
-        conn = get_connection()
-        cursor = conn.cursor()
 
-        query = 'SELECT id, category, name, price, description, duration_minutes, active FROM services WHERE 1=1'
-        params = []
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._loaders = {}
+        self._versions = {}
+        self._snapshots = {}
+        self._stats = {}
 
-        if category:
-            query += ' AND category = ?'
-            params.append(category)
+    def register(self, section: str, loader):
+        """Зарегистрировать раздел (имя совпадает с разделом в change_log)."""
+        self._loaders[section] = loader
+        self._versions[section] = 0
+        self._stats[section] = {'hits': 0, 'misses': 0, 'invalidations': 0}
 
-        if active_only:
-            query += ' AND active = TRUE'
+    def get(self, section: str):
+        """Получить снимок раздела (загрузить при промахе)."""
+        shared_version = _change_log.versions().get(section)
 
-        query += ' ORDER BY category, name'
+        with self._lock:
+            version = self._versions[section]
+            entry = self._snapshots.get(section)
+            if entry is not None and entry[0] == (DB_PATH, version, shared_version):
+                self._stats[section]['hits'] += 1
+                return entry[1]
+            self._stats[section]['misses'] += 1
 
-        cursor.execute(query, params)
-        rows = cursor.fetchall()
-        conn.close()
+        # Версия читается до загрузки: запись между ними даст лишнюю
+        # перезагрузку, но не устаревший снимок
+        shared_version = _change_log.versions(force=True).get(section)
+        snapshot = self._loaders[section]()
 
-        services = []
-        for row in rows:
-            services.append({
-                'id': row[0],
-                'category': row[1],
-                'name': row[2],
-                'price': row[3],
-                'description': row[4],
-                'duration_minutes': row[5],
-                'active': row[6]
-            })
+        with self._lock:
+            if self._versions[section] == version:
+                self._snapshots[section] = ((DB_PATH, version, shared_version), snapshot)
+        return snapshot
 
-        return services
+    def invalidate(self, *sections: str):
+        """Сбросить снимки разделов после записи в этом процессе."""
+        with self._lock:
+            for section in sections:
+                self._versions[section] += 1
+                self._snapshots.pop(section, None)
+                self._stats[section]['invalidations'] += 1
 
-    except Exception as e:
-        logger.error(f"Ошибка получения услуг: {e}")
-        return []
+    def stats(self) -> dict:
+        """Счётчики попаданий, промахов и инвалидаций по разделам."""
+        with self._lock:
+            return {
+                section: dict(counters, version=self._versions[section],
+                              cached=section in self._snapshots)
+                for section, counters in self._stats.items()
+            }
 
 
-def get_service_by_id(service_id: int) -> Optional[dict]:
+def _load_services_snapshot() -> _CatalogSnapshot:
+    """Загрузить все услуги одним запросом."""
+    conn = get_connection()
+    try:
+        rows = tuple(conn.execute('''
+            SELECT id, category, name, price, description, duration_minutes, active
+            FROM services
+            ORDER BY category, name
+        ''').fetchall())
+    finally:
+        conn.close()
+
+    return _CatalogSnapshot(
+        rows,
+        {row[0]: row for row in rows},
+        sorted({row[1] for row in rows if row[6]}),
+    )
+
+
+def _load_products_snapshot() -> _CatalogSnapshot:
+    """Загрузить все товары одним запросом."""
+    conn = get_connection()
+    try:
+        cursor = conn.execute('''
+            SELECT id, category, name, price, photo_url, description, in_stock, active
+            FROM products
+            ORDER BY category, name
+        ''')
+        rows = tuple(fetch_records(cursor, Product))
+    finally:
+        conn.close()
+
+    return _CatalogSnapshot(
+        rows,
+        {row.id: row for row in rows},
+        sorted({row.category for row in rows if row.active}),
+    )
+
+
+def _load_gallery_snapshot() -> _CatalogSnapshot:
+    """Загрузить галерею одним запросом (новые фото первыми)."""
+    conn = get_connection()
+    try:
+        rows = tuple(
+            (row[0], row[1], row[2], row[3], row[4] or 0, row[5] or '')
+            for row in conn.execute('''
+                SELECT id, category, description, photo_url, price, created_at
+                FROM gallery
+                ORDER BY id DESC
+            ''')
+        )
+    finally:
+        conn.close()
+
+    return _CatalogSnapshot(
+        rows,
+        {row[0]: row for row in rows},
+        sorted({row[1] for row in rows}),
+    )
+
+
+_catalog_cache = _SnapshotCache()
+_catalog_cache.register('services', _load_services_snapshot)
+_catalog_cache.register('products', _load_products_snapshot)
+_catalog_cache.register('gallery', _load_gallery_snapshot)
+
+
+def get_catalog_cache_stats() -> dict:
     """
-    Получить услугу по ID.
+    Получить статистику кэша каталога и реестра настроек.
+
+    Returns:
+        dict: По разделам (services, products, gallery, settings): hits, misses,
+              invalidations, version, cached
+    """
+    return dict(_catalog_cache.stats(), **_settings_cache.stats())
+
+
+# =================================================================
+# РЕЕСТР НАСТРОЕК ПРОГРАММ
+# =================================================================
+
+# Снимок всех настроек: записи неизменяемы, их можно отдавать
+# в любые потоки без копирования
+_SettingsSnapshot = namedtuple('_SettingsSnapshot', ('bonus', 'referral', 'feedback'))
+
+_DEFAULT_BONUS_SETTINGS = BonusSettings(5, 3000, 50, 500, 0, None)
+_DEFAULT_REFERRAL_SETTINGS = ReferralSettings(False, 'fixed', 0, 0, 0, 0, True, False, None)
+_DEFAULT_FEEDBACK_SETTINGS = FeedbackSettings(
+    True, 1, 'Здравствуйте! Как вам наши услуги/товары? Будем рады вашему отзыву! 💐', None
+)
+
+
+def _load_settings_snapshot() -> _SettingsSnapshot:
+    """Загрузить настройки бонусной, реферальной программы и запросов отзывов."""
+    conn = get_connection()
+    try:
+        bonus = fetch_record(conn.execute('''
+            SELECT bonus_percent, bonus_threshold, max_bonus_payment_percent, referral_bonus,
+                   bonus_expiry_days, updated_at
+            FROM bonus_settings WHERE id = 1
+        '''), BonusSettings)
+        referral = fetch_record(conn.execute('''
+            SELECT enabled, reward_type, reward_amount, reward_percent, min_order_amount,
+                   max_reward_amount, reward_on_first_order_only, auto_approve, updated_at
+            FROM referral_settings WHERE id = 1
+        '''), ReferralSettings)
+        feedback = fetch_record(conn.execute('''
+            SELECT enabled, delay_days, message_template, updated_at
+            FROM feedback_settings WHERE id = 1
+        '''), FeedbackSettings)
+    finally:
+        conn.close()
+
+    if referral:
+        referral = referral._replace(
+            enabled=bool(referral.enabled),
+            reward_on_first_order_only=bool(referral.reward_on_first_order_only),
+            auto_approve=bool(referral.auto_approve),
+        )
+    if feedback:
+        feedback = feedback._replace(enabled=bool(feedback.enabled))
+
+    return _SettingsSnapshot(
+        bonus or _DEFAULT_BONUS_SETTINGS,
+        referral or _DEFAULT_REFERRAL_SETTINGS,
+        feedback or _DEFAULT_FEEDBACK_SETTINGS,
+    )
+
+
+_settings_cache = _SnapshotCache()
+_settings_cache.register('settings', _load_settings_snapshot)
+
+
+# =================================================================
+# РАБОТА С УСЛУГАМИ
+# =================================================================
+
+def add_service(category: str, name: str, price: int, description: str = "", duration_minutes: int = 60) -> int:
+    """
+    Добавить новую услугу салона.
 
     Args:
-        service_id: ID услуги
+        category: Категория услуги
+        name: Название услуги
+        price: Цена в рублях
+        description: Описание услуги
+        duration_minutes: Длительность в минутах
 
     Returns:
-        dict: Данные услуги или None
+        int: ID добавленной услуги
     """
     try:
         conn = get_connection()
         cursor = conn.cursor()
 
-        cursor.execute('SELECT id, category, name, price, description, duration_minutes, active FROM services WHERE id = ?', (service_id,))
-        row = cursor.fetchone()
+        cursor.execute('''
+            INSERT INTO services (category, name, price, description, duration_minutes, active)
+            VALUES (?, ?, ?, ?, ?, TRUE)
+        ''', (category, name, price, description, duration_minutes))
+
+        service_id = cursor.lastrowid
+        conn.commit()
         conn.close()
+        _catalog_cache.invalidate('services')
 
-        if row:
-            return {
-                'id': row[0],
-                'category': row[1],
-                'name': row[2],
-                'price': row[3],
-                'description': row[4],
-                'duration_minutes': row[5],
-                'active': row[6]
-            }
-        return None
+        logger.info(f"Услуга '{name}' добавлена с ID {service_id}")
+        return service_id
+
+    except Exception as e:
+        logger.error(f"Ошибка добавления услуги: {e}")
+        return 0
+
+
+def get_services(category: Optional[str] = None, active_only: bool = True) -> List[dict]:
+    """
+    Получить список услуг.
+
+    Args:
+        category: Фильтр по категории (если None - все категории)
+        active_only: Только активные услуги
+
+    Returns:
+        list: Список словарей с данными услуг
+    """
+    try:
+        snapshot = _catalog_cache.get('services')
+
+        return [
+            dict(zip(_SERVICE_FIELDS, row))
+            for row in snapshot.rows
+            if (not category or row[1] == category) and (not active_only or row[6])
+        ]
+
+    except Exception as e:
+        logger.error(f"Ошибка получения услуг: {e}")
+        return []
+
+
+def get_service_by_id(service_id: int) -> Optional[dict]:
+    """
+    Получить услугу по ID.
+
+    Args:
+        service_id: ID услуги
+
+    Returns:
+        dict: Данные услуги или None
+    """
+    try:
+        row = _catalog_cache.get('services').by_id.get(service_id)
+        return dict(zip(_SERVICE_FIELDS, row)) if row else None
 
     except Exception as e:
         logger.error(f"Ошибка получения услуги: {e}")
@@ -1273,6 +2003,7 @@ def update_service(service_id: int, **kwargs):
         cursor.execute(query, values)
         conn.commit()
         conn.close()
+        _catalog_cache.invalidate('services')
 
         logger.info(f"Услуга {service_id} обновлена")
 
@@ -1295,6 +2026,7 @@ def delete_service(service_id: int):
 
         conn.commit()
         conn.close()
+        _catalog_cache.invalidate('services')
 
         logger.info(f"Услуга {service_id} деактивирована")
 
@@ -1310,14 +2042,7 @@ def get_service_categories() -> List[str]:
         list: Список категорий
     """
     try:
-        conn = get_connection()
-        cursor = conn.cursor()
-
-        cursor.execute('SELECT DISTINCT category FROM services WHERE active = TRUE ORDER BY category')
-        categories = [row[0] for row in cursor.fetchall()]
-
-        conn.close()
-        return categories
+        return list(_catalog_cache.get('services').categories)
 
     except Exception as e:
         logger.error(f"Ошибка получения категорий услуг: {e}")
@@ -1354,6 +2079,7 @@ def add_product(category: str, name: str, price: int, photo_url: str = "", descr
         product_id = cursor.lastrowid
         conn.commit()
         conn.close()
+        _catalog_cache.invalidate('products')
 
         logger.info(f"Товар '{name}' добавлен с ID {product_id}")
         return product_id
@@ -1376,42 +2102,14 @@ def get_products(category: Optional[str] = None, active_only: bool = True, in_st
         list: Список словарей с данными товаров
     """
     try:
-        conn = get_connection()
-        cursor = conn.cursor()
-
-        query = 'SELECT id, category, name, price, photo_url, description, in_stock, active FROM products WHERE 1=1'
-        params = []
-
-        if category:
-            query += ' AND category = ?'
-            params.append(category)
+        snapshot = _catalog_cache.get('products')
 
-        if active_only:
-            query += ' AND active = TRUE'
-
-        if in_stock_only:
-            query += ' AND in_stock = TRUE'
-
-        query += ' ORDER BY category, name'
-
-        cursor.execute(query, params)
-        rows = cursor.fetchall()
-        conn.close()
-
-        products = []
-        for row in rows:
-            products.append({
-                'id': row[0],
-                'category': row[1],
-                'name': row[2],
-                'price': row[3],
-                'photo_url': row[4],
-                'description': row[5],
-                'in_stock': row[6],
-                'active': row[7]
-            })
-
-        return products
+        return [
+            product for product in snapshot.rows
+            if (not category or product.category == category)
+            and (not active_only or product.active)
+            and (not in_stock_only or product.in_stock)
+        ]
 
     except Exception as e:
         logger.error(f"Ошибка получения товаров: {e}")
@@ -1429,25 +2127,8 @@ def get_product_by_id(product_id: int) -> Optional[dict]:
         dict: Данные товара или None
     """
     try:
-        conn = get_connection()
-        cursor = conn.cursor()
-
-        cursor.execute('SELECT id, category, name, price, photo_url, description, in_stock, active FROM products WHERE id = ?', (product_id,))
-        row = cursor.fetchone()
-        conn.close()
-
-        if row:
-            return {
-                'id': row[0],
-                'category': row[1],
-                'name': row[2],
-                'price': row[3],
-                'photo_url': row[4],
-                'description': row[5],
-                'in_stock': row[6],
-                'active': row[7]
-            }
-        return None
+        product = _catalog_cache.get('products').by_id.get(product_id)
+        return product.as_dict() if product else None
 
     except Exception as e:
         logger.error(f"Ошибка получения товара: {e}")
@@ -1483,6 +2164,7 @@ def update_product(product_id: int, **kwargs):
         cursor.execute(query, values)
         conn.commit()
         conn.close()
+        _catalog_cache.invalidate('products')
 
         logger.info(f"Товар {product_id} обновлен")
 
@@ -1505,6 +2187,7 @@ def delete_product(product_id: int):
 
         conn.commit()
         conn.close()
+        _catalog_cache.invalidate('products')
 
         logger.info(f"Товар {product_id} деактивирован")
 
@@ -1520,14 +2203,7 @@ def get_product_categories() -> List[str]:
         list: Список категорий
     """
     try:
-        conn = get_connection()
-        cursor = conn.cursor()
-
-        cursor.execute('SELECT DISTINCT category FROM products WHERE active = TRUE ORDER BY category')
-        categories = [row[0] for row in cursor.fetchall()]
-
-        conn.close()
-        return categories
+        return list(_catalog_cache.get('products').categories)
 
     except Exception as e:
         logger.error(f"Ошибка получения категорий товаров: {e}")
@@ -1595,9 +2271,15 @@ def get_salon_appointments(user_id: Optional[int] = None, status: Optional[str]
         conn = get_connection()
         cursor = conn.cursor()
 
-        query = '''SELECT id, user_id, user_name, phone, service_id, service_name,
-                   appointment_date, time_slot, status, prepaid, comment, created_at, price, duration_minutes
-                   FROM salon_appointments WHERE 1=1'''
+        # История клиента - вместе с архивом
+        table = 'salon_appointments_history' if user_id else 'salon_appointments'
+        if user_id:
+            _ensure_history(cursor)
+
+        query = f'''SELECT id, user_id, user_name, phone, service_id, service_name,
+                   appointment_date, time_slot, status, prepaid, comment, created_at,
+                   COALESCE(price, 0) AS price, COALESCE(duration_minutes, 60) AS duration_minutes
+                   FROM {table} WHERE 1=1'''
         params = []
 
         if user_id:
@@ -1611,28 +2293,9 @@ def get_salon_appointments(user_id: Optional[int] = None, status: Optional[str]
         query += ' ORDER BY appointment_date DESC, time_slot DESC'
 
         cursor.execute(query, params)
-        rows = cursor.fetchall()
+        appointments = fetch_records(cursor, Appointment)
         conn.close()
 
-        appointments = []
-        for row in rows:
-            appointments.append({
-                'id': row[0],
-                'user_id': row[1],
-                'user_name': row[2],
-                'phone': row[3],
-                'service_id': row[4],
-                'service_name': row[5],
-                'appointment_date': row[6],
-                'time_slot': row[7],
-                'status': row[8],
-                'prepaid': row[9],
-                'comment': row[10],
-                'created_at': row[11],
-                'price': row[12] if len(row) > 12 else 0,
-                'duration_minutes': row[13] if len(row) > 13 else 60
-            })
-
         return appointments
 
     except Exception as e:
@@ -1715,6 +2378,49 @@ def update_salon_appointment_status(appointment_id: int, status: str):
 # РАБОТА С ЗАКАЗАМИ ЦВЕТОВ
 # =================================================================
 
+def _order_item_rows(items: str) -> List[Tuple]:
+    """
+    Разобрать JSON корзины в позиции (product_id, quantity, unit_price).
+
+    Битый JSON и элементы не-словари пропускаются - как в миграции order_items.
+    """
+    try:
+        cart = json.loads(items)
+    except (TypeError, ValueError):
+        return []
+    if not isinstance(cart, list):
+        return []
+
+    return [
+        (item.get('id'), item.get('quantity') or 1, item.get('price') or 0)
+        for item in cart
+        if isinstance(item, dict)
+    ]
+
+
+def _insert_flower_order(cursor, user_id: int, user_name: str, phone: str, items: str,
+                         total_amount: int, delivery_type: str, delivery_address: str = "",
+                         delivery_time: str = "", anonymous: bool = False, card_text: str = "",
+                         recipient_name: str = "", recipient_phone: str = "") -> int:
+    """Вставить заказ цветов и его позиции в текущей транзакции (без commit) и вернуть ID заказа."""
+    cursor.execute('''
+        INSERT INTO flower_orders
+        (user_id, user_name, phone, items, total_amount, delivery_type, delivery_address,
+         delivery_time, anonymous, card_text, recipient_name, recipient_phone, status, paid)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 'new', FALSE)
+    ''', (user_id, user_name, phone, items, total_amount, delivery_type, delivery_address,
+          delivery_time, anonymous, card_text, recipient_name, recipient_phone))
+    order_id = cursor.lastrowid
+
+    # Дата заказа копируется в позиции: продажи товара за период - диапазон по индексу
+    cursor.executemany('''
+        INSERT INTO order_items (order_id, product_id, quantity, unit_price, created_at)
+        SELECT id, ?, ?, ?, created_at FROM flower_orders WHERE id = ?
+    ''', [(*row, order_id) for row in _order_item_rows(items)])
+
+    return order_id
+
+
 def add_flower_order(user_id: int, user_name: str, phone: str, items: str, total_amount: int,
                      delivery_type: str, delivery_address: str = "", delivery_time: str = "",
                      anonymous: bool = False, card_text: str = "",
@@ -1740,20 +2446,12 @@ def add_flower_order(user_id: int, user_name: str, phone: str, items: str, total
         int: ID заказа
     """
     try:
-        conn = get_connection()
-        cursor = conn.cursor()
-
-        cursor.execute('''
-            INSERT INTO flower_orders
-            (user_id, user_name, phone, items, total_amount, delivery_type, delivery_address,
-             delivery_time, anonymous, card_text, recipient_name, recipient_phone, status, paid)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 'new', FALSE)
-        ''', (user_id, user_name, phone, items, total_amount, delivery_type, delivery_address,
-              delivery_time, anonymous, card_text, recipient_name, recipient_phone))
-
-        order_id = cursor.lastrowid
-        conn.commit()
-        conn.close()
+        with transaction() as cursor:
+            order_id = _insert_flower_order(
+                cursor, user_id, user_name, phone, items, total_amount, delivery_type,
+                delivery_address, delivery_time, anonymous, card_text,
+                recipient_name, recipient_phone
+            )
 
         logger.info(f"Заказ цветов #{order_id} создан для пользователя {user_id}")
         return order_id
@@ -1763,6 +2461,111 @@ def add_flower_order(user_id: int, user_name: str, phone: str, items: str, total
         return 0
 
 
+def checkout_flower_order(user_id: int, user_name: str, items: str, total_amount: int,
+                          delivery_type: str, delivery_address: str = "", delivery_time: str = "",
+                          anonymous: bool = False, card_text: str = "",
+                          recipient_name: str = "", recipient_phone: str = "",
+                          bonus_used: int = 0, bonus_earned: int = 0,
+                          bonus_hold_id: Optional[int] = None) -> dict:
+    """
+    Оформить заказ цветов целиком в одной транзакции.
+
+    Создание заказа, запрос отзыва, списание и начисление бонусов,
+    реферальная награда и UTM-конверсия выполняются на одном соединении
+    и фиксируются одним commit. Если что-то не удалось (например,
+    баллов не хватает), не сохраняется ничего.
+
+    Args:
+        user_id: ID пользователя
+        user_name: Имя пользователя
+        items: JSON строка с товарами
+        total_amount: Сумма к оплате (уже за вычетом бонусов)
+        delivery_type: Тип доставки (delivery/pickup)
+        delivery_address: Адрес доставки
+        delivery_time: Время доставки
+        anonymous: Анонимная доставка
+        card_text: Текст открытки
+        recipient_name: Имя получателя
+        recipient_phone: Телефон получателя (если пусто - телефон из профиля)
+        bonus_used: Сколько баллов списать в оплату (если нет резерва)
+        bonus_earned: Сколько баллов начислить за заказ
+        bonus_hold_id: Резерв бонусов (hold_bonus_points), списывается вместо bonus_used
+
+    Returns:
+        dict: order_id (0 при ошибке), customer_phone, bonus_used, bonus_earned,
+              referral (dict или None), error (None, 'insufficient_bonus' или 'db_error')
+    """
+    result = {
+        'order_id': 0,
+        'customer_phone': None,
+        'bonus_used': 0,
+        'bonus_earned': 0,
+        'referral': None,
+        'error': None,
+    }
+
+    try:
+        with transaction() as cursor:
+            cursor.execute('''
+                SELECT phone, referred_by, utm_source, utm_medium, utm_campaign, utm_content, utm_term
+                FROM users WHERE user_id = ?
+            ''', (user_id,))
+            customer = cursor.fetchone()
+            customer_phone = customer[0] if customer else None
+
+            order_id = _insert_flower_order(
+                cursor, user_id, user_name, recipient_phone or customer_phone or '', items,
+                total_amount, delivery_type, delivery_address, delivery_time, anonymous,
+                card_text, recipient_name, recipient_phone
+            )
+
+            _schedule_feedback(cursor, user_id, 'flower_order', order_id)
+
+            if bonus_hold_id:
+                bonus_used = _confirm_hold(
+                    cursor, bonus_hold_id, user_id, order_id, f"Оплата заказа цветов #{order_id}"
+                )
+                if not bonus_used:
+                    raise _InsufficientBonus()
+            elif bonus_used > 0 and not _debit_bonus(
+                cursor, user_id, bonus_used, f"Оплата заказа цветов #{order_id}"
+            ):
+                raise _InsufficientBonus()
+
+            if bonus_earned > 0:
+                _credit_bonus(cursor, user_id, bonus_earned, f"Заказ цветов #{order_id}")
+
+            referral = None
+            if customer and customer[1]:  # referred_by
+                referral = _award_referral_bonus(
+                    cursor, order_id, user_id, total_amount, referrer_id=customer[1]
+                )
+
+        # Конверсия учитывается только после фиксации заказа
+        if customer and customer[2]:  # utm_source
+            utm_code = '__'.join(value or '' for value in customer[2:7])
+            _utm_stats.add(utm_code, 'conversion', total_amount)
+
+        result.update(
+            order_id=order_id,
+            customer_phone=customer_phone,
+            bonus_used=bonus_used,
+            bonus_earned=bonus_earned,
+            referral=referral,
+        )
+        logger.info(f"Заказ цветов #{order_id} оформлен для пользователя {user_id}")
+
+    except _InsufficientBonus:
+        logger.warning(f"Недостаточно бонусов у пользователя {user_id} для списания {bonus_used}")
+        result['error'] = 'insufficient_bonus'
+
+    except Exception as e:
+        logger.error(f"Ошибка оформления заказа цветов: {e}")
+        result['error'] = 'db_error'
+
+    return result
+
+
 def get_flower_orders(user_id: Optional[int] = None, status: Optional[str] = None) -> List[dict]:
     """
     Получить список заказов цветов.
@@ -1778,10 +2581,15 @@ def get_flower_orders(user_id: Optional[int] = None, status: Optional[str] = Non
         conn = get_connection()
         cursor = conn.cursor()
 
-        query = '''SELECT id, user_id, user_name, phone, items, total_amount, delivery_type,
+        # История клиента - вместе с архивом
+        table = 'flower_orders_history' if user_id else 'flower_orders'
+        if user_id:
+            _ensure_history(cursor)
+
+        query = f'''SELECT id, user_id, user_name, phone, items, total_amount, delivery_type,
                    delivery_address, delivery_time, anonymous, card_text, recipient_name,
                    recipient_phone, status, paid, created_at
-                   FROM flower_orders WHERE 1=1'''
+                   FROM {table} WHERE 1=1'''
         params = []
 
         if user_id:
@@ -1795,30 +2603,9 @@ def get_flower_orders(user_id: Optional[int] = None, status: Optional[str] = Non
         query += ' ORDER BY created_at DESC'
 
         cursor.execute(query, params)
-        rows = cursor.fetchall()
+        orders = fetch_records(cursor, FlowerOrder)
         conn.close()
 
-        orders = []
-        for row in rows:
-            orders.append({
-                'id': row[0],
-                'user_id': row[1],
-                'user_name': row[2],
-                'phone': row[3],
-                'items': row[4],
-                'total_amount': row[5],
-                'delivery_type': row[6],
-                'delivery_address': row[7],
-                'delivery_time': row[8],
-                'anonymous': row[9],
-                'card_text': row[10],
-                'recipient_name': row[11],
-                'recipient_phone': row[12],
-                'status': row[13],
-                'paid': row[14],
-                'created_at': row[15]
-            })
-
         return orders
 
     except Exception as e:
@@ -1828,23 +2615,25 @@ def get_flower_orders(user_id: Optional[int] = None, status: Optional[str] = Non
 
 def get_flower_order_by_id(order_id: int) -> Optional[dict]:
     """
-    Получить заказ по ID.
+    Получить заказ по ID (в том числе перенесённый в архив).
 
     Args:
         order_id: ID заказа
 
     Returns:
-        dict: Данные заказа или None
+        dict: Данные заказа (archived=True - заказ в архиве, только чтение) или None
     """
     try:
         conn = get_connection()
         cursor = conn.cursor()
 
+        _ensure_history(cursor)
         cursor.execute('''
             SELECT id, user_id, user_name, phone, items, total_amount, delivery_type,
                    delivery_address, delivery_time, anonymous, card_text, recipient_name,
-                   recipient_phone, status, paid, created_at
-            FROM flower_orders
+                   recipient_phone, status, paid, created_at,
+                   NOT EXISTS (SELECT 1 FROM main.flower_orders WHERE id = h.id) AS archived
+            FROM flower_orders_history h
             WHERE id = ?
         ''', (order_id,))
 
@@ -1868,7 +2657,8 @@ def get_flower_order_by_id(order_id: int) -> Optional[dict]:
                 'recipient_phone': row[12],
                 'status': row[13],
                 'paid': row[14],
-                'created_at': row[15]
+                'created_at': row[15],
+                'archived': bool(row[16])
             }
         return None
 
@@ -1877,15 +2667,22 @@ def get_flower_order_by_id(order_id: int) -> Optional[dict]:
         return None
 
 
-def update_flower_order_status(order_id: int, status: str, paid: Optional[bool] = None, send_notification: bool = False):
+def update_flower_order_status(order_id: int, status: str, paid: Optional[bool] = None,
+                               send_notification: bool = False) -> bool:
     """
     Обновить статус заказа цветов.
 
+    Меняются только заказы рабочей таблицы: заказы в архиве (см.
+    archive_old_records) доступны только для чтения.
+
     Args:
         order_id: ID заказа
         status: Новый статус (new, accepted, delivering, delivered, cancelled)
         paid: Оплачен ли заказ
         send_notification: Отправлять уведомление клиенту
+
+    Returns:
+        bool: True если статус обновлён (False - заказа нет в рабочей таблице или ошибка)
     """
     try:
         conn = get_connection()
@@ -1901,10 +2698,15 @@ def update_flower_order_status(order_id: int, status: str, paid: Optional[bool]
         else:
             cursor.execute('UPDATE flower_orders SET status = ? WHERE id = ?',
                          (status, order_id))
+        updated = cursor.rowcount > 0
 
         conn.commit()
         conn.close()
 
+        if not updated:
+            logger.warning(f"Заказ цветов #{order_id} не найден в рабочей таблице (архив?), статус не изменён")
+            return False
+
         logger.info(f"Заказ цветов #{order_id} обновлен на статус {status}")
 
         # Отправить уведомление клиенту
@@ -1934,65 +2736,89 @@ def update_flower_order_status(order_id: int, status: str, paid: Optional[bool]
                 except Exception as e:
                     logger.error(f"Ошибка отправки уведомления о статусе заказа: {e}")
 
+        return True
+
     except Exception as e:
         logger.error(f"Ошибка обновления статуса заказа: {e}")
+        return False
 
 
 # =================================================================
 # РАБОТА С СЕРТИФИКАТАМИ
 # =================================================================
 
+def _certificate_code(raw: str) -> str:
+    """Оформить код сертификата группами по 4 символа: CERT-XXXX-XXXX."""
+    return 'CERT-' + '-'.join(raw[i:i + 4] for i in range(0, len(raw), 4))
+
+
 def generate_certificate_code() -> str:
     """
     Генерация уникального кода сертификата.
 
     Returns:
-        str: Код формата CERT-XXXX
+        str: Код формата CERT-XXXX-XXXX (длина - CERTIFICATE_CODE_LENGTH)
     """
-    while True:
-        code = 'CERT-' + ''.join(random.choices(string.ascii_uppercase + string.digits, k=4))
-
-        conn = get_connection()
-        cursor = conn.cursor()
-        cursor.execute('SELECT code FROM certificates WHERE code = ?', (code,))
-        exists = cursor.fetchone()
-        conn.close()
+    with transaction() as cursor:
+        raw = reserve_codes(cursor, 'certificate', 1, CERTIFICATE_CODE_LENGTH)[0]
+    return _certificate_code(raw)
 
-        if not exists:
-            return code
 
-
-def add_certificate(amount: int, buyer_user_id: int) -> str:
+def add_certificates(amount: int, buyer_user_id: int, count: int = 1) -> List[str]:
     """
-    Добавить новый сертификат.
+    Выпустить несколько сертификатов одного номинала одной транзакцией.
+
+    Коды резервируются одним блоком. Совпасть они могут только со
+    старыми случайными кодами - тогда берётся следующий код из блока.
 
     Args:
         amount: Номинал сертификата
         buyer_user_id: ID покупателя
+        count: Количество сертификатов
 
     Returns:
-        str: Код сертификата
+        List[str]: Коды сертификатов (пустой список при ошибке)
     """
     try:
-        conn = get_connection()
-        cursor = conn.cursor()
+        issued = []
+        with transaction() as cursor:
+            pending = reserve_codes(cursor, 'certificate', count, CERTIFICATE_CODE_LENGTH)
+
+            while len(issued) < count:
+                if not pending:
+                    pending = reserve_codes(cursor, 'certificate', count - len(issued),
+                                            CERTIFICATE_CODE_LENGTH)
+                code = _certificate_code(pending.pop(0))
+                try:
+                    cursor.execute('''
+                        INSERT INTO certificates (code, amount, buyer_user_id, used)
+                        VALUES (?, ?, ?, FALSE)
+                    ''', (code, amount, buyer_user_id))
+                    issued.append(code)
+                except sqlite3.IntegrityError:
+                    logger.warning(f"Код {code} уже занят старым сертификатом, берём следующий")
 
-        code = generate_certificate_code()
+        logger.info(f"Выпущено сертификатов: {count} на сумму {amount} руб.")
+        return issued
 
-        cursor.execute('''
-            INSERT INTO certificates (code, amount, buyer_user_id, used)
-            VALUES (?, ?, ?, FALSE)
-        ''', (code, amount, buyer_user_id))
+    except Exception as e:
+        logger.error(f"Ошибка создания сертификатов: {e}")
+        return []
 
-        conn.commit()
-        conn.close()
 
-        logger.info(f"Сертификат {code} создан на сумму {amount} руб.")
-        return code
+def add_certificate(amount: int, buyer_user_id: int) -> str:
+    """
+    Добавить новый сертификат.
 
-    except Exception as e:
-        logger.error(f"Ошибка создания сертификата: {e}")
-        return ""
+    Args:
+        amount: Номинал сертификата
+        buyer_user_id: ID покупателя
+
+    Returns:
+        str: Код сертификата
+    """
+    codes = add_certificates(amount, buyer_user_id, 1)
+    return codes[0] if codes else ""
 
 
 def get_certificate(code: str) -> Optional[dict]:
@@ -2104,6 +2930,7 @@ def add_gallery_item(category: str, photo_url: str, description: str = "", price
         item_id = cursor.lastrowid
         conn.commit()
         conn.close()
+        _catalog_cache.invalidate('gallery')
 
         logger.info(f"Фото добавлено в галерею с ID {item_id}")
         return item_id
@@ -2124,37 +2951,13 @@ def get_gallery_items(category: Optional[str] = None) -> List[dict]:
         list: Список фото
     """
     try:
-        conn = get_connection()
-        cursor = conn.cursor()
+        snapshot = _catalog_cache.get('gallery')
 
-        if category:
-            cursor.execute('''
-                SELECT id, category, description, photo_url, price, created_at
-                FROM gallery WHERE category = ?
-                ORDER BY id DESC
-            ''', (category,))
-        else:
-            cursor.execute('''
-                SELECT id, category, description, photo_url, price, created_at
-                FROM gallery
-                ORDER BY id DESC
-            ''')
-
-        rows = cursor.fetchall()
-        conn.close()
-
-        items = []
-        for row in rows:
-            items.append({
-                'id': row[0],
-                'category': row[1],
-                'description': row[2],
-                'photo_url': row[3],
-                'price': row[4] if row[4] else 0,
-                'created_at': row[5] if row[5] else ''
-            })
-
-        return items
+        return [
+            dict(zip(_GALLERY_FIELDS, row))
+            for row in snapshot.rows
+            if not category or row[1] == category
+        ]
 
     except Exception as e:
         logger.error(f"Ошибка получения галереи: {e}")
@@ -2172,27 +2975,8 @@ def get_gallery_item_by_id(item_id: int) -> Optional[dict]:
         dict: Данные фото или None
     """
     try:
-        conn = get_connection()
-        cursor = conn.cursor()
-
-        cursor.execute('''
-            SELECT id, category, description, photo_url, price, created_at
-            FROM gallery WHERE id = ?
-        ''', (item_id,))
-
-        row = cursor.fetchone()
-        conn.close()
-
-        if row:
-            return {
-                'id': row[0],
-                'category': row[1],
-                'description': row[2],
-                'photo_url': row[3],
-                'price': row[4] if row[4] else 0,
-                'created_at': row[5] if row[5] else ''
-            }
-        return None
+        row = _catalog_cache.get('gallery').by_id.get(item_id)
+        return dict(zip(_GALLERY_FIELDS, row)) if row else None
 
     except Exception as e:
         logger.error(f"Ошибка получения фото по ID: {e}")
@@ -2221,6 +3005,7 @@ def update_gallery_item(item_id: int, category: str, description: str = "", pric
 
         conn.commit()
         conn.close()
+        _catalog_cache.invalidate('gallery')
 
         logger.info(f"Фото {item_id} обновлено в галерее")
 
@@ -2243,6 +3028,7 @@ def delete_gallery_item(item_id: int):
 
         conn.commit()
         conn.close()
+        _catalog_cache.invalidate('gallery')
 
         logger.info(f"Фото {item_id} удалено из галереи")
 
@@ -2340,109 +3126,693 @@ def get_reviews(min_rating: Optional[int] = None) -> List[dict]:
 # ДОПОЛНИТЕЛЬНЫЕ ФУНКЦИИ
 # =================================================================
 
-def log_notification(user_id: int, notification_type: str):
+def _insert_notification(cursor, user_id: int, notification_type: str):
+    """Записать уведомление в журнал в текущей транзакции (без commit)."""
+    cursor.execute('''
+        INSERT INTO notifications_log (user_id, notification_type)
+        VALUES (?, ?)
+    ''', (user_id, notification_type))
+
+
+def log_notification(user_id: int, notification_type: str) -> Future:
     """
     Записать отправленное уведомление в журнал.
 
+    Запись ставится в очередь групповой записи, вызов её не ждёт.
+
     Args:
         user_id: ID пользователя
         notification_type: Тип уведомления
+
+    Returns:
+        Future: Завершается после commit записи
+    """
+    def done(future: Future):
+        error = future.exception()
+        if error is not None:
+            logger.error(f"Ошибка записи уведомления: {error}")
+        else:
+            logger.info(f"Уведомление '{notification_type}' для пользователя {user_id} записано в журнал")
+
+    future = submit_write(_insert_notification, user_id, notification_type)
+    future.add_done_callback(done)
+    return future
+
+
+def get_all_users() -> List[int]:
+    """
+    Получить список всех пользователей (для рассылки).
+
+    Returns:
+        list: Список ID пользователей
+    """
+    try:
+        conn = get_connection()
+        cursor = conn.cursor()
+
+        cursor.execute('SELECT user_id FROM users')
+        users = [row[0] for row in cursor.fetchall()]
+
+        conn.close()
+        return users
+
+    except Exception as e:
+        logger.error(f"Ошибка получения списка пользователей: {e}")
+        return []
+
+
+def get_users_list(search: Optional[str] = None, limit: int = 100, offset: int = 0) -> List[dict]:
+    """
+    Получить список пользователей с полной информацией.
+
+    Args:
+        search: Поисковый запрос (имя, телефон, username)
+        limit: Количество записей
+        offset: Смещение для пагинации
+
+    Returns:
+        list: Список пользователей
     """
     try:
         conn = get_connection()
         cursor = conn.cursor()
 
+        query = '''
+            SELECT user_id, first_name, username, phone, bonus_points, registration_date
+            FROM users
+            WHERE 1=1
+        '''
+        params = []
+
+        if search:
+            match = _fts_match_expression(search, phone_column='phone')
+            if not match:
+                conn.close()
+                return []
+            query += ' AND user_id IN (SELECT rowid FROM users_fts WHERE users_fts MATCH ?)'
+            params.append(match)
+
+        query += ' ORDER BY registration_date DESC LIMIT ? OFFSET ?'
+        params.extend([limit, offset])
+
+        cursor.execute(query, params)
+        rows = cursor.fetchall()
+
+        users = []
+        for row in rows:
+            users.append({
+                'user_id': row[0],
+                'user_name': row[1],  # first_name как user_name для совместимости с шаблонами
+                'username': row[2],
+                'phone': row[3],
+                'bonus_points': row[4],
+                'created_at': row[5]
+            })
+
+        conn.close()
+        return users
+
+    except Exception as e:
+        logger.error(f"Ошибка получения списка пользователей: {e}")
+        return []
+
+
+# =================================================================
+# ПОЛНОТЕКСТОВЫЙ ПОИСК (FTS5)
+# =================================================================
+
+_PHONE_QUERY_RE = re.compile(r'^[\d\s\-+().]+$')
+
+
+def _fts_match_expression(text: str, phone_column: Optional[str] = None) -> Optional[str]:
+    """
+    Построить выражение MATCH с поиском по префиксу.
+
+    Каждое слово запроса берётся в кавычки (спецсимволы FTS5 не
+    интерпретируются) и ищется как префикс: "анн"* найдёт "Анна".
+    Запрос из цифр ищется по нормализованному телефону.
+
+    Args:
+        text: Поисковый запрос оператора
+        phone_column: Столбец FTS с телефоном (если есть)
+
+    Returns:
+        Optional[str]: Выражение MATCH или None для пустого запроса
+    """
+    if not text:
+        return None
+
+    if phone_column and _PHONE_QUERY_RE.match(text):
+        digits = re.sub(r'\D', '', text)
+        if len(digits) >= 3:
+            # Полный номер ищем без кода страны (+7 и 8 дают одинаковый хвост)
+            token = digits[-10:] if len(digits) >= 10 else digits
+            return f'{phone_column} : "{token}"*'
+
+    tokens = re.findall(r'\w+', text.lower())
+    if not tokens:
+        return None
+    return ' '.join(f'"{token}"*' for token in tokens)
+
+
+def search_users(text: str, limit: int = 50, mode: str = TRANSACTIONAL) -> list:
+    """
+    Найти клиентов по имени, username или телефону.
+
+    Args:
+        text: Поисковый запрос (можно начало слова или часть номера)
+        limit: Максимум результатов
+        mode: Режим соединения (TRANSACTIONAL или ANALYTICS)
+
+    Returns:
+        list: Записи UserSummary, самые релевантные первыми
+    """
+    match = _fts_match_expression(text, phone_column='phone')
+    if not match:
+        return []
+
+    try:
+        conn = get_connection(mode)
+        cursor = conn.cursor()
+
+        # Совпадение в имени весит больше, чем в username и телефоне
         cursor.execute('''
-            INSERT INTO notifications_log (user_id, notification_type)
-            VALUES (?, ?)
-        ''', (user_id, notification_type))
+            SELECT u.user_id, u.first_name AS user_name, u.username, u.phone,
+                   u.bonus_points, u.registration_date AS created_at
+            FROM users_fts
+            JOIN users u ON u.user_id = users_fts.rowid
+            WHERE users_fts MATCH ?
+            ORDER BY bm25(users_fts, 10.0, 5.0, 1.0)
+            LIMIT ?
+        ''', (match, limit))
 
-        conn.commit()
+        users = fetch_records(cursor, UserSummary)
+        conn.close()
+        return users
+
+    except Exception as e:
+        logger.error(f"Ошибка поиска пользователей '{text}': {e}")
+        return []
+
+
+def search_products(text: str, limit: int = 20, active_only: bool = True) -> list:
+    """
+    Найти товары по названию и описанию.
+
+    Args:
+        text: Поисковый запрос
+        limit: Максимум результатов
+        active_only: Только активные товары
+
+    Returns:
+        list: Записи Product, самые релевантные первыми
+    """
+    match = _fts_match_expression(text)
+    if not match:
+        return []
+
+    try:
+        conn = get_connection()
+        cursor = conn.cursor()
+
+        query = '''
+            SELECT p.id, p.category, p.name, p.price, p.photo_url, p.description, p.in_stock, p.active
+            FROM products_fts
+            JOIN products p ON p.id = products_fts.rowid
+            WHERE products_fts MATCH ?
+        '''
+        if active_only:
+            query += ' AND p.active = TRUE'
+        query += ' ORDER BY bm25(products_fts, 10.0, 1.0) LIMIT ?'
+
+        cursor.execute(query, (match, limit))
+        products = fetch_records(cursor, Product)
+        conn.close()
+        return products
+
+    except Exception as e:
+        logger.error(f"Ошибка поиска товаров '{text}': {e}")
+        return []
+
+
+def search_reviews(text: str, limit: int = 20) -> list:
+    """
+    Найти отзывы по тексту.
+
+    Args:
+        text: Поисковый запрос
+        limit: Максимум результатов
+
+    Returns:
+        list: Записи Review, самые релевантные первыми
+    """
+    match = _fts_match_expression(text)
+    if not match:
+        return []
+
+    try:
+        conn = get_connection()
+        cursor = conn.cursor()
+
+        cursor.execute('''
+            SELECT r.id, r.user_id, r.user_name, r.rating, r.text, r.created_at
+            FROM reviews_fts
+            JOIN reviews r ON r.id = reviews_fts.rowid
+            WHERE reviews_fts MATCH ?
+            ORDER BY bm25(reviews_fts)
+            LIMIT ?
+        ''', (match, limit))
+
+        reviews = fetch_records(cursor, Review)
+        conn.close()
+        return reviews
+
+    except Exception as e:
+        logger.error(f"Ошибка поиска отзывов '{text}': {e}")
+        return []
+
+
+# =================================================================
+# ПОСТРАНИЧНАЯ ВЫБОРКА (KEYSET)
+# =================================================================
+
+def encode_page_cursor(created_at: str, row_id: int) -> str:
+    """
+    Упаковать позицию последней строки страницы в курсор.
+
+    Args:
+        created_at: Дата создания последней строки
+        row_id: ID последней строки
+
+    Returns:
+        str: Курсор для URL и callback_data
+    """
+    raw = f"{created_at}|{row_id}".encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_page_cursor(token: Optional[str]) -> Optional[Tuple[str, int]]:
+    """
+    Распаковать курсор страницы.
+
+    Args:
+        token: Курсор из encode_page_cursor
+
+    Returns:
+        Optional[Tuple[str, int]]: (created_at, id) или None для первой страницы
+    """
+    if not token:
+        return None
+    try:
+        padded = token + '=' * (-len(token) % 4)
+        created_at, row_id = base64.urlsafe_b64decode(padded).decode('utf-8').rsplit('|', 1)
+        return created_at, int(row_id)
+    except (ValueError, UnicodeDecodeError):
+        logger.warning(f"Некорректный курсор страницы: {token}")
+        return None
+
+
+def _keyset_page(select_sql: str, where: List[str], params: list,
+                 order_col: str, id_col: str, after: Optional[str],
+                 limit: int, record_cls, mode: str = TRANSACTIONAL) -> dict:
+    """
+    Выбрать страницу по ключу (order_col, id_col) в порядке убывания.
+
+    Стоимость любой страницы одинакова: вместо OFFSET используется
+    условие (order_col, id_col) < (курсор), которое идёт по индексу.
+
+    Args:
+        select_sql: SELECT ... FROM ... без WHERE
+        where: Условия фильтра
+        params: Параметры условий
+        order_col: Столбец даты создания
+        id_col: Столбец ID
+        after: Курсор предыдущей страницы (None - первая страница)
+        limit: Размер страницы
+        record_cls: Класс записи из records
+        mode: Режим соединения (TRANSACTIONAL или ANALYTICS)
+
+    Returns:
+        dict: {'items': list, 'next_cursor': str или None}
+    """
+    conditions = list(where)
+    params = list(params)
+
+    position = decode_page_cursor(after)
+    if position:
+        conditions.append(f"({order_col}, {id_col}) < (?, ?)")
+        params.extend(position)
+
+    query = select_sql
+    if conditions:
+        query += ' WHERE ' + ' AND '.join(conditions)
+    query += f' ORDER BY {order_col} DESC, {id_col} DESC LIMIT ?'
+    params.append(limit + 1)
+
+    conn = get_connection(mode)
+    cursor = conn.cursor()
+    cursor.execute(query, params)
+    items = fetch_records(cursor, record_cls)
+    conn.close()
+
+    next_cursor = None
+    if len(items) > limit:
+        items = items[:limit]
+        last = items[-1]
+        next_cursor = encode_page_cursor(last.created_at, last[0])
+
+    return {'items': items, 'next_cursor': next_cursor}
+
+
+def get_flower_orders_page(after: Optional[str] = None, limit: int = 20,
+                           user_id: Optional[int] = None, status: Optional[str] = None,
+                           mode: str = TRANSACTIONAL) -> dict:
+    """
+    Получить страницу заказов цветов (новые сверху).
+
+    Args:
+        after: Курсор предыдущей страницы
+        limit: Размер страницы
+        user_id: Фильтр по пользователю
+        status: Фильтр по статусу
+        mode: Режим соединения (TRANSACTIONAL или ANALYTICS)
+
+    Returns:
+        dict: {'items': список заказов, 'next_cursor': str или None}
+    """
+    where, params = [], []
+    if user_id:
+        where.append('user_id = ?')
+        params.append(user_id)
+    if status:
+        where.append('status = ?')
+        params.append(status)
+
+    try:
+        return _keyset_page(
+            '''SELECT id, user_id, user_name, phone, items, total_amount, delivery_type,
+                      delivery_address, delivery_time, anonymous, card_text, recipient_name,
+                      recipient_phone, status, paid, created_at
+               FROM flower_orders''',
+            where, params, 'created_at', 'id', after, limit, FlowerOrder, mode
+        )
+    except Exception as e:
+        logger.error(f"Ошибка получения страницы заказов: {e}")
+        return {'items': [], 'next_cursor': None}
+
+
+def get_salon_appointments_page(after: Optional[str] = None, limit: int = 20,
+                                user_id: Optional[int] = None, status: Optional[str] = None) -> dict:
+    """
+    Получить страницу записей в салон (новые сверху).
+
+    Args:
+        after: Курсор предыдущей страницы
+        limit: Размер страницы
+        user_id: Фильтр по пользователю
+        status: Фильтр по статусу
+
+    Returns:
+        dict: {'items': список записей, 'next_cursor': str или None}
+    """
+    where, params = [], []
+    if user_id:
+        where.append('user_id = ?')
+        params.append(user_id)
+    if status:
+        where.append('status = ?')
+        params.append(status)
+
+    try:
+        return _keyset_page(
+            '''SELECT id, user_id, user_name, phone, service_id, service_name,
+                      appointment_date, time_slot, status, prepaid, comment, created_at,
+                      COALESCE(price, 0) AS price, COALESCE(duration_minutes, 60) AS duration_minutes
+               FROM salon_appointments''',
+            where, params, 'created_at', 'id', after, limit, Appointment
+        )
+    except Exception as e:
+        logger.error(f"Ошибка получения страницы записей: {e}")
+        return {'items': [], 'next_cursor': None}
+
+
+def get_reviews_page(after: Optional[str] = None, limit: int = 20,
+                     min_rating: Optional[int] = None) -> dict:
+    """
+    Получить страницу отзывов (новые сверху).
+
+    Args:
+        after: Курсор предыдущей страницы
+        limit: Размер страницы
+        min_rating: Минимальный рейтинг
+
+    Returns:
+        dict: {'items': список отзывов, 'next_cursor': str или None}
+    """
+    where, params = [], []
+    if min_rating:
+        where.append('rating >= ?')
+        params.append(min_rating)
+
+    try:
+        return _keyset_page(
+            'SELECT id, user_id, user_name, rating, text, created_at FROM reviews',
+            where, params, 'created_at', 'id', after, limit, Review
+        )
+    except Exception as e:
+        logger.error(f"Ошибка получения страницы отзывов: {e}")
+        return {'items': [], 'next_cursor': None}
+
+
+def get_users_page(after: Optional[str] = None, limit: int = 50,
+                   search: Optional[str] = None, mode: str = TRANSACTIONAL) -> dict:
+    """
+    Получить страницу пользователей (новые сверху).
+
+    Args:
+        after: Курсор предыдущей страницы
+        limit: Размер страницы
+        search: Поисковый запрос (имя, телефон, username)
+        mode: Режим соединения (TRANSACTIONAL или ANALYTICS)
+
+    Returns:
+        dict: {'items': список пользователей, 'next_cursor': str или None}
+    """
+    where, params = [], []
+    if search:
+        match = _fts_match_expression(search, phone_column='phone')
+        if not match:
+            return {'items': [], 'next_cursor': None}
+        where.append('user_id IN (SELECT rowid FROM users_fts WHERE users_fts MATCH ?)')
+        params.append(match)
+
+    try:
+        return _keyset_page(
+            '''SELECT user_id, first_name AS user_name, username, phone, bonus_points,
+                      registration_date AS created_at
+               FROM users''',
+            where, params, 'registration_date', 'user_id', after, limit, UserSummary, mode
+        )
+    except Exception as e:
+        logger.error(f"Ошибка получения страницы пользователей: {e}")
+        return {'items': [], 'next_cursor': None}
+
+
+def count_users(mode: str = TRANSACTIONAL) -> int:
+    """
+    Получить количество пользователей.
+
+    Args:
+        mode: Режим соединения (TRANSACTIONAL или ANALYTICS)
+
+    Returns:
+        int: Количество пользователей
+    """
+    try:
+        conn = get_connection(mode)
+        cursor = conn.cursor()
+
+        cursor.execute('SELECT COUNT(*) FROM users')
+        count = cursor.fetchone()[0]
+
+        conn.close()
+        return count
+
+    except Exception as e:
+        logger.error(f"Ошибка подсчёта пользователей: {e}")
+        return 0
+
+
+def _status_counts(table: str, user_id: Optional[int] = None, mode: str = TRANSACTIONAL) -> dict:
+    """
+    Количество строк таблицы по статусам (GROUP BY по индексу).
+    По пользователю считается вся история, включая архив (всегда
+    через транзакционное соединение - к нему подключён архив).
+    """
+    query = f'SELECT status, COUNT(*) FROM {table}'
+    params = []
+    if user_id:
+        query = f'SELECT status, COUNT(*) FROM {table}_history WHERE user_id = ?'
+        params.append(user_id)
+    query += ' GROUP BY status'
+
+    conn = get_connection(TRANSACTIONAL if user_id else mode)
+    try:
+        if user_id:
+            _ensure_history(conn)
+        return dict(conn.execute(query, params).fetchall())
+    finally:
+        conn.close()
+
+
+def get_salon_appointment_status_counts(user_id: Optional[int] = None, mode: str = TRANSACTIONAL) -> dict:
+    """
+    Получить количество записей в салон по статусам.
+
+    Args:
+        user_id: Только записи пользователя (None - все)
+        mode: Режим соединения (TRANSACTIONAL или ANALYTICS)
+
+    Returns:
+        dict: {статус: количество}
+    """
+    try:
+        return _status_counts('salon_appointments', user_id, mode)
+
+    except Exception as e:
+        logger.error(f"Ошибка подсчёта записей по статусам: {e}")
+        return {}
+
+
+def get_flower_order_status_counts(user_id: Optional[int] = None, mode: str = TRANSACTIONAL) -> dict:
+    """
+    Получить количество заказов цветов по статусам.
+
+    Args:
+        user_id: Только заказы пользователя (None - все)
+        mode: Режим соединения (TRANSACTIONAL или ANALYTICS)
+
+    Returns:
+        dict: {статус: количество}
+    """
+    try:
+        return _status_counts('flower_orders', user_id, mode)
+
+    except Exception as e:
+        logger.error(f"Ошибка подсчёта заказов по статусам: {e}")
+        return {}
+
+
+def _user_rows_by_status(select_sql: str, order_sql: str, record_cls,
+                         user_id: int, limits: Dict[str, int]) -> Dict[str, list]:
+    """
+    Последние строки пользователя по каждому статусу.
+
+    Для каждого статуса - отдельный запрос с LIMIT по индексу
+    (user_id, status, ...), поэтому стоимость не растёт с историей.
+    Таблица в select_sql - представление *_history (с архивом).
+
+    Args:
+        select_sql: SELECT ... FROM ... без WHERE
+        order_sql: Порядок строк (совпадает с индексом)
+        record_cls: Класс записи из records
+        user_id: ID пользователя
+        limits: {статус: сколько строк вернуть}
+
+    Returns:
+        dict: {статус: список записей}
+    """
+    conn = get_connection()
+    try:
+        _ensure_history(conn)
+        rows = {}
+        for status, limit in limits.items():
+            cursor = conn.execute(
+                f'{select_sql} WHERE user_id = ? AND status = ? ORDER BY {order_sql} LIMIT ?',
+                (user_id, status, limit)
+            )
+            rows[status] = fetch_records(cursor, record_cls)
+        return rows
+    finally:
         conn.close()
 
-        logger.info(f"Уведомление '{notification_type}' для пользователя {user_id} записано в журнал")
-
-    except Exception as e:
-        logger.error(f"Ошибка записи уведомления: {e}")
-
 
-def get_all_users() -> List[int]:
+def get_user_appointments_by_status(user_id: int, limits: Dict[str, int]) -> dict:
     """
-    Получить список всех пользователей (для рассылки).
+    Получить сводку записей пользователя для профиля.
+
+    Args:
+        user_id: ID пользователя
+        limits: {статус: сколько последних записей вернуть}
 
     Returns:
-        list: Список ID пользователей
+        dict: {'counts': {статус: количество}, 'top': {статус: записи, ближайшие по дате первыми}}
     """
     try:
-        conn = get_connection()
-        cursor = conn.cursor()
-
-        cursor.execute('SELECT user_id FROM users')
-        users = [row[0] for row in cursor.fetchall()]
-
-        conn.close()
-        return users
+        return {
+            'counts': _status_counts('salon_appointments', user_id),
+            'top': _user_rows_by_status(
+                '''SELECT id, user_id, user_name, phone, service_id, service_name,
+                          appointment_date, time_slot, status, prepaid, comment, created_at,
+                          COALESCE(price, 0) AS price, COALESCE(duration_minutes, 60) AS duration_minutes
+                   FROM salon_appointments_history''',
+                'appointment_date DESC, time_slot DESC', Appointment, user_id, limits
+            ),
+        }
 
     except Exception as e:
-        logger.error(f"Ошибка получения списка пользователей: {e}")
-        return []
+        logger.error(f"Ошибка получения записей пользователя по статусам: {e}")
+        return {'counts': {}, 'top': {status: [] for status in limits}}
 
 
-def get_users_list(search: Optional[str] = None, limit: int = 100, offset: int = 0) -> List[dict]:
+def get_user_flower_orders_by_status(user_id: int, limits: Dict[str, int]) -> dict:
     """
-    Получить список пользователей с полной информацией.
+    Получить сводку заказов цветов пользователя для профиля.
 
     Args:
-        search: Поисковый запрос (имя, телефон, username)
-        limit: Количество записей
-        offset: Смещение для пагинации
+        user_id: ID пользователя
+        limits: {статус: сколько последних заказов вернуть}
 
     Returns:
-        list: Список пользователей
+        dict: {'counts': {статус: количество}, 'top': {статус: заказы, новые первыми}}
     """
     try:
-        conn = get_connection()
-        cursor = conn.cursor()
+        return {
+            'counts': _status_counts('flower_orders', user_id),
+            'top': _user_rows_by_status(
+                '''SELECT id, user_id, user_name, phone, items, total_amount, delivery_type,
+                          delivery_address, delivery_time, anonymous, card_text, recipient_name,
+                          recipient_phone, status, paid, created_at
+                   FROM flower_orders_history''',
+                'created_at DESC', FlowerOrder, user_id, limits
+            ),
+        }
 
-        query = '''
-            SELECT user_id, first_name, username, phone, bonus_points, registration_date
-            FROM users
-            WHERE 1=1
-        '''
-        params = []
+    except Exception as e:
+        logger.error(f"Ошибка получения заказов пользователя по статусам: {e}")
+        return {'counts': {}, 'top': {status: [] for status in limits}}
 
-        if search:
-            query += ''' AND (
-                first_name LIKE ? OR
-                username LIKE ? OR
-                phone LIKE ?
-            )'''
-            search_pattern = f'%{search}%'
-            params.extend([search_pattern, search_pattern, search_pattern])
 
-        query += ' ORDER BY registration_date DESC LIMIT ? OFFSET ?'
-        params.extend([limit, offset])
+def get_review_rating_counts() -> dict:
+    """
+    Получить количество отзывов по оценкам.
 
-        cursor.execute(query, params)
-        rows = cursor.fetchall()
+    Returns:
+        dict: {оценка: количество}
+    """
+    try:
+        conn = get_connection()
+        cursor = conn.cursor()
 
-        users = []
-        for row in rows:
-            users.append({
-                'user_id': row[0],
-                'user_name': row[1],  # first_name как user_name для совместимости с шаблонами
-                'username': row[2],
-                'phone': row[3],
-                'bonus_points': row[4],
-                'created_at': row[5]
-            })
+        cursor.execute('SELECT rating, COUNT(*) FROM reviews GROUP BY rating')
+        counts = dict(cursor.fetchall())
 
         conn.close()
-        return users
+        return counts
 
     except Exception as e:
-        logger.error(f"Ошибка получения списка пользователей: {e}")
-        return []
+        logger.error(f"Ошибка подсчёта отзывов по оценкам: {e}")
+        return {}
 
 
 def get_user_stats(user_id: int) -> dict:
@@ -2459,12 +3829,14 @@ def get_user_stats(user_id: int) -> dict:
         conn = get_connection()
         cursor = conn.cursor()
 
+        _ensure_history(cursor)
+
         # Записи в салон
-        cursor.execute('SELECT COUNT(*) FROM salon_appointments WHERE user_id = ?', (user_id,))
+        cursor.execute('SELECT COUNT(*) FROM salon_appointments_history WHERE user_id = ?', (user_id,))
         appointments_count = cursor.fetchone()[0]
 
         # Заказы цветов
-        cursor.execute('SELECT COUNT(*) FROM flower_orders WHERE user_id = ?', (user_id,))
+        cursor.execute('SELECT COUNT(*) FROM flower_orders_history WHERE user_id = ?', (user_id,))
         orders_count = cursor.fetchone()[0]
 
         # Отзывы
@@ -2472,7 +3844,7 @@ def get_user_stats(user_id: int) -> dict:
         reviews_count = cursor.fetchone()[0]
 
         # Общая сумма заказов
-        cursor.execute('SELECT SUM(total_amount) FROM flower_orders WHERE user_id = ? AND status != "cancelled"', (user_id,))
+        cursor.execute('SELECT SUM(total_amount) FROM flower_orders_history WHERE user_id = ? AND status != "cancelled"', (user_id,))
         total_spent = cursor.fetchone()[0] or 0
 
         conn.close()
@@ -2523,6 +3895,14 @@ def count_referrals(user_id: int) -> int:
 # ЛОГИРОВАНИЕ СОГЛАСИЙ НА ОБРАБОТКУ ДАННЫХ
 # =================================================================
 
+def _insert_consent(cursor, user_id: int, user_name: str, phone: str, consent_type: str):
+    """Записать согласие в текущей транзакции (без commit)."""
+    cursor.execute('''
+        INSERT INTO consent_logs (user_id, user_name, phone, consent_type)
+        VALUES (?, ?, ?, ?)
+    ''', (user_id, user_name, phone, consent_type))
+
+
 def log_consent(user_id: int, user_name: str, phone: str, consent_type: str = 'phone_share') -> bool:
     """
     Зафиксировать согласие пользователя на обработку персональных данных.
@@ -2537,16 +3917,7 @@ def log_consent(user_id: int, user_name: str, phone: str, consent_type: str = 'p
         bool: True если успешно, False при ошибке
     """
     try:
-        conn = get_connection()
-        cursor = conn.cursor()
-
-        cursor.execute('''
-            INSERT INTO consent_logs (user_id, user_name, phone, consent_type)
-            VALUES (?, ?, ?, ?)
-        ''', (user_id, user_name, phone, consent_type))
-
-        conn.commit()
-        conn.close()
+        submit_write(_insert_consent, user_id, user_name, phone, consent_type).result()
 
         logger.info(f"Зафиксировано согласие пользователя {user_id} ({user_name}) на {consent_type}")
         return True
@@ -2571,17 +3942,18 @@ def get_consent_logs(user_id: Optional[int] = None, limit: int = 100) -> List[di
         conn = get_connection()
         conn.row_factory = sqlite3.Row
         cursor = conn.cursor()
+        _ensure_history(cursor)
 
         if user_id:
             cursor.execute('''
-                SELECT * FROM consent_logs
+                SELECT * FROM consent_logs_history
                 WHERE user_id = ?
                 ORDER BY consent_date DESC
                 LIMIT ?
             ''', (user_id, limit))
         else:
             cursor.execute('''
-                SELECT * FROM consent_logs
+                SELECT * FROM consent_logs_history
                 ORDER BY consent_date DESC
                 LIMIT ?
             ''', (limit,))
@@ -2679,6 +4051,7 @@ def rename_service_category(old_name: str, new_name: str) -> bool:
 
         conn.commit()
         conn.close()
+        _catalog_cache.invalidate('services')
 
         logger.info(f"Категория услуг переименована: '{old_name}' -> '{new_name}'")
         return True
@@ -2711,6 +4084,7 @@ def rename_product_category(old_name: str, new_name: str) -> bool:
 
         conn.commit()
         conn.close()
+        _catalog_cache.invalidate('products')
 
         logger.info(f"Категория товаров переименована: '{old_name}' -> '{new_name}'")
         return True
@@ -2743,6 +4117,7 @@ def delete_service_category(category_name: str) -> bool:
 
         conn.commit()
         conn.close()
+        _catalog_cache.invalidate('services')
 
         logger.info(f"Категория услуг '{category_name}' удалена (услуги деактивированы)")
         return True
@@ -2775,6 +4150,7 @@ def delete_product_category(category_name: str) -> bool:
 
         conn.commit()
         conn.close()
+        _catalog_cache.invalidate('products')
 
         logger.info(f"Категория товаров '{category_name}' удалена (товары деактивированы)")
         return True
@@ -2818,6 +4194,7 @@ def add_service_category(category_name: str, placeholder_name: str = "Новая
 
         conn.commit()
         conn.close()
+        _catalog_cache.invalidate('services')
 
         logger.info(f"Категория услуг '{category_name}' создана")
         return True
@@ -2861,6 +4238,7 @@ def add_product_category(category_name: str, placeholder_name: str = "Новый
 
         conn.commit()
         conn.close()
+        _catalog_cache.invalidate('products')
 
         logger.info(f"Категория товаров '{category_name}' создана")
         return True
@@ -2874,47 +4252,19 @@ def add_product_category(category_name: str, placeholder_name: str = "Новый
 # УПРАВЛЕНИЕ БОНУСНОЙ ПРОГРАММОЙ
 # ============================================================================
 
-def get_bonus_settings() -> dict:
+def get_bonus_settings() -> BonusSettings:
     """
     Получить текущие настройки бонусной программы.
 
     Returns:
-        dict: Настройки бонусной программы
+        BonusSettings: Неизменяемый снимок настроек (доступ и по ключам, как у dict)
     """
     try:
-        conn = get_connection()
-        cursor = conn.cursor()
-
-        cursor.execute('SELECT * FROM bonus_settings WHERE id = 1')
-        row = cursor.fetchone()
-        conn.close()
-
-        if row:
-            return {
-                'bonus_percent': row[1],
-                'bonus_threshold': row[2],
-                'max_bonus_payment_percent': row[3],
-                'referral_bonus': row[4],
-                'bonus_expiry_days': row[5],
-                'updated_at': row[6]
-            }
-        return {
-            'bonus_percent': 5,
-            'bonus_threshold': 3000,
-            'max_bonus_payment_percent': 50,
-            'referral_bonus': 500,
-            'bonus_expiry_days': 0
-        }
+        return _settings_cache.get('settings').bonus
 
     except Exception as e:
         logger.error(f"Ошибка получения настроек бонусов: {e}")
-        return {
-            'bonus_percent': 5,
-            'bonus_threshold': 3000,
-            'max_bonus_payment_percent': 50,
-            'referral_bonus': 500,
-            'bonus_expiry_days': 0
-        }
+        return _DEFAULT_BONUS_SETTINGS
 
 
 def update_bonus_settings(bonus_percent: int, bonus_threshold: int,
@@ -2934,24 +4284,33 @@ def update_bonus_settings(bonus_percent: int, bonus_threshold: int,
         bool: True если успешно, False в случае ошибки
     """
     try:
-        conn = get_connection()
-        cursor = conn.cursor()
-
-        cursor.execute('''
-            UPDATE bonus_settings
-            SET bonus_percent = ?,
-                bonus_threshold = ?,
-                max_bonus_payment_percent = ?,
-                referral_bonus = ?,
-                bonus_expiry_days = ?,
-                updated_at = CURRENT_TIMESTAMP
-            WHERE id = 1
-        ''', (bonus_percent, bonus_threshold, max_bonus_payment_percent,
-              referral_bonus, bonus_expiry_days))
-
-        conn.commit()
-        conn.close()
+        with transaction() as cursor:
+            cursor.execute('SELECT bonus_expiry_days FROM bonus_settings WHERE id = 1')
+            row = cursor.fetchone()
+            old_expiry_days = row[0] if row else 0
 
+            cursor.execute('''
+                UPDATE bonus_settings
+                SET bonus_percent = ?,
+                    bonus_threshold = ?,
+                    max_bonus_payment_percent = ?,
+                    referral_bonus = ?,
+                    bonus_expiry_days = ?,
+                    updated_at = CURRENT_TIMESTAMP
+                WHERE id = 1
+            ''', (bonus_percent, bonus_threshold, max_bonus_payment_percent,
+                  referral_bonus, bonus_expiry_days))
+
+            # Новый срок действует и для уже начисленных непотраченных бонусов
+            if bonus_expiry_days != old_expiry_days:
+                cursor.execute('''
+                    UPDATE bonus_credits
+                    SET expires_at = CASE WHEN ? > 0
+                                          THEN datetime(created_at, '+' || ? || ' days') END
+                    WHERE remaining > 0
+                ''', (bonus_expiry_days, bonus_expiry_days))
+
+        _settings_cache.invalidate('settings')
         logger.info("Настройки бонусной программы обновлены")
         return True
 
@@ -2964,54 +4323,51 @@ def expire_old_bonuses() -> int:
     """
     Списать просроченные бонусы у всех пользователей.
 
+    Читаются только открытые начисления с истёкшим expires_at (частичный
+    индекс), поэтому стоимость зависит от числа истекающих начислений,
+    а не от всей истории. Погашенное начисление больше не попадает в выборку.
+
     Returns:
         int: Количество пользователей, у которых списаны бонусы
     """
     try:
-        settings = get_bonus_settings()
-        expiry_days = settings.get('bonus_expiry_days', 0)
-
-        if expiry_days <= 0:
-            return 0  # Бонусы бессрочные
-
-        conn = get_connection()
-        cursor = conn.cursor()
-
-        # Найти транзакции старше expiry_days
-        cursor.execute('''
-            SELECT user_id, SUM(points) as expired_points
-            FROM loyalty_transactions
-            WHERE points > 0
-            AND datetime(created_at, '+' || ? || ' days') < datetime('now')
-            GROUP BY user_id
-            HAVING expired_points > 0
-        ''', (expiry_days,))
-
-        expired_users = cursor.fetchall()
-        count = 0
-
-        for user_id, expired_points in expired_users:
-            # Списать просроченные бонусы
-            cursor.execute('''
-                UPDATE users
-                SET bonus_points = MAX(0, bonus_points - ?)
-                WHERE user_id = ?
-            ''', (expired_points, user_id))
-
-            # Записать транзакцию списания
+        with transaction() as cursor:
             cursor.execute('''
-                INSERT INTO loyalty_transactions (user_id, points, description)
-                VALUES (?, ?, ?)
-            ''', (user_id, -expired_points, f"Списание просроченных бонусов ({expiry_days} дней)"))
+                SELECT id, user_id, remaining FROM bonus_credits
+                WHERE remaining > 0
+                AND expires_at IS NOT NULL
+                AND expires_at <= datetime('now')
+            ''')
+            expiring = cursor.fetchall()
 
-            count += 1
+            if not expiring:
+                return 0
 
-        conn.commit()
-        conn.close()
+            expired_by_user = {}
+            for credit_id, user_id, remaining in expiring:
+                expired_by_user[user_id] = expired_by_user.get(user_id, 0) + remaining
 
-        if count > 0:
-            logger.info(f"Списаны просроченные бонусы у {count} пользователей")
+            cursor.executemany(
+                'UPDATE bonus_credits SET remaining = 0 WHERE id = ?',
+                [(credit_id,) for credit_id, _, _ in expiring]
+            )
 
+            for user_id, expired_points in expired_by_user.items():
+                # Списать просроченные бонусы
+                cursor.execute('''
+                    UPDATE users
+                    SET bonus_points = MAX(0, bonus_points - ?)
+                    WHERE user_id = ?
+                ''', (expired_points, user_id))
+
+                # Записать транзакцию списания
+                cursor.execute('''
+                    INSERT INTO loyalty_transactions (user_id, points, description)
+                    VALUES (?, ?, ?)
+                ''', (user_id, -expired_points, "Списание просроченных бонусов"))
+
+        count = len(expired_by_user)
+        logger.info(f"Списаны просроченные бонусы у {count} пользователей ({len(expiring)} начислений)")
         return count
 
     except Exception as e:
@@ -3019,6 +4375,38 @@ def expire_old_bonuses() -> int:
         return 0
 
 
+def get_expiring_bonuses(user_id: int, days: int = 30) -> List[Tuple]:
+    """
+    Получить начисления пользователя, которые сгорят в ближайшие дни.
+
+    Args:
+        user_id: ID пользователя
+        days: Горизонт в днях
+
+    Returns:
+        list: Список (остаток, дата сгорания), ближайшие первыми
+    """
+    try:
+        conn = get_connection()
+        cursor = conn.cursor()
+
+        cursor.execute('''
+            SELECT remaining, expires_at FROM bonus_credits
+            WHERE user_id = ? AND remaining > 0
+            AND expires_at IS NOT NULL
+            AND expires_at <= datetime('now', '+' || ? || ' days')
+            ORDER BY expires_at
+        ''', (user_id, days))
+
+        credits = cursor.fetchall()
+        conn.close()
+        return credits
+
+    except Exception as e:
+        logger.error(f"Ошибка получения сгорающих бонусов: {e}")
+        return []
+
+
 def manually_adjust_bonus_points(user_id: int, points: int, description: str) -> bool:
     """
     Вручную начислить или списать бонусы пользователю (для админов).
@@ -3032,34 +4420,13 @@ def manually_adjust_bonus_points(user_id: int, points: int, description: str) ->
         bool: True если успешно, False в случае ошибки
     """
     try:
-        conn = get_connection()
-        cursor = conn.cursor()
-
-        # Проверить текущий баланс при списании
-        if points < 0:
-            cursor.execute('SELECT bonus_points FROM users WHERE user_id = ?', (user_id,))
-            result = cursor.fetchone()
-            if not result or result[0] + points < 0:
-                conn.close()
+        with transaction() as cursor:
+            if points >= 0:
+                _credit_bonus(cursor, user_id, points, description)
+            elif not _debit_bonus(cursor, user_id, -points, description):
                 logger.warning(f"Недостаточно бонусов для списания у пользователя {user_id}")
                 return False
 
-        # Обновить баланс
-        cursor.execute('''
-            UPDATE users
-            SET bonus_points = bonus_points + ?
-            WHERE user_id = ?
-        ''', (points, user_id))
-
-        # Записать транзакцию
-        cursor.execute('''
-            INSERT INTO loyalty_transactions (user_id, points, description)
-            VALUES (?, ?, ?)
-        ''', (user_id, points, description))
-
-        conn.commit()
-        conn.close()
-
         logger.info(f"Вручную изменены бонусы пользователя {user_id}: {points:+d} ({description})")
         return True
 
@@ -3072,41 +4439,19 @@ def manually_adjust_bonus_points(user_id: int, points: int, description: str) ->
 # РЕКОМЕНДАТЕЛЬНАЯ СИСТЕМА / ЗАПРОСЫ ОТЗЫВОВ
 # ============================================================================
 
-def get_feedback_settings() -> dict:
+def get_feedback_settings() -> FeedbackSettings:
     """
     Получить настройки рекомендательной системы.
 
     Returns:
-        dict: Настройки системы запросов отзывов
+        FeedbackSettings: Неизменяемый снимок настроек (доступ и по ключам, как у dict)
     """
     try:
-        conn = get_connection()
-        cursor = conn.cursor()
-
-        cursor.execute('SELECT * FROM feedback_settings WHERE id = 1')
-        row = cursor.fetchone()
-        conn.close()
-
-        if row:
-            return {
-                'enabled': bool(row[1]),
-                'delay_days': row[2],
-                'message_template': row[3],
-                'updated_at': row[4]
-            }
-        return {
-            'enabled': True,
-            'delay_days': 1,
-            'message_template': 'Здравствуйте! Как вам наши услуги/товары? Будем рады вашему отзыву! 💐'
-        }
+        return _settings_cache.get('settings').feedback
 
     except Exception as e:
         logger.error(f"Ошибка получения настроек отзывов: {e}")
-        return {
-            'enabled': True,
-            'delay_days': 1,
-            'message_template': 'Здравствуйте! Как вам наши услуги/товары? Будем рады вашему отзыву! 💐'
-        }
+        return _DEFAULT_FEEDBACK_SETTINGS
 
 
 def update_feedback_settings(enabled: bool, delay_days: int, message_template: str) -> bool:
@@ -3136,6 +4481,7 @@ def update_feedback_settings(enabled: bool, delay_days: int, message_template: s
 
         conn.commit()
         conn.close()
+        _settings_cache.invalidate('settings')
 
         logger.info("Настройки рекомендательной системы обновлены")
         return True
@@ -3145,6 +4491,26 @@ def update_feedback_settings(enabled: bool, delay_days: int, message_template: s
         return False
 
 
+def _schedule_feedback(cursor, user_id: int, order_type: str, order_id: int) -> Optional[int]:
+    """
+    Запланировать запрос отзыва в текущей транзакции (без commit).
+
+    Returns:
+        Optional[int]: Через сколько дней будет запрос, None если система выключена
+    """
+    settings = get_feedback_settings()
+    if not settings.enabled:
+        return None
+    delay_days = settings.delay_days
+
+    # Вычислить дату отправки (через delay_days дней)
+    cursor.execute('''
+        INSERT INTO feedback_requests (user_id, order_type, order_id, scheduled_date, status)
+        VALUES (?, ?, ?, date('now', '+' || ? || ' days'), 'pending')
+    ''', (user_id, order_type, order_id, delay_days))
+    return delay_days
+
+
 def schedule_feedback_request(user_id: int, order_type: str, order_id: int) -> bool:
     """
     Запланировать отправку запроса на отзыв.
@@ -3158,22 +4524,11 @@ def schedule_feedback_request(user_id: int, order_type: str, order_id: int) -> b
         bool: True если успешно, False в случае ошибки
     """
     try:
-        settings = get_feedback_settings()
-        if not settings['enabled']:
-            return False
-
-        conn = get_connection()
-        cursor = conn.cursor()
-
-        # Вычислить дату отправки (через delay_days дней)
-        delay_days = settings['delay_days']
-        cursor.execute('''
-            INSERT INTO feedback_requests (user_id, order_type, order_id, scheduled_date, status)
-            VALUES (?, ?, ?, date('now', '+' || ? || ' days'), 'pending')
-        ''', (user_id, order_type, order_id, delay_days))
+        with transaction() as cursor:
+            delay_days = _schedule_feedback(cursor, user_id, order_type, order_id)
 
-        conn.commit()
-        conn.close()
+        if delay_days is None:
+            return False
 
         logger.info(f"Запланирован запрос отзыва для пользователя {user_id} через {delay_days} дней")
         return True
@@ -3221,6 +4576,16 @@ def get_pending_feedback_requests() -> List[dict]:
         return []
 
 
+def _mark_feedback_sent(cursor, request_id: int):
+    """Отметить запрос отзыва отправленным в текущей транзакции (без commit)."""
+    cursor.execute('''
+        UPDATE feedback_requests
+        SET status = 'sent',
+            sent_at = CURRENT_TIMESTAMP
+        WHERE id = ?
+    ''', (request_id,))
+
+
 def mark_feedback_request_sent(request_id: int) -> bool:
     """
     Отметить запрос отзыва как отправленный.
@@ -3232,19 +4597,7 @@ def mark_feedback_request_sent(request_id: int) -> bool:
         bool: True если успешно
     """
     try:
-        conn = get_connection()
-        cursor = conn.cursor()
-
-        cursor.execute('''
-            UPDATE feedback_requests
-            SET status = 'sent',
-                sent_at = CURRENT_TIMESTAMP
-            WHERE id = ?
-        ''', (request_id,))
-
-        conn.commit()
-        conn.close()
-
+        submit_write(_mark_feedback_sent, request_id).result()
         return True
 
     except Exception as e:
@@ -3376,9 +4729,10 @@ def create_utm_campaign(name: str, utm_source: str, utm_medium: str = None,
 
         cursor.execute('''
             INSERT INTO utm_campaigns
-            (name, utm_source, utm_medium, utm_campaign, utm_content, utm_term, generated_link)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-        ''', (name, utm_source, utm_medium, utm_campaign, utm_content, utm_term, generated_link))
+            (name, utm_source, utm_medium, utm_campaign, utm_content, utm_term, generated_link, utm_code)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (name, utm_source, utm_medium, utm_campaign, utm_content, utm_term, generated_link,
+              f"utm_{utm_code}"))
 
         conn.commit()
         conn.close()
@@ -3391,6 +4745,46 @@ def create_utm_campaign(name: str, utm_source: str, utm_medium: str = None,
         return None
 
 
+def _parse_start_param(start_param: str) -> dict:
+    """Разобрать параметр /start на UTM-метки (без обращения к БД)."""
+    utm_params = {
+        'source_type': 'organic',
+        'utm_source': None,
+        'utm_medium': None,
+        'utm_campaign': None,
+        'utm_content': None,
+        'utm_term': None
+    }
+
+    if not start_param:
+        return utm_params
+
+    # Реферальная ссылка (формат: REF123456)
+    if start_param.startswith('REF'):
+        utm_params['source_type'] = 'referral'
+        utm_params['utm_source'] = 'referral'
+        utm_params['utm_content'] = start_param
+        return utm_params
+
+    # UTM-метки (формат: utm_source__medium__campaign__content__term)
+    if start_param.startswith('utm_'):
+        utm_params['source_type'] = 'utm'
+        parts = start_param.replace('utm_', '').split('__')
+
+        if len(parts) >= 1 and parts[0]:
+            utm_params['utm_source'] = parts[0]
+        if len(parts) >= 2 and parts[1]:
+            utm_params['utm_medium'] = parts[1]
+        if len(parts) >= 3 and parts[2]:
+            utm_params['utm_campaign'] = parts[2]
+        if len(parts) >= 4 and parts[3]:
+            utm_params['utm_content'] = parts[3]
+        if len(parts) >= 5 and parts[4]:
+            utm_params['utm_term'] = parts[4]
+
+    return utm_params
+
+
 def parse_utm_from_start_param(start_param: str) -> dict:
     """
     Распарсить UTM-параметры из /start параметра.
@@ -3401,96 +4795,175 @@ def parse_utm_from_start_param(start_param: str) -> dict:
     Returns:
         dict: Словарь с UTM-параметрами
     """
-    utm_params = {
-        'source_type': 'organic',
-        'utm_source': None,
-        'utm_medium': None,
-        'utm_campaign': None,
-        'utm_content': None,
-        'utm_term': None
-    }
+    utm_params = _parse_start_param(None)
+
+    try:
+        utm_params = _parse_start_param(start_param)
+
+        # Обновить статистику кампании
+        if utm_params['source_type'] == 'utm':
+            update_utm_campaign_stats(start_param, 'click')
+
+        return utm_params
+
+    except Exception as e:
+        logger.error(f"Ошибка парсинга UTM: {e}")
+        return utm_params
+
+
+def _utm_campaign_code(utm_code: str) -> str:
+    """
+    Привести код к виду из deep link: utm_source__medium__campaign__content__term.
+
+    Код из /start приходит полным, код из UTM-колонок пользователя - без
+    префикса, а укороченная ссылка может прийти без пустых хвостовых меток.
+    """
+    if utm_code.startswith('utm_'):
+        utm_code = utm_code[4:]
+    parts = utm_code.replace(' ', '_').split('__')
+    parts += [''] * (5 - len(parts))
+    return 'utm_' + '__'.join(parts)
+
+
+def _apply_utm_counters(cursor, rows: list):
+    """Прибавить счётчики кампаний (clicks, registrations, conversions, revenue, utm_code) без commit."""
+    cursor.executemany('''
+        UPDATE utm_campaigns
+        SET clicks = clicks + ?,
+            registrations = registrations + ?,
+            conversions = conversions + ?,
+            revenue = revenue + ?
+        WHERE utm_code = ?
+    ''', rows)
+
+
+class _UtmStatsBuffer:
+    """
+    Буфер счётчиков UTM-кампаний.
+
+    Клики, регистрации, конверсии и выручка суммируются в памяти по коду
+    кампании, а фоновый поток раз в UTM_STATS_FLUSH_SECONDS записывает их
+    одним executemany через очередь групповой записи. При штатной остановке (close_pool,
+    atexit) буфер сбрасывается; при аварийной теряется не больше одного интервала.
+    """
+
+    # Позиции счётчиков: clicks, registrations, conversions, revenue
+    _FIELDS = {'click': 0, 'registration': 1, 'conversion': 2}
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._pid = os.getpid()
+        self._thread = None
+
+    def _check_fork(self):
+        """После fork счётчики принадлежат родителю - начать с пустого буфера."""
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._pending = {}
+            self._thread = None
+
+    def add(self, utm_code: str, stat_type: str, amount: int = 1):
+        """Учесть событие кампании (без обращения к БД)."""
+        if stat_type not in self._FIELDS:
+            logger.warning(f"Неизвестный тип статистики UTM: {stat_type}")
+            return
+
+        code = _utm_campaign_code(utm_code)
+        with self._lock:
+            self._check_fork()
+            counters = self._pending.setdefault(code, [0, 0, 0, 0])
+            counters[self._FIELDS[stat_type]] += 1
+            if stat_type == 'conversion':
+                counters[3] += amount
+
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._run, name="utm-stats-flush", daemon=True
+                )
+                self._thread.start()
+
+    def _run(self):
+        """Фоновый сброс счётчиков."""
+        while True:
+            time.sleep(self.interval)
+            if self._pid != os.getpid():
+                return
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Ошибка сброса статистики UTM: {e}")
+
+    def flush(self) -> int:
+        """
+        Записать накопленные счётчики в БД.
+
+        Если запись не удалась, счётчики возвращаются в буфер.
+
+        Returns:
+            int: Количество обновлённых кодов кампаний
+        """
+        with self._lock:
+            self._check_fork()
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return 0
+
+        try:
+            # Сброс делит commit с другими мелкими записями очереди
+            submit_write(_apply_utm_counters, [(*counters, code) for code, counters in pending.items()]).result()
+        except Exception:
+            with self._lock:
+                for code, counters in pending.items():
+                    current = self._pending.setdefault(code, [0, 0, 0, 0])
+                    for i, value in enumerate(counters):
+                        current[i] += value
+            raise
 
-    try:
-        if not start_param:
-            return utm_params
-
-        # Реферальная ссылка (формат: REF123456)
-        if start_param.startswith('REF'):
-            utm_params['source_type'] = 'referral'
-            utm_params['utm_source'] = 'referral'
-            utm_params['utm_content'] = start_param
-            return utm_params
-
-        # UTM-метки (формат: utm_source__medium__campaign__content__term)
-        if start_param.startswith('utm_'):
-            utm_params['source_type'] = 'utm'
-            parts = start_param.replace('utm_', '').split('__')
-
-            if len(parts) >= 1 and parts[0]:
-                utm_params['utm_source'] = parts[0]
-            if len(parts) >= 2 and parts[1]:
-                utm_params['utm_medium'] = parts[1]
-            if len(parts) >= 3 and parts[2]:
-                utm_params['utm_campaign'] = parts[2]
-            if len(parts) >= 4 and parts[3]:
-                utm_params['utm_content'] = parts[3]
-            if len(parts) >= 5 and parts[4]:
-                utm_params['utm_term'] = parts[4]
-
-            # Обновить статистику кампании
-            update_utm_campaign_stats(start_param, 'click')
+        return len(pending)
 
-        return utm_params
 
-    except Exception as e:
-        logger.error(f"Ошибка парсинга UTM: {e}")
-        return utm_params
+_utm_stats = _UtmStatsBuffer(UTM_STATS_FLUSH_SECONDS)
 
 
 def update_utm_campaign_stats(utm_code: str, stat_type: str, amount: int = 1):
     """
     Обновить статистику UTM-кампании.
 
+    Событие попадает в буфер и записывается в БД фоновым сбросом
+    (см. flush_utm_stats), вызов к БД не обращается.
+
     Args:
         utm_code: Код UTM-кампании
         stat_type: Тип статистики (click, registration, conversion)
         amount: Значение для revenue
     """
     try:
-        conn = get_connection()
-        cursor = conn.cursor()
+        _utm_stats.add(utm_code, stat_type, amount)
 
-        # Восстановить полный код
-        if not utm_code.startswith('utm_'):
-            utm_code = f'utm_{utm_code}'
+    except Exception as e:
+        logger.error(f"Ошибка обновления статистики UTM: {e}")
 
-        generated_link_pattern = f'%{utm_code}'
 
-        if stat_type == 'click':
-            cursor.execute('''
-                UPDATE utm_campaigns
-                SET clicks = clicks + 1
-                WHERE generated_link LIKE ?
-            ''', (generated_link_pattern,))
-        elif stat_type == 'registration':
-            cursor.execute('''
-                UPDATE utm_campaigns
-                SET registrations = registrations + 1
-                WHERE generated_link LIKE ?
-            ''', (generated_link_pattern,))
-        elif stat_type == 'conversion':
-            cursor.execute('''
-                UPDATE utm_campaigns
-                SET conversions = conversions + 1,
-                    revenue = revenue + ?
-                WHERE generated_link LIKE ?
-            ''', (amount, generated_link_pattern))
+def flush_utm_stats() -> int:
+    """
+    Сбросить накопленную статистику UTM-кампаний в БД.
 
-        conn.commit()
-        conn.close()
+    Вызывается фоновым потоком, при закрытии пула и при выходе из процесса.
+
+    Returns:
+        int: Количество обновлённых кампаний (по кодам)
+    """
+    try:
+        return _utm_stats.flush()
 
     except Exception as e:
-        logger.error(f"Ошибка обновления статистики UTM: {e}")
+        logger.error(f"Ошибка сброса статистики UTM: {e}")
+        return 0
+
+
+atexit.register(flush_utm_stats)
 
 
 def get_utm_campaigns() -> List[dict]:
@@ -3570,32 +5043,19 @@ def toggle_utm_campaign(campaign_id: int) -> bool:
 # РАБОТА С РЕФЕРАЛЬНОЙ ПРОГРАММОЙ
 # =================================================================
 
-def get_referral_settings() -> dict:
-    """Получить настройки реферальной программы."""
-    try:
-        conn = get_connection()
-        cursor = conn.cursor()
-
-        cursor.execute('SELECT * FROM referral_settings WHERE id = 1')
-        row = cursor.fetchone()
-        conn.close()
+def get_referral_settings() -> ReferralSettings:
+    """
+    Получить настройки реферальной программы.
 
-        if row:
-            return {
-                'enabled': bool(row[1]),
-                'reward_type': row[2],
-                'reward_amount': row[3],
-                'reward_percent': row[4],
-                'min_order_amount': row[5],
-                'max_reward_amount': row[6],
-                'reward_on_first_order_only': bool(row[7]),
-                'auto_approve': bool(row[8])
-            }
-        return {}
+    Returns:
+        ReferralSettings: Неизменяемый снимок настроек (доступ и по ключам, как у dict)
+    """
+    try:
+        return _settings_cache.get('settings').referral
 
     except Exception as e:
         logger.error(f"Ошибка получения настроек реферальной программы: {e}")
-        return {}
+        return _DEFAULT_REFERRAL_SETTINGS
 
 
 def update_referral_settings(**settings):
@@ -3616,92 +5076,105 @@ def update_referral_settings(**settings):
 
         conn.commit()
         conn.close()
+        _settings_cache.invalidate('settings')
         logger.info("Настройки реферальной программы обновлены")
 
     except Exception as e:
         logger.error(f"Ошибка обновления настроек реферальной программы: {e}")
 
 
-def check_and_award_referral_bonus(order_id: int, user_id: int, order_amount: int):
+def _award_referral_bonus(cursor, order_id: int, user_id: int, order_amount: int,
+                          referrer_id: Optional[int] = None) -> Optional[dict]:
     """
-    Проверить и начислить реферальный бонус.
+    Создать реферальную награду в текущей транзакции (без commit).
 
     Args:
+        cursor: Курсор открытой транзакции
         order_id: ID заказа
         user_id: ID пользователя, совершившего заказ
         order_amount: Сумма заказа
-    """
-    try:
-        # Получить настройки
-        settings = get_referral_settings()
-        if not settings or not settings.get('enabled'):
-            return
+        referrer_id: Кто пригласил (если уже известен, запрос к users не нужен)
 
-        # Проверить минимальную сумму
-        if order_amount < settings['min_order_amount']:
-            return
+    Returns:
+        Optional[dict]: referrer_id, amount, status или None, если награды нет
+    """
+    settings = get_referral_settings()
+    if not settings.enabled:
+        return None
 
-        conn = get_connection()
-        cursor = conn.cursor()
+    # Проверить минимальную сумму
+    if order_amount < settings['min_order_amount']:
+        return None
 
-        # Получить того, кто пригласил
+    # Получить того, кто пригласил
+    if referrer_id is None:
         cursor.execute('SELECT referred_by FROM users WHERE user_id = ?', (user_id,))
         result = cursor.fetchone()
+        referrer_id = result[0] if result else None
 
-        if not result or not result[0]:
-            conn.close()
-            return
+    if not referrer_id:
+        return None
 
-        referrer_id = result[0]
+    # Проверить, был ли уже начислен бонус (если настроено только за первый заказ)
+    if settings['reward_on_first_order_only']:
+        cursor.execute('''
+            SELECT COUNT(*) FROM referral_rewards
+            WHERE referred_user_id = ? AND status IN ('pending', 'approved')
+        ''', (user_id,))
 
-        # Проверить, был ли уже начислен бонус (если настроено только за первый заказ)
-        if settings['reward_on_first_order_only']:
-            cursor.execute('''
-                SELECT COUNT(*) FROM referral_rewards
-                WHERE referred_user_id = ? AND status IN ('pending', 'approved')
-            ''', (user_id,))
+        if cursor.fetchone()[0] > 0:
+            return None
 
-            if cursor.fetchone()[0] > 0:
-                conn.close()
-                return
+    # Рассчитать сумму награды
+    if settings['reward_type'] == 'fixed':
+        reward_amount = settings['reward_amount']
+    else:  # percent
+        reward_amount = int(order_amount * settings['reward_percent'] / 100)
+        if reward_amount > settings['max_reward_amount']:
+            reward_amount = settings['max_reward_amount']
 
-        # Рассчитать сумму награды
-        if settings['reward_type'] == 'fixed':
-            reward_amount = settings['reward_amount']
-        else:  # percent
-            reward_amount = int(order_amount * settings['reward_percent'] / 100)
-            if reward_amount > settings['max_reward_amount']:
-                reward_amount = settings['max_reward_amount']
+    status = 'approved' if settings['auto_approve'] else 'pending'
 
-        # Создать запись о награде
-        cursor.execute('''
-            INSERT INTO referral_rewards
-            (referrer_user_id, referred_user_id, reward_type, reward_amount,
-             trigger_order_id, trigger_order_amount, status)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-        ''', (
-            referrer_id, user_id, settings['reward_type'], reward_amount,
-            order_id, order_amount,
-            'approved' if settings['auto_approve'] else 'pending'
-        ))
+    # Создать запись о награде
+    cursor.execute('''
+        INSERT INTO referral_rewards
+        (referrer_user_id, referred_user_id, reward_type, reward_amount,
+         trigger_order_id, trigger_order_amount, status, paid_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, CASE WHEN ? THEN CURRENT_TIMESTAMP END)
+    ''', (
+        referrer_id, user_id, settings['reward_type'], reward_amount,
+        order_id, order_amount, status, settings['auto_approve']
+    ))
+
+    # Если автоматическое одобрение - начислить бонусы сразу
+    if settings['auto_approve']:
+        _credit_bonus(
+            cursor,
+            referrer_id,
+            reward_amount,
+            f"Реферальный бонус за приглашение пользователя (заказ #{order_id})"
+        )
+
+    return {'referrer_id': referrer_id, 'amount': reward_amount, 'status': status}
 
-        # Если автоматическое одобрение - начислить бонусы сразу
-        if settings['auto_approve']:
-            add_bonus_points(
-                referrer_id,
-                reward_amount,
-                f"Реферальный бонус за приглашение пользователя (заказ #{order_id})"
-            )
-            cursor.execute('''
-                UPDATE referral_rewards
-                SET paid_at = CURRENT_TIMESTAMP
-                WHERE referrer_user_id = ? AND referred_user_id = ? AND trigger_order_id = ?
-            ''', (referrer_id, user_id, order_id))
 
-        conn.commit()
-        conn.close()
+def check_and_award_referral_bonus(order_id: int, user_id: int, order_amount: int):
+    """
+    Проверить и начислить реферальный бонус.
+
+    Args:
+        order_id: ID заказа
+        user_id: ID пользователя, совершившего заказ
+        order_amount: Сумма заказа
+    """
+    try:
+        with transaction() as cursor:
+            reward = _award_referral_bonus(cursor, order_id, user_id, order_amount)
 
-        logger.info(f"Реферальный бонус {reward_amount} создан для пользователя {referrer_id}")
+        if reward:
+            logger.info(
+                f"Реферальный бонус {reward['amount']} создан для пользователя {reward['referrer_id']}"
+            )
 
     except Exception as e:
         logger.error(f"Ошибка проверки реферального бонуса: {e}")
@@ -4426,33 +5899,22 @@ def get_master_appointments(master_id: int, date: str):
 
     cursor.execute('''
         SELECT
-            id, user_id, user_name, phone, service_id, service_name,
-            appointment_date, time_slot, status, duration_minutes, price, comment
-        FROM salon_appointments
-        WHERE master_id = ? AND appointment_date = ?
-        ORDER BY time_slot
+            sa.id, sa.user_id, sa.user_name, sa.phone, sa.service_id, sa.service_name,
+            sa.appointment_date, sa.time_slot, sa.status,
+            COALESCE(sa.duration_minutes, 60) AS duration_minutes,
+            COALESCE(sa.price, 0) AS price, sa.comment,
+            sa.master_id, sa.master_name,
+            COALESCE(m.color, '#3498db') AS master_color
+        FROM salon_appointments sa
+        LEFT JOIN masters m ON sa.master_id = m.id
+        WHERE sa.master_id = ? AND sa.appointment_date = ?
+        ORDER BY sa.time_slot
     ''', (master_id, date))
 
-    rows = cursor.fetchall()
+    appointments = fetch_records(cursor, ScheduleAppointment)
     conn.close()
 
-    return [
-        {
-            'id': row[0],
-            'user_id': row[1],
-            'user_name': row[2],
-            'phone': row[3],
-            'service_id': row[4],
-            'service_name': row[5],
-            'appointment_date': row[6],
-            'time_slot': row[7],
-            'status': row[8],
-            'duration_minutes': row[9] or 60,
-            'price': row[10] or 0,
-            'comment': row[11]
-        }
-        for row in rows
-    ]
+    return appointments
 
 
 def get_all_appointments_by_date(date: str):
@@ -4464,38 +5926,21 @@ def get_all_appointments_by_date(date: str):
         SELECT
             sa.id, sa.user_id, sa.user_name, sa.phone,
             sa.service_id, sa.service_name, sa.appointment_date, sa.time_slot,
-            sa.status, sa.duration_minutes, sa.price, sa.comment,
+            sa.status,
+            COALESCE(sa.duration_minutes, 60) AS duration_minutes,
+            COALESCE(sa.price, 0) AS price, sa.comment,
             sa.master_id, sa.master_name,
-            m.color as master_color
+            COALESCE(m.color, '#3498db') AS master_color
         FROM salon_appointments sa
         LEFT JOIN masters m ON sa.master_id = m.id
         WHERE sa.appointment_date = ?
         ORDER BY sa.time_slot, sa.master_id
     ''', (date,))
 
-    rows = cursor.fetchall()
+    appointments = fetch_records(cursor, ScheduleAppointment)
     conn.close()
 
-    return [
-        {
-            'id': row[0],
-            'user_id': row[1],
-            'user_name': row[2],
-            'phone': row[3],
-            'service_id': row[4],
-            'service_name': row[5],
-            'appointment_date': row[6],
-            'time_slot': row[7],
-            'status': row[8],
-            'duration_minutes': row[9] or 60,
-            'price': row[10] or 0,
-            'comment': row[11],
-            'master_id': row[12],
-            'master_name': row[13],
-            'master_color': row[14] or '#3498db'
-        }
-        for row in rows
-    ]
+    return appointments
 
 
 def assign_master_to_appointment(appointment_id: int, master_id: int, send_notification: bool = False):
@@ -4954,6 +6399,553 @@ def get_user_payments(user_id: int, limit: int = 50) -> List[dict]:
         return []
 
 
+# =================================================================
+# АРХИВ ЗАКРЫТЫХ ЗАПИСЕЙ
+# =================================================================
+
+# Конечные статусы: такие записи больше не меняются и могут уйти в архив.
+# Заказ цветов завершается статусом delivered (см. update_flower_order_status),
+# completed - статус заказов, закрытых до появления доставки
+APPOINTMENT_CLOSED_STATUSES = ('completed', 'cancelled')
+FLOWER_ORDER_CLOSED_STATUSES = ('delivered', 'completed', 'cancelled')
+# Выполненные заказы (идут в выручку и конверсии) - закрытые без отмены
+FLOWER_ORDER_DONE_STATUSES = tuple(s for s in FLOWER_ORDER_CLOSED_STATUSES if s != 'cancelled')
+
+
+def _status_in(statuses: Tuple[str, ...]) -> str:
+    """Условие status IN (...) для набора статусов."""
+    return "status IN (" + ', '.join(f"'{status}'" for status in statuses) + ")"
+
+
+# Архивируемые таблицы: (столбец даты, условие закрытой строки или None,
+# индексы архивной копии). Позиции заказов переносятся вместе с заказом
+_ARCHIVE_TABLES = {
+    'salon_appointments': ('appointment_date', _status_in(APPOINTMENT_CLOSED_STATUSES), (
+        ('user_id', 'appointment_date', 'time_slot'),
+        ('user_id', 'status', 'appointment_date', 'time_slot'),
+        ('appointment_date',),
+        ('created_at',),
+    )),
+    'flower_orders': ('created_at', _status_in(FLOWER_ORDER_CLOSED_STATUSES), (
+        ('user_id', 'created_at'),
+        ('user_id', 'status', 'created_at'),
+        ('created_at',),
+    )),
+    'order_items': (None, None, (
+        ('order_id',),
+        ('product_id', 'created_at'),
+        ('created_at',),
+    )),
+    # Начисление, из которого ещё не всё потрачено, остаётся в рабочей
+    # таблице: на него ссылается открытый bonus_credits.transaction_id.
+    # У закрытых начислений (remaining = 0) ссылка может вести в архив -
+    # искать её нужно в loyalty_transactions_history
+    'loyalty_transactions': ('created_at', '''id NOT IN (
+        SELECT transaction_id FROM bonus_credits
+        WHERE remaining > 0 AND transaction_id IS NOT NULL
+    )''', (
+        ('user_id', 'created_at'),
+        ('created_at',),
+    )),
+    'notifications_log': ('sent_at', None, (
+        ('user_id', 'notification_type', 'sent_at'),
+        ('sent_at',),
+    )),
+    'consent_logs': ('consent_date', None, (
+        ('user_id', 'consent_date'),
+        ('consent_date',),
+    )),
+}
+
+
+def archive_path(db_path: str) -> str:
+    """Путь к файлу архива рядом с рабочей БД: data/beauty_salon.db -> data/beauty_salon_archive.db."""
+    root, ext = os.path.splitext(db_path)
+    return f"{root}_archive{ext or '.db'}"
+
+
+def _table_columns(cursor, schema: str, table: str) -> List[Tuple]:
+    """Столбцы таблицы (PRAGMA table_info) в схеме main или archive."""
+    return cursor.execute(f'PRAGMA {schema}.table_info({table})').fetchall()
+
+
+def _ensure_archive_schema(cursor):
+    """
+    Создать недостающие таблицы, столбцы и индексы архива (без commit).
+
+    Пишет в файл архива, поэтому вызывается только из архивации, а не
+    из чтения. Таблицы архива повторяют рабочие (с первичным ключом),
+    новые столбцы рабочих таблиц добавляются при следующем запуске.
+    """
+    for table, (_, _, indexes) in _ARCHIVE_TABLES.items():
+        columns = _table_columns(cursor, 'main', table)
+        if not columns:
+            # Миграции ещё не применены
+            return
+
+        archived = {row[1] for row in _table_columns(cursor, 'archive', table)}
+        if not archived:
+            definitions = ', '.join(
+                f'{name} {col_type} PRIMARY KEY' if pk else f'{name} {col_type}'
+                for _, name, col_type, _, _, pk in columns
+            )
+            cursor.execute(f'CREATE TABLE archive.{table} ({definitions})')
+        else:
+            for _, name, col_type, _, _, _ in columns:
+                if name not in archived:
+                    cursor.execute(f'ALTER TABLE archive.{table} ADD COLUMN {name} {col_type}')
+
+        for index in indexes:
+            cursor.execute(f'''
+                CREATE INDEX IF NOT EXISTS archive.idx_{table}_{'_'.join(index)}
+                ON {table}({', '.join(index)})
+            ''')
+
+
+def _ensure_history(cursor):
+    """
+    Подготовить соединение к чтению истории (без commit).
+
+    Создаёт временные представления <таблица>_history - UNION ALL рабочей
+    таблицы и её архивной копии. Пишутся только объекты схемы temp этого
+    соединения: ни рабочая БД, ни архив не блокируются. Представления
+    строятся по текущей схеме архива (нет таблицы - только рабочая
+    таблица, нет столбца - NULL) и пересобираются, когда архивация
+    меняет её или миграции меняют рабочие таблицы (PRAGMA schema_version).
+    """
+    version = '{}.{}'.format(
+        cursor.execute('PRAGMA main.schema_version').fetchone()[0],
+        cursor.execute('PRAGMA archive.schema_version').fetchone()[0],
+    )
+    built = cursor.execute(
+        "SELECT sql FROM temp.sqlite_master WHERE type = 'view' AND name = 'history_schema'"
+    ).fetchone()
+    if built and built[0].endswith(f"SELECT '{version}' AS version"):
+        return
+
+    views = {}
+    for table in _ARCHIVE_TABLES:
+        columns = [row[1] for row in _table_columns(cursor, 'main', table)]
+        if not columns:
+            # Миграции ещё не применены
+            return
+
+        names = ', '.join(columns)
+        query = f'SELECT {names} FROM main.{table}'
+        archived = {row[1] for row in _table_columns(cursor, 'archive', table)}
+        if archived:
+            archived_names = ', '.join(name if name in archived else f'NULL AS {name}' for name in columns)
+            query += f' UNION ALL SELECT {archived_names} FROM archive.{table}'
+        views[table] = query
+
+    for table, query in views.items():
+        cursor.execute(f'DROP VIEW IF EXISTS temp.{table}_history')
+        cursor.execute(f'CREATE TEMP VIEW {table}_history AS {query}')
+    cursor.execute('DROP VIEW IF EXISTS temp.history_schema')
+    cursor.execute(f"CREATE TEMP VIEW history_schema AS SELECT '{version}' AS version")
+
+
+def _move_to_archive(table: str, where: str, params: tuple, children: Tuple[str, ...] = ()) -> int:
+    """
+    Перенести строки таблицы в архив пачками по ARCHIVE_BATCH_SIZE.
+
+    Рабочая БД в режиме WAL, поэтому транзакция с двумя файлами не
+    атомарна. Пачка сначала копируется в архив, затем отдельной
+    транзакцией удаляется из рабочей БД. После сбоя между шагами строки
+    временно видны в *_history дважды; следующий запуск копирует их
+    без дублей (INSERT OR IGNORE) и удаляет.
+
+    Args:
+        table: Таблица
+        where: Условие отбора строк
+        params: Параметры условия
+        children: Таблицы с order_id, строки которых переносятся вместе с родительской
+
+    Returns:
+        int: Количество перенесённых строк
+    """
+    moved = 0
+    while True:
+        with transaction() as cursor:
+            cursor.execute(f'SELECT id FROM main.{table} WHERE {where} LIMIT ?', (*params, ARCHIVE_BATCH_SIZE))
+            batch = json.dumps([row[0] for row in cursor.fetchall()])
+            if batch == '[]':
+                break
+
+            for target, key in ((table, 'id'),) + tuple((child, 'order_id') for child in children):
+                names = ', '.join(row[1] for row in _table_columns(cursor, 'main', target))
+                cursor.execute(f'''
+                    INSERT OR IGNORE INTO archive.{target} ({names})
+                    SELECT {names} FROM main.{target}
+                    WHERE {key} IN (SELECT value FROM json_each(?))
+                ''', (batch,))
+
+        with transaction() as cursor:
+            for target, key in tuple((child, 'order_id') for child in children) + ((table, 'id'),):
+                cursor.execute(
+                    f'DELETE FROM main.{target} WHERE {key} IN (SELECT value FROM json_each(?))', (batch,)
+                )
+            moved += cursor.rowcount
+
+    return moved
+
+
+def archive_old_records(days: int = ARCHIVE_AFTER_DAYS) -> dict:
+    """
+    Перенести старые закрытые записи в архив (файл archive_path(DB_PATH)).
+
+    Записи в салон и заказы цветов - в конечном статусе
+    (APPOINTMENT_CLOSED_STATUSES, FLOWER_ORDER_CLOSED_STATUSES) старше
+    горизонта (заказы вместе с позициями), журналы бонусов (кроме
+    начислений с непотраченным остатком), уведомлений и согласий - все
+    старше горизонта. История пользователя читается
+    через представления *_history и не меняется; роллапы статистики
+    пересчитываются по тем же представлениям.
+
+    Args:
+        days: Горизонт в днях
+
+    Returns:
+        dict: {таблица: перенесено строк}
+    """
+    cutoff = (datetime.now() - timedelta(days=days)).strftime('%Y-%m-%d')
+    moved = {}
+    try:
+        with transaction() as cursor:
+            _ensure_archive_schema(cursor)
+
+        for table, (date_column, closed, _) in _ARCHIVE_TABLES.items():
+            if date_column is None:
+                continue
+            where = f'{date_column} < ?' + (f' AND {closed}' if closed else '')
+            children = ('order_items',) if table == 'flower_orders' else ()
+            moved[table] = _move_to_archive(table, where, (cutoff,), children)
+
+        logger.info(f"Архивация записей старше {cutoff}: {moved}")
+        return moved
+
+    except Exception as e:
+        logger.error(f"Ошибка архивации записей: {e}")
+        return moved
+
+
+# =================================================================
+# РОЛЛАПЫ СТАТИСТИКИ
+# =================================================================
+
+# Даты событий, по которым строятся роллапы: (таблица, столбец).
+# Архивируемые таблицы читаются через *_history: перенос строк в архив
+# помечает их дни устаревшими, а пересчёт даёт те же значения
+_STATS_EVENT_DATES = (
+    ('users', 'registration_date'),
+    ('flower_orders_history', 'created_at'),
+    ('salon_appointments_history', 'appointment_date'),
+    ('salon_appointments_history', 'created_at'),
+    ('certificates', 'purchase_date'),
+    ('user_subscriptions', 'created_at'),
+    ('subscription_usage', 'used_at'),
+    ('loyalty_transactions_history', 'created_at'),
+)
+
+# Час визита в салон: дата записи + час слота ('YYYY-MM-DD HH')
+_APPOINTMENT_HOUR_SQL = "appointment_date || ' ' || COALESCE(substr(time_slot, 1, 2), '00')"
+
+# Завершённые заказы и визиты с клиентом - для выручки по каналу привлечения
+_CHANNEL_EVENTS_SQL = f'''
+    SELECT substr(created_at, 1, 13) AS hour, user_id, COALESCE(total_amount, 0) AS amount
+    FROM flower_orders_history
+    WHERE created_at >= :start AND created_at < :end AND {_status_in(FLOWER_ORDER_DONE_STATUSES)}
+    UNION ALL
+    SELECT {_APPOINTMENT_HOUR_SQL}, user_id, COALESCE(price, 0)
+    FROM salon_appointments_history
+    WHERE appointment_date >= :start AND appointment_date < :end AND status = 'completed'
+'''
+
+# Пересчёт дня: каждый запрос возвращает (час, метрика, значение) для событий
+# в диапазоне [:start, :end). Условия по дате - диапазоны по индексам
+_STATS_HOURLY_QUERIES = (
+    # Регистрации: всего, по реферальным ссылкам, по каналам привлечения
+    '''SELECT substr(registration_date, 1, 13), 'users.new', COUNT(*)
+       FROM users
+       WHERE registration_date >= :start AND registration_date < :end
+       GROUP BY 1''',
+    '''SELECT substr(registration_date, 1, 13), 'users.referral', COUNT(*)
+       FROM users
+       WHERE registration_date >= :start AND registration_date < :end AND referred_by IS NOT NULL
+       GROUP BY 1''',
+    '''SELECT substr(registration_date, 1, 13), 'users.source.' || COALESCE(source_type, 'organic'), COUNT(*)
+       FROM users
+       WHERE registration_date >= :start AND registration_date < :end
+       GROUP BY 1, 2''',
+
+    # Заказы цветов и их сумма по статусам
+    '''SELECT substr(created_at, 1, 13), 'flowers.orders.' || COALESCE(status, 'unknown'), COUNT(*)
+       FROM flower_orders_history
+       WHERE created_at >= :start AND created_at < :end
+       GROUP BY 1, 2''',
+    '''SELECT substr(created_at, 1, 13), 'flowers.revenue.' || COALESCE(status, 'unknown'),
+              COALESCE(SUM(total_amount), 0)
+       FROM flower_orders_history
+       WHERE created_at >= :start AND created_at < :end
+       GROUP BY 1, 2''',
+
+    # Записи в салон и их сумма по статусам (по дате визита)
+    f'''SELECT {_APPOINTMENT_HOUR_SQL}, 'salon.appointments.' || COALESCE(status, 'unknown'), COUNT(*)
+        FROM salon_appointments_history
+        WHERE appointment_date >= :start AND appointment_date < :end
+        GROUP BY 1, 2''',
+    f'''SELECT {_APPOINTMENT_HOUR_SQL}, 'salon.revenue.' || COALESCE(status, 'unknown'),
+               COALESCE(SUM(price), 0)
+        FROM salon_appointments_history
+        WHERE appointment_date >= :start AND appointment_date < :end
+        GROUP BY 1, 2''',
+
+    # Конверсии и выручка по каналу привлечения клиента
+    f'''SELECT e.hour, 'channel.conversions.' || COALESCE(u.source_type, 'organic'), COUNT(*)
+        FROM ({_CHANNEL_EVENTS_SQL}) e
+        LEFT JOIN users u ON u.user_id = e.user_id
+        GROUP BY 1, 2''',
+    f'''SELECT e.hour, 'channel.revenue.' || COALESCE(u.source_type, 'organic'), SUM(e.amount)
+        FROM ({_CHANNEL_EVENTS_SQL}) e
+        LEFT JOIN users u ON u.user_id = e.user_id
+        GROUP BY 1, 2''',
+
+    # Сертификаты
+    '''SELECT substr(purchase_date, 1, 13), 'certificates.sold', COUNT(*)
+       FROM certificates
+       WHERE purchase_date >= :start AND purchase_date < :end
+       GROUP BY 1''',
+    '''SELECT substr(purchase_date, 1, 13), 'certificates.revenue', COALESCE(SUM(amount), 0)
+       FROM certificates
+       WHERE purchase_date >= :start AND purchase_date < :end
+       GROUP BY 1''',
+
+    # Подписки: новые по тарифам, выручка, использование привилегий
+    '''SELECT substr(us.created_at, 1, 13), 'subscriptions.new.' || COALESCE(sp.name, us.plan_id), COUNT(*)
+       FROM user_subscriptions us
+       LEFT JOIN subscription_plans sp ON sp.id = us.plan_id
+       WHERE us.created_at >= :start AND us.created_at < :end
+       GROUP BY 1, 2''',
+    '''SELECT substr(created_at, 1, 13), 'subscriptions.revenue', COALESCE(SUM(payment_amount), 0)
+       FROM user_subscriptions
+       WHERE created_at >= :start AND created_at < :end
+       GROUP BY 1''',
+    '''SELECT substr(used_at, 1, 13), 'subscriptions.usage.' || COALESCE(usage_type, 'unknown'), COUNT(*)
+       FROM subscription_usage
+       WHERE used_at >= :start AND used_at < :end
+       GROUP BY 1, 2''',
+
+    # Бонусы: начислено, потрачено, сгорело (см. expire_old_bonuses), реферальные
+    '''SELECT substr(created_at, 1, 13),
+              CASE
+                  WHEN points > 0 THEN 'bonuses.earned'
+                  WHEN description = 'Списание просроченных бонусов' THEN 'bonuses.expired'
+                  ELSE 'bonuses.spent'
+              END,
+              SUM(ABS(points))
+       FROM loyalty_transactions_history
+       WHERE created_at >= :start AND created_at < :end AND points != 0
+       GROUP BY 1, 2''',
+    '''SELECT substr(created_at, 1, 13), 'bonuses.referral', SUM(points)
+       FROM loyalty_transactions_history
+       WHERE created_at >= :start AND created_at < :end AND points > 0
+         AND description LIKE 'Реферальн%'
+       GROUP BY 1''',
+)
+
+# Метрики только за день (не складываются из часов)
+_STATS_DAILY_QUERIES = (
+    # Активные пользователи: записались, заказали или получили/потратили бонусы
+    '''SELECT 'users.active', COUNT(DISTINCT user_id) FROM (
+           SELECT user_id FROM salon_appointments_history WHERE created_at >= :start AND created_at < :end
+           UNION ALL
+           SELECT user_id FROM flower_orders_history WHERE created_at >= :start AND created_at < :end
+           UNION ALL
+           SELECT user_id FROM loyalty_transactions_history WHERE created_at >= :start AND created_at < :end
+       )''',
+)
+
+
+def _rebuild_stats_day(cursor, day: str) -> bool:
+    """
+    Пересчитать роллапы одного дня в текущей транзакции (без commit).
+
+    Returns:
+        bool: False если строка не является датой YYYY-MM-DD
+    """
+    try:
+        end = (datetime.strptime(day, '%Y-%m-%d') + timedelta(days=1)).strftime('%Y-%m-%d')
+    except (TypeError, ValueError):
+        logger.warning(f"Пропущен день статистики с неверной датой: {day!r}")
+        return False
+
+    _ensure_history(cursor)
+    params = {'start': day, 'end': end}
+    cursor.execute('DELETE FROM stats_hourly WHERE hour >= :start AND hour < :end', params)
+    cursor.execute('DELETE FROM stats_daily WHERE day = :start', params)
+
+    for query in _STATS_HOURLY_QUERIES:
+        cursor.execute(f'INSERT INTO stats_hourly (hour, metric, value) {query}', params)
+
+    cursor.execute('''
+        INSERT INTO stats_daily (day, metric, value)
+        SELECT :start, metric, SUM(value)
+        FROM stats_hourly
+        WHERE hour >= :start AND hour < :end
+        GROUP BY metric
+    ''', params)
+    for query in _STATS_DAILY_QUERIES:
+        cursor.execute(f'INSERT INTO stats_daily (day, metric, value) SELECT :start, * FROM ({query})', params)
+
+    return True
+
+
+def refresh_stats_rollups() -> int:
+    """
+    Пересчитать роллапы дней, помеченных устаревшими.
+
+    Триггеры исходных таблиц помечают день события в stats_dirty при
+    каждой записи; здесь эти дни пересчитываются целиком пачками по
+    STATS_REFRESH_BATCH_DAYS дней на транзакцию. Вызывается отчётами
+    перед чтением роллапов, повторный вызов без новых записей ничего не делает.
+
+    Returns:
+        int: Количество пересчитанных дней
+    """
+    refreshed = 0
+    try:
+        while True:
+            with transaction() as cursor:
+                cursor.execute(
+                    'SELECT day FROM stats_dirty ORDER BY day LIMIT ?', (STATS_REFRESH_BATCH_DAYS,)
+                )
+                days = [row[0] for row in cursor.fetchall()]
+                for day in days:
+                    _rebuild_stats_day(cursor, day)
+                cursor.executemany('DELETE FROM stats_dirty WHERE day = ?', [(day,) for day in days])
+
+            refreshed += len(days)
+            if len(days) < STATS_REFRESH_BATCH_DAYS:
+                break
+
+        if refreshed:
+            logger.info(f"Роллапы статистики пересчитаны за {refreshed} дн.")
+        return refreshed
+
+    except Exception as e:
+        logger.error(f"Ошибка пересчёта роллапов статистики: {e}")
+        return refreshed
+
+
+def rebuild_stats_rollups(since: Optional[str] = None) -> int:
+    """
+    Перестроить роллапы из истории (бэкфилл).
+
+    Args:
+        since: Первый день перестроения YYYY-MM-DD (None - вся история)
+
+    Returns:
+        int: Количество пересчитанных дней
+    """
+    try:
+        start = since or ''
+        with transaction() as cursor:
+            _ensure_history(cursor)
+            cursor.execute('DELETE FROM stats_hourly WHERE hour >= ?', (start,))
+            cursor.execute('DELETE FROM stats_daily WHERE day >= ?', (start,))
+            for table, column in _STATS_EVENT_DATES:
+                cursor.execute(f'''
+                    INSERT OR IGNORE INTO stats_dirty (day)
+                    SELECT DISTINCT substr({column}, 1, 10) FROM {table}
+                    WHERE {column} >= ?
+                ''', (start,))
+
+    except Exception as e:
+        logger.error(f"Ошибка подготовки перестроения роллапов статистики: {e}")
+        return 0
+
+    return refresh_stats_rollups()
+
+
+def get_daily_stats(first_day, last_day=None) -> Dict[str, Dict[str, int]]:
+    """
+    Получить дневные роллапы.
+
+    Args:
+        first_day: Первый день (date или YYYY-MM-DD)
+        last_day: Последний день включительно (None - только first_day)
+
+    Returns:
+        dict: {день: {метрика: значение}}; дни без событий отсутствуют
+    """
+    try:
+        conn = get_connection()
+        try:
+            rows = conn.execute('''
+                SELECT day, metric, value FROM stats_daily
+                WHERE day >= ? AND day <= ?
+            ''', (str(first_day), str(last_day or first_day))).fetchall()
+        finally:
+            conn.close()
+
+        stats = {}
+        for day, metric, value in rows:
+            stats.setdefault(day, {})[metric] = value
+        return stats
+
+    except Exception as e:
+        logger.error(f"Ошибка получения дневной статистики: {e}")
+        return {}
+
+
+def get_hourly_stats(first_hour: str, last_hour: Optional[str] = None) -> Dict[str, int]:
+    """
+    Получить сумму почасовых роллапов за интервал часов.
+
+    Args:
+        first_hour: Первый час 'YYYY-MM-DD HH'
+        last_hour: Последний час включительно (None - только first_hour)
+
+    Returns:
+        dict: {метрика: значение}
+    """
+    try:
+        conn = get_connection()
+        try:
+            return dict(conn.execute('''
+                SELECT metric, SUM(value) FROM stats_hourly
+                WHERE hour >= ? AND hour <= ?
+                GROUP BY metric
+            ''', (first_hour, last_hour or first_hour)).fetchall())
+        finally:
+            conn.close()
+
+    except Exception as e:
+        logger.error(f"Ошибка получения почасовой статистики: {e}")
+        return {}
+
+
+def group_stats(metrics: Dict[str, int], prefix: str) -> Dict[str, int]:
+    """
+    Выбрать метрики с общим префиксом.
+
+    Пример: group_stats(m, 'flowers.orders') -> {'new': 3, 'completed': 5}
+
+    Args:
+        metrics: {метрика: значение}
+        prefix: Префикс без завершающей точки
+
+    Returns:
+        dict: {остаток имени: значение}
+    """
+    prefix += '.'
+    return {
+        metric[len(prefix):]: value
+        for metric, value in metrics.items()
+        if metric.startswith(prefix)
+    }
+
+
 # Инициализировать БД при импорте модуля
-if __name__ != "__main__":
+if __name__ != "__main__" and DB_AUTO_MIGRATE:
     init_db()
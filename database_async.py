@@ -0,0 +1,166 @@
+"""
+Асинхронный доступ к базе данных для обработчиков бота.
+
+Функции database.py блокирующие: вызванные прямо из async-обработчика,
+они останавливают event loop, и один медленный запрос задерживает
+обновления всех пользователей. Здесь те же функции выполняются
+в ограниченном пуле потоков и возвращают awaitable.
+
+Использование:
+    from database_async import get_user, run_db
+    user = await get_user(user_id)
+    pricing = await run_db(get_pricing_profile, user_id)
+"""
+
+import asyncio
+import functools
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+import database
+from config import DB_EXECUTOR_WORKERS
+
+logger = logging.getLogger(__name__)
+
+_executor: Optional[ThreadPoolExecutor] = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    """Получить (или создать) пул потоков для запросов к БД."""
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=DB_EXECUTOR_WORKERS,
+                    thread_name_prefix="db"
+                )
+    return _executor
+
+
+async def run_db(func, *args, **kwargs):
+    """
+    Выполнить блокирующую функцию работы с БД в пуле потоков.
+
+    Args:
+        func: Синхронная функция (из database.py или utils)
+        *args: Позиционные аргументы функции
+        **kwargs: Именованные аргументы функции
+
+    Returns:
+        Результат func(*args, **kwargs)
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        _get_executor(), functools.partial(func, *args, **kwargs)
+    )
+
+
+def _to_async(func):
+    """Сделать awaitable-версию синхронной функции БД."""
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        return await run_db(func, *args, **kwargs)
+    return wrapper
+
+
+async def shutdown_db(application=None):
+    """
+    Дождаться завершения запросов и остановить пул потоков.
+    Подходит для Application.builder().post_shutdown().
+
+    Args:
+        application: Приложение бота (не используется)
+    """
+    global _executor
+    with _executor_lock:
+        executor, _executor = _executor, None
+    if executor is not None:
+        await asyncio.get_running_loop().run_in_executor(
+            None, functools.partial(executor.shutdown, wait=True)
+        )
+    database.close_pool()
+    logger.info("Пул потоков БД остановлен")
+
+
+# =================================================================
+# ПОЛЬЗОВАТЕЛИ И ПРОФИЛЬ
+# =================================================================
+
+register_user = _to_async(database.register_user)
+get_user = _to_async(database.get_user)
+update_user_phone = _to_async(database.update_user_phone)
+update_user_profile = _to_async(database.update_user_profile)
+is_profile_filled = _to_async(database.is_profile_filled)
+get_profile_snapshot = _to_async(database.get_profile_snapshot)
+count_referrals = _to_async(database.count_referrals)
+log_consent = _to_async(database.log_consent)
+
+# =================================================================
+# АДРЕСА
+# =================================================================
+
+get_addresses = _to_async(database.get_addresses)
+add_address = _to_async(database.add_address)
+set_default_address = _to_async(database.set_default_address)
+delete_address = _to_async(database.delete_address)
+
+# =================================================================
+# БОНУСЫ
+# =================================================================
+
+get_bonus_balance = _to_async(database.get_bonus_balance)
+add_bonus_points = _to_async(database.add_bonus_points)
+subtract_bonus_points = _to_async(database.subtract_bonus_points)
+get_available_bonus = _to_async(database.get_available_bonus)
+hold_bonus_points = _to_async(database.hold_bonus_points)
+release_bonus_hold = _to_async(database.release_bonus_hold)
+get_loyalty_transactions = _to_async(database.get_loyalty_transactions)
+get_expiring_bonuses = _to_async(database.get_expiring_bonuses)
+
+# =================================================================
+# КАТАЛОГ
+# =================================================================
+
+get_service_categories = _to_async(database.get_service_categories)
+get_services = _to_async(database.get_services)
+get_service_by_id = _to_async(database.get_service_by_id)
+get_product_categories = _to_async(database.get_product_categories)
+get_products = _to_async(database.get_products)
+get_product_by_id = _to_async(database.get_product_by_id)
+
+# =================================================================
+# ЗАПИСИ И ЗАКАЗЫ
+# =================================================================
+
+add_salon_appointment = _to_async(database.add_salon_appointment)
+get_salon_appointments = _to_async(database.get_salon_appointments)
+add_flower_order = _to_async(database.add_flower_order)
+get_flower_orders = _to_async(database.get_flower_orders)
+checkout_flower_order = _to_async(database.checkout_flower_order)
+
+# =================================================================
+# ОБРАТНАЯ СВЯЗЬ, РЕФЕРАЛЫ, UTM, ПОДПИСКИ
+# =================================================================
+
+schedule_feedback_request = _to_async(database.schedule_feedback_request)
+check_and_award_referral_bonus = _to_async(database.check_and_award_referral_bonus)
+update_utm_campaign_stats = _to_async(database.update_utm_campaign_stats)
+get_user_active_subscription = _to_async(database.get_user_active_subscription)
+
+# =================================================================
+# АДМИН-ПАНЕЛЬ (ПОСТРАНИЧНЫЕ СПИСКИ)
+# =================================================================
+
+get_salon_appointments_page = _to_async(database.get_salon_appointments_page)
+get_flower_orders_page = _to_async(database.get_flower_orders_page)
+get_reviews_page = _to_async(database.get_reviews_page)
+get_salon_appointment_status_counts = _to_async(database.get_salon_appointment_status_counts)
+get_flower_order_status_counts = _to_async(database.get_flower_order_status_counts)
+get_user_appointments_by_status = _to_async(database.get_user_appointments_by_status)
+get_user_flower_orders_by_status = _to_async(database.get_user_flower_orders_by_status)
+get_review_rating_counts = _to_async(database.get_review_rating_counts)
+search_users = _to_async(database.search_users)
@@ -0,0 +1,271 @@
+"""
+Аудит планов запросов.
+
+Извлекает SQL-литералы из модулей (по умолчанию database.py), выполняет
+для каждого EXPLAIN QUERY PLAN на свежей схеме (все миграции) и помечает
+полные сканирования таблиц и временные B-деревья для сортировки.
+Фрагменты, которые достраивают хелперы (_keyset_page и т.п.),
+проверяются в собранном виде.
+
+Запуск:
+    python explain_audit.py                  # database.py
+    python explain_audit.py alerts.py --all  # показать и запросы без замечаний
+
+Код возврата 1, если найдены полные сканирования больших таблиц.
+"""
+
+import os
+import re
+import ast
+import sys
+import argparse
+import tempfile
+from typing import List, Optional, Tuple
+
+# Аудит работает на временной БД, рабочую не трогаем
+os.environ.setdefault("DB_AUTO_MIGRATE", "0")
+
+import database
+from migrations import apply_migrations
+
+# Таблицы-справочники на единицы строк: их сканирование не считается проблемой
+SMALL_TABLES = {
+    'bonus_settings', 'referral_settings', 'feedback_settings',
+    'subscription_plans', 'masters', 'schema_migrations', 'sqlite_master', 'change_log',
+    'stats_dirty',
+    # Каталог (десятки позиций, ведёт администратор): читается целиком в
+    # снимок каталога, категории считаются по нему же
+    'services', 'products', 'gallery',
+    # Рекламные кампании заводит администратор, их единицы-десятки
+    'utm_campaigns',
+}
+
+# Запросы, которым по смыслу нужна вся таблица (отчёты и обслуживание):
+# индекс не сократит проход, сканирование выводится только с --all
+FULL_PASS_QUERIES = {
+    'get_reviews': 'весь список отзывов',
+    'get_review_rating_counts': 'распределение всех отзывов по оценкам',
+    'get_user_acquisition_sources': 'отчёт по источникам всех пользователей',
+    'get_subscription_stats': 'отчёт по всем активным подпискам',
+    'reset_monthly_benefits': 'ежемесячный сброс лимитов всех подписок',
+    'update_bonus_settings': 'новый срок для всех открытых начислений',
+}
+
+SQL_START = re.compile(r'^\s*(SELECT|UPDATE|DELETE|INSERT|WITH)\b', re.IGNORECASE)
+NAMED_PARAM_RE = re.compile(r"(?<![\w:']):([A-Za-z_]\w*)")
+SCAN_RE = re.compile(r'^SCAN (?:TABLE )?(?:\w+\.)?(\w+)(?: AS \w+)?(.*)$')
+VIRTUAL_INDEX_RE = re.compile(r'VIRTUAL TABLE INDEX (\d+):(\S*)')
+LIMIT_RE = re.compile(r'\bLIMIT\b', re.IGNORECASE)
+# База динамического запроса: условия дописываются к "WHERE 1=1" при вызове
+OPEN_WHERE_RE = re.compile(r'\bWHERE\s+1\s*=\s*1\s*$', re.IGNORECASE)
+
+# Хелперы, собирающие запрос из фрагмента "SELECT ... FROM ..." (без WHERE).
+# Сам фрагмент не проверяется: объясняется запрос в том виде, в каком его
+# собирает хелпер (аргументы - номера позиционных аргументов вызова)
+FRAGMENT_BUILDERS = {
+    # _keyset_page(select_sql, where, params, order_col, id_col, ...): страница по курсору
+    '_keyset_page': (
+        (0, 3, 4),
+        '{0} WHERE ({1}, {2}) < (?, ?) ORDER BY {1} DESC, {2} DESC LIMIT ?',
+    ),
+    # _user_rows_by_status(select_sql, order_sql, ...): строки пользователя по статусу
+    '_user_rows_by_status': (
+        (0, 1),
+        '{0} WHERE user_id = ? AND status = ? ORDER BY {1} LIMIT ?',
+    ),
+}
+
+
+def extract_queries(path: str) -> List[Tuple[int, str, str]]:
+    """
+    Найти SQL-литералы в исходном файле.
+
+    Args:
+        path: Путь к .py файлу
+
+    Returns:
+        List[Tuple[int, str, str]]: Список (строка, функция, SQL)
+    """
+    with open(path, encoding='utf-8') as f:
+        tree = ast.parse(f.read(), filename=path)
+
+    queries = []
+    fragments = set()
+
+    def assemble(call, func_name):
+        builder = FRAGMENT_BUILDERS.get(getattr(call.func, 'id', None))
+        if not builder:
+            return
+        positions, template = builder
+        parts = []
+        for position in positions:
+            arg = call.args[position] if position < len(call.args) else None
+            if not (isinstance(arg, ast.Constant) and isinstance(arg.value, str)):
+                return
+            parts.append(arg.value)
+        fragments.add(id(call.args[0]))
+        queries.append((call.args[0].lineno, func_name, template.format(*parts)))
+
+    def visit(node, func_name):
+        for child in ast.iter_child_nodes(node):
+            name = func_name
+            if isinstance(child, (ast.FunctionDef, ast.AsyncFunctionDef)):
+                name = child.name
+            if isinstance(child, ast.Call):
+                assemble(child, name)
+            if (isinstance(child, ast.Constant) and isinstance(child.value, str)
+                    and SQL_START.match(child.value) and id(child) not in fragments):
+                queries.append((child.lineno, name, child.value))
+            visit(child, name)
+
+    visit(tree, '<module>')
+    return queries
+
+
+def explain(conn, sql: str) -> List[str]:
+    """
+    Получить план запроса.
+
+    Args:
+        conn: Соединение с БД
+        sql: Текст запроса с плейсхолдерами ? или :имя
+
+    Returns:
+        List[str]: Строки плана (поле detail)
+    """
+    named = NAMED_PARAM_RE.findall(sql)
+    params = dict.fromkeys(named) if named else (None,) * sql.count('?')
+    rows = conn.execute(f"EXPLAIN QUERY PLAN {sql}", params).fetchall()
+    return [row[-1] for row in rows]
+
+
+def classify(plan: List[str], sql: str = '') -> List[str]:
+    """
+    Найти проблемные шаги плана.
+
+    Args:
+        plan: Строки плана
+        sql: Текст запроса (для проверки LIMIT)
+
+    Returns:
+        List[str]: Замечания (пустой список - всё в порядке)
+    """
+    # Проход по индексу в порядке ORDER BY останавливается на LIMIT
+    limited = LIMIT_RE.search(sql) and not any('TEMP B-TREE FOR ORDER BY' in d for d in plan)
+
+    issues = []
+    for detail in plan:
+        match = SCAN_RE.match(detail)
+        if match:
+            table, rest = match.group(1), match.group(2)
+            if table in SMALL_TABLES:
+                continue
+            if table.endswith('_history'):
+                # Обход UNION ALL представления: части плана с условиями проверяются отдельно
+                continue
+            virtual = VIRTUAL_INDEX_RE.search(rest)
+            if virtual and (virtual.group(1) != '0' or virtual.group(2)):
+                # Виртуальная таблица (FTS5) с ограничением, например MATCH:
+                # поиск идёт по её собственному индексу
+                continue
+            if limited and 'USING' in rest and 'INDEX' in rest:
+                continue
+            if 'COVERING INDEX' in rest:
+                issues.append(f"полный проход по индексу: {detail}")
+            else:
+                issues.append(f"полное сканирование: {detail}")
+        elif 'USE TEMP B-TREE' in detail:
+            issues.append(f"сортировка без индекса: {detail}")
+    return issues
+
+
+def run_audit(paths: List[str], show_all: bool = False) -> int:
+    """
+    Выполнить аудит и вывести отчёт.
+
+    Args:
+        paths: Файлы для проверки
+        show_all: Показывать запросы без замечаний
+
+    Returns:
+        int: Количество запросов с полным сканированием
+    """
+    tmpdir = tempfile.mkdtemp(prefix="explain_audit_")
+    database.DB_PATH = os.path.join(tmpdir, "audit.db")
+    apply_migrations()
+
+    conn = database.get_connection()
+    # Таблицы архива создаёт архивация; представления истории (*_history)
+    # живут в temp-схеме соединения
+    database._ensure_archive_schema(conn)
+    conn.commit()
+    database._ensure_history(conn)
+    checked = 0
+    flagged = 0
+    failed = 0
+    skipped = 0
+
+    try:
+        for path in paths:
+            for lineno, func_name, sql in extract_queries(path):
+                checked += 1
+                location = f"{os.path.basename(path)}:{lineno} {func_name}()"
+                if OPEN_WHERE_RE.search(sql.strip()):
+                    # Без дописанных условий план ничего не говорит о запросе
+                    skipped += 1
+                    if show_all:
+                        print(f"⏭️  {location}: основа динамического запроса (WHERE 1=1)")
+                    continue
+                try:
+                    plan = explain(conn, sql)
+                except Exception as e:
+                    # Фрагменты динамических запросов и запросы к несуществующим столбцам
+                    failed += 1
+                    print(f"⚠️  {location}: не удалось разобрать ({e})")
+                    continue
+
+                issues = classify(plan, sql)
+                if any(issue.startswith("полное сканирование") for issue in issues):
+                    if func_name in FULL_PASS_QUERIES:
+                        if show_all:
+                            print(f"ℹ️  {location}: полный проход - {FULL_PASS_QUERIES[func_name]}")
+                        continue
+                    flagged += 1
+
+                if issues:
+                    print(f"❌ {location}")
+                    for issue in issues:
+                        print(f"     {issue}")
+                elif show_all:
+                    print(f"✅ {location}")
+    finally:
+        conn.close()
+        database.close_pool()
+
+    print()
+    print(f"Проверено запросов: {checked}, со сканированием: {flagged}, "
+          f"не разобрано: {failed}, основ динамических запросов: {skipped}")
+    return flagged
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    """
+    Точка входа CLI.
+
+    Args:
+        argv: Аргументы командной строки
+
+    Returns:
+        int: Код возврата
+    """
+    parser = argparse.ArgumentParser(description="EXPLAIN QUERY PLAN для запросов проекта")
+    parser.add_argument("paths", nargs="*", default=["database.py"], help="файлы для проверки")
+    parser.add_argument("--all", action="store_true", help="показывать и запросы без замечаний")
+    args = parser.parse_args(argv)
+
+    flagged = run_audit(args.paths, show_all=args.all)
+    return 1 if flagged else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,6 +1,8 @@
 """
 Планировщик автоматических запросов отзывов.
-Отправляет запросы на отзывы клиентам через заданное время после заказа.
+Отправляет запросы на отзывы клиентам через заданное время после заказа
+и раз в час списывает просроченные бонусы и снимает брошенные резервы.
+Ночью переносит старые закрытые записи в архивную БД.
 """
 
 import asyncio
@@ -11,8 +13,10 @@ from telegram import Bot, InlineKeyboardMarkup, InlineKeyboardButton
 from config import TELEGRAM_BOT_TOKEN
 from database import (
     get_pending_feedback_requests, mark_feedback_request_sent,
-    get_feedback_settings
+    get_feedback_settings, expire_old_bonuses, release_expired_bonus_holds,
+    archive_old_records, refresh_stats_rollups
 )
+from backup import run_scheduled_backup
 
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -102,8 +106,20 @@ async def run_scheduler():
 
     while True:
         try:
+            # Обе проверки читают только истекающие записи, поэтому дешёвые
+            expire_old_bonuses()
+            release_expired_bonus_holds()
+
             current_hour = datetime.now().hour
 
+            # Архивация в 03:00; затронутые дни статистики пересчитываются сразу,
+            # а не при следующем отчёте
+            if current_hour == 3:
+                archive_old_records()
+                refresh_stats_rollups()
+                # Копия снимается после архивации, в том же ночном окне
+                run_scheduled_backup()
+
             # Отправляем запросы в 10:00 каждый день
             if current_hour == 10:
                 await send_feedback_requests()
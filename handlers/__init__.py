@@ -40,7 +40,7 @@ from .support_handlers import support_start, support_send_message
 from .admin_handlers import (
     admin_panel, admin_view_appointments, admin_view_orders,
     admin_view_reviews, admin_broadcast_start, admin_broadcast_enter_text,
-    admin_broadcast_confirm
+    admin_broadcast_confirm, admin_find_user
 )
 
 __all__ = [
@@ -70,5 +70,5 @@ __all__ = [
     'support_start', 'support_send_message',
     'admin_panel', 'admin_view_appointments', 'admin_view_orders',
     'admin_view_reviews', 'admin_broadcast_start', 'admin_broadcast_enter_text',
-    'admin_broadcast_confirm'
+    'admin_broadcast_confirm', 'admin_find_user'
 ]
@@ -7,7 +7,12 @@ import logging
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes, ConversationHandler
 from config import ADMIN_ID, ADMIN_BROADCAST_TEXT, ADMIN_BROADCAST_CONFIRM
-from database import get_all_users, get_salon_appointments, get_flower_orders, get_reviews
+from database import get_all_users
+from database_async import (
+    get_salon_appointments_page, get_flower_orders_page, get_reviews_page,
+    get_salon_appointment_status_counts, get_flower_order_status_counts, get_review_rating_counts,
+    search_users
+)
 from utils.helpers import format_price
 
 logger = logging.getLogger(__name__)
@@ -39,6 +44,21 @@ async def admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int
         await update.callback_query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
 
 
+def _page_cursor(query) -> str:
+    """Курсор страницы из callback_data вида 'admin_orders:<курсор>'."""
+    _, _, cursor = query.data.partition(':')
+    return cursor or None
+
+
+def _page_keyboard(section: str, next_cursor) -> list:
+    """Кнопки навигации по страницам раздела админ-панели."""
+    keyboard = []
+    if next_cursor:
+        keyboard.append([InlineKeyboardButton("Далее ▶️", callback_data=f"{section}:{next_cursor}")])
+    keyboard.append([InlineKeyboardButton("◀️ Назад", callback_data="admin_panel")])
+    return keyboard
+
+
 async def admin_view_appointments(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Просмотр записей в салон"""
 
@@ -50,24 +70,17 @@ async def admin_view_appointments(update: Update, context: ContextTypes.DEFAULT_
         return
 
     try:
-        appointments = get_salon_appointments()
-
-        # Подсчитать статистику
-        today_count = 0
-        pending_count = 0
-
-        for appt in appointments:
-            if appt.get('status') == 'pending':
-                pending_count += 1
+        counts = await get_salon_appointment_status_counts()
+        page = await get_salon_appointments_page(after=_page_cursor(query), limit=5, status='pending')
 
         text = (
             "📋 ЗАПИСИ В САЛОН\n\n"
-            f"Ожидают подтверждения: {pending_count}\n"
-            f"Всего записей: {len(appointments)}\n\n"
+            f"Ожидают подтверждения: {counts.get('pending', 0)}\n"
+            f"Всего записей: {sum(counts.values())}\n\n"
         )
 
-        # Показать последние 5 ожидающих
-        pending = [a for a in appointments if a.get('status') == 'pending'][:5]
+        # Ожидающие подтверждения, по 5 на странице
+        pending = page['items']
 
         if pending:
             text += "Ожидают подтверждения:\n━━━━━━━━━━━━━━━\n"
@@ -79,7 +92,7 @@ async def admin_view_appointments(update: Update, context: ContextTypes.DEFAULT_
                     f"👤 {appt.get('user_name')} ({appt.get('phone')})\n\n"
                 )
 
-        keyboard = [[InlineKeyboardButton("◀️ Назад", callback_data="admin_panel")]]
+        keyboard = _page_keyboard("admin_appointments", page['next_cursor'])
 
         await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
 
@@ -104,21 +117,18 @@ async def admin_view_orders(update: Update, context: ContextTypes.DEFAULT_TYPE)
         return
 
     try:
-        orders = get_flower_orders()
-
-        # Подсчитать статистику
-        new_count = len([o for o in orders if o.get('status') == 'new'])
-        processing_count = len([o for o in orders if o.get('status') == 'processing'])
+        counts = await get_flower_order_status_counts()
+        page = await get_flower_orders_page(after=_page_cursor(query), limit=5, status='new')
 
         text = (
             "💐 ЗАКАЗЫ ЦВЕТОВ\n\n"
-            f"Новые: {new_count}\n"
-            f"В обработке: {processing_count}\n"
-            f"Всего заказов: {len(orders)}\n\n"
+            f"Новые: {counts.get('new', 0)}\n"
+            f"В обработке: {counts.get('processing', 0)}\n"
+            f"Всего заказов: {sum(counts.values())}\n\n"
         )
 
-        # Показать последние 5 новых
-        new_orders = [o for o in orders if o.get('status') == 'new'][:5]
+        # Новые заказы, по 5 на странице
+        new_orders = page['items']
 
         if new_orders:
             text += "Новые заказы:\n━━━━━━━━━━━━━━━\n"
@@ -131,7 +141,7 @@ async def admin_view_orders(update: Update, context: ContextTypes.DEFAULT_TYPE)
                     f"👤 {order.get('user_name')}\n\n"
                 )
 
-        keyboard = [[InlineKeyboardButton("◀️ Назад", callback_data="admin_panel")]]
+        keyboard = _page_keyboard("admin_orders", page['next_cursor'])
 
         await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
 
@@ -156,21 +166,22 @@ async def admin_view_reviews(update: Update, context: ContextTypes.DEFAULT_TYPE)
         return
 
     try:
-        reviews = get_reviews()
+        counts = await get_review_rating_counts()
+        page = await get_reviews_page(after=_page_cursor(query), limit=3)
 
         # Подсчитать статистику
-        positive = [r for r in reviews if r.get('rating', 0) >= 4]
-        negative = [r for r in reviews if r.get('rating', 0) <= 3]
+        positive = sum(count for rating, count in counts.items() if (rating or 0) >= 4)
+        negative = sum(count for rating, count in counts.items() if (rating or 0) <= 3)
 
         text = (
             "⭐ ОТЗЫВЫ\n\n"
-            f"Положительные (4-5⭐): {len(positive)}\n"
-            f"Негативные (1-3⭐): {len(negative)}\n"
-            f"Всего отзывов: {len(reviews)}\n\n"
+            f"Положительные (4-5⭐): {positive}\n"
+            f"Негативные (1-3⭐): {negative}\n"
+            f"Всего отзывов: {sum(counts.values())}\n\n"
         )
 
-        # Показать последние 3 отзыва
-        recent = reviews[:3]
+        # Последние отзывы, по 3 на странице
+        recent = page['items']
 
         if recent:
             text += "Последние отзывы:\n━━━━━━━━━━━━━━━\n"
@@ -184,7 +195,7 @@ async def admin_view_reviews(update: Update, context: ContextTypes.DEFAULT_TYPE)
                     text += f"\"{review.get('text')[:50]}...\"\n"
                 text += "\n"
 
-        keyboard = [[InlineKeyboardButton("◀️ Назад", callback_data="admin_panel")]]
+        keyboard = _page_keyboard("admin_reviews", page['next_cursor'])
 
         await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
 
@@ -198,6 +209,44 @@ async def admin_view_reviews(update: Update, context: ContextTypes.DEFAULT_TYPE)
         )
 
 
+async def admin_find_user(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Поиск клиента: /find <имя, username или телефон>"""
+
+    if update.effective_user.id != ADMIN_ID:
+        await update.message.reply_text("❌ Нет доступа")
+        return
+
+    search = " ".join(context.args or []).strip()
+    if not search:
+        await update.message.reply_text(
+            "🔍 Поиск клиента\n\n"
+            "Использование: /find <имя, @username или телефон>\n"
+            "Можно вводить начало слова или часть номера."
+        )
+        return
+
+    try:
+        users = await search_users(search, limit=10)
+
+        if not users:
+            await update.message.reply_text(f"🔍 По запросу «{search}» никого не найдено")
+            return
+
+        text = f"🔍 Найдено по запросу «{search}»:\n━━━━━━━━━━━━━━━\n"
+        for user in users:
+            username = f" (@{user.username})" if user.username else ""
+            text += (
+                f"👤 {user.user_name or 'Без имени'}{username}\n"
+                f"🆔 {user.user_id} | 📞 {user.phone or '—'} | 💎 {user.bonus_points or 0}\n\n"
+            )
+
+        await update.message.reply_text(text)
+
+    except Exception as e:
+        logger.error(f"Ошибка поиска клиента: {e}")
+        await update.message.reply_text("❌ Ошибка поиска")
+
+
 async def admin_broadcast_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Начало рассылки"""
 
@@ -9,19 +9,10 @@ from telegram.ext import ContextTypes, ConversationHandler
 from config import CERT_AMOUNT, CERT_RECIPIENT, CERT_CONFIRM
 from database import add_certificate
 from utils.helpers import format_price, generate_order_number, send_to_user_topic
-import random
-import string
 
 logger = logging.getLogger(__name__)
 
 
-def generate_certificate_code():
-    """Генерация уникального кода сертификата"""
-    part1 = ''.join(random.choices(string.ascii_uppercase + string.digits, k=4))
-    part2 = ''.join(random.choices(string.ascii_uppercase + string.digits, k=4))
-    return f"CERT-{part1}-{part2}"
-
-
 async def certificate_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Начало покупки сертификата"""
 
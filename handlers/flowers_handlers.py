@@ -13,14 +13,18 @@ from config import (
     FLOWERS_RECIPIENT, FLOWERS_PAYMENT, FLOWERS_CONFIRM,
     FREE_DELIVERY_THRESHOLD, DELIVERY_COST, BONUS_PERCENT, MAX_BONUS_PAYMENT_PERCENT, BONUS_THRESHOLD
 )
-from database import (
-    get_user, get_addresses, add_address, get_bonus_balance, subtract_bonus_points, add_bonus_points,
-    get_products, get_product_by_id, get_product_categories, add_flower_order,
-    schedule_feedback_request, check_and_award_referral_bonus, update_utm_campaign_stats
+from database_async import (
+    get_user, get_addresses, add_address,
+    get_available_bonus, hold_bonus_points, release_bonus_hold,
+    get_products, get_product_by_id, get_product_categories,
+    checkout_flower_order, run_db
 )
 import json
 from utils.helpers import format_price, get_current_datetime, calculate_delivery_cost, generate_order_number, send_to_user_topic
-from utils.pricing import calculate_cart_total, format_price_summary, get_subscription_benefits_summary
+from utils.pricing import (
+    get_pricing_profile, cached_pricing_profile, remember_pricing_profile, price_cart_memoized,
+    format_price_summary, get_subscription_benefits_summary
+)
 
 logger = logging.getLogger(__name__)
 
@@ -41,7 +45,7 @@ async def flowers_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
 
     try:
         # Получить категории из БД
-        categories = get_product_categories()
+        categories = await get_product_categories()
 
         if not categories:
             await query.edit_message_text(
@@ -112,7 +116,7 @@ async def flowers_select_category(update: Update, context: ContextTypes.DEFAULT_
 
     try:
         # Получить товары категории из БД
-        products = get_products(category=category, active_only=True, in_stock_only=True)
+        products = await get_products(category=category, active_only=True, in_stock_only=True)
 
         if not products:
             await query.edit_message_text(
@@ -162,7 +166,7 @@ async def flowers_view_item(update: Update, context: ContextTypes.DEFAULT_TYPE)
     product_id = int(query.data.replace("view_flower_", ""))
 
     try:
-        product = get_product_by_id(product_id)
+        product = await get_product_by_id(product_id)
 
         if not product:
             await query.answer("❌ Товар не найден", show_alert=True)
@@ -209,7 +213,7 @@ async def flowers_add_to_cart(update: Update, context: ContextTypes.DEFAULT_TYPE
     product_id = int(query.data.replace("add_flower_", ""))
 
     try:
-        product = get_product_by_id(product_id)
+        product = await get_product_by_id(product_id)
 
         if not product:
             await query.answer("❌ Товар не найден", show_alert=True)
@@ -257,7 +261,7 @@ async def flowers_select_category_update(update, context, category):
     query = update.callback_query
 
     try:
-        products = get_products(category=category, active_only=True, in_stock_only=True)
+        products = await get_products(category=category, active_only=True, in_stock_only=True)
 
         keyboard = []
         for product in products[:10]:
@@ -287,6 +291,31 @@ async def flowers_select_category_update(update, context, category):
 # ШАГ 3: КОРЗИНА - УПРАВЛЕНИЕ ТОВАРАМИ
 # =================================================================
 
+def _cart_items(cart: list) -> list:
+    """Позиции корзины для расчета цен (одинаковые на всех экранах оформления)."""
+    return [
+        {'price': item['price'], 'quantity': item['quantity'], 'type': 'flower', 'name': item['name']}
+        for item in cart
+    ]
+
+
+async def _price_cart(update: Update, context: ContextTypes.DEFAULT_TYPE,
+                      cart_items: list, delivery_cost: int) -> dict:
+    """
+    Рассчитать корзину с учетом подписки.
+
+    Подписка читается одним запросом на первом экране и сохраняется в
+    user_data (PRICING_PROFILE_TTL_SECONDS): следующие экраны обходятся
+    без БД. Если корзина и подписка не менялись, берётся расчёт с
+    прошлого экрана.
+    """
+    profile = cached_pricing_profile(context.user_data)
+    if profile is None:
+        profile = await run_db(get_pricing_profile, update.effective_user.id)
+        remember_pricing_profile(context.user_data, profile)
+    return price_cart_memoized(context.user_data, profile, cart_items, delivery_cost)
+
+
 async def flowers_view_cart(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Показать корзину с возможностью изменения"""
 
@@ -306,11 +335,10 @@ async def flowers_view_cart(update: Update, context: ContextTypes.DEFAULT_TYPE)
         return FLOWERS_CATEGORY
 
     # Подсчитать итоги с учетом подписки
-    user_id = update.effective_user.id
-    cart_items = [{'price': item['price'], 'quantity': item['quantity'], 'type': 'flower', 'name': item['name']} for item in cart]
+    cart_items = _cart_items(cart)
     base_subtotal = sum(item['price'] * item['quantity'] for item in cart)
     delivery = calculate_delivery_cost(base_subtotal)
-    pricing_info = calculate_cart_total(user_id, cart_items, delivery)
+    pricing_info = await _price_cart(update, context, cart_items, delivery)
 
     # Создать текст корзины
     text = "🛒 ВАША КОРЗИНА:\n\n"
@@ -489,35 +517,30 @@ async def flowers_confirm_order(update: Update, context: ContextTypes.DEFAULT_TY
         subtotal = sum(item['price'] * item['quantity'] for item in cart)
         composition = ", ".join([f"{item['name']} x{item['quantity']}" for item in cart])
         
-        # Создать заказ в БД
+        # Начислить бонусы за заказ от порога
+        bonus_earned = int(subtotal * BONUS_PERCENT / 100) if subtotal >= BONUS_THRESHOLD else 0
+
+        # Заказ, отзыв, бонусы, реферальная награда и UTM - одной транзакцией
         items_json = json.dumps(cart, ensure_ascii=False)
 
-        order_id = add_flower_order(
+        checkout = await checkout_flower_order(
             user_id=user.id,
             user_name=user.first_name,
-            phone='',
             items=items_json,
             total_amount=subtotal,
             delivery_type='pickup',
             delivery_address='Самовывоз',
             delivery_time='По готовности',
-            anonymous=False,
-            card_text='',
-            recipient_name='',
-            recipient_phone=''
+            bonus_earned=bonus_earned
         )
 
+        order_id = checkout['order_id']
         if not order_id:
             raise Exception("Не удалось создать заказ")
 
-        # Запланировать запрос на отзыв
-        schedule_feedback_request(user.id, 'flower_order', order_id)
+        if checkout['referral']:
+            logger.info(f"Реферальный бонус по заказу #{order_id}: {checkout['referral']}")
 
-        # Начислить бонусы
-        if subtotal >= BONUS_THRESHOLD:
-            bonus_earn = int(subtotal * BONUS_PERCENT / 100)
-            add_bonus_points(user.id, bonus_earn, f"Заказ цветов #{order_id}")
-        
         # Уведомление админу
         admin_text = (
             f"🆕 <b>НОВЫЙ ЗАКАЗ ЦВЕТОВ</b>\n\n"
@@ -532,9 +555,8 @@ async def flowers_confirm_order(update: Update, context: ContextTypes.DEFAULT_TY
 
         # Ответ клиенту
         response_text = f"🎉 Заказ #{order_id} успешно создан!\n\n"
-        if subtotal >= BONUS_THRESHOLD:
-            bonus_earn = int(subtotal * BONUS_PERCENT / 100)
-            response_text += f"🎁 Вам начислено {format_price(bonus_earn)} бонусов!\n\n"
+        if bonus_earned > 0:
+            response_text += f"🎁 Вам начислено {format_price(bonus_earned)} бонусов!\n\n"
         response_text += "Администратор свяжется с вами для уточнения."
         
         await query.edit_message_text(
@@ -589,7 +611,7 @@ async def flowers_ask_address(update: Update, context: ContextTypes.DEFAULT_TYPE
 
     query = update.callback_query
     user_id = update.effective_user.id
-    addresses = get_addresses(user_id)
+    addresses = await get_addresses(user_id)
 
     keyboard = []
 
@@ -645,7 +667,7 @@ async def flowers_handle_address_selection(update: Update, context: ContextTypes
     # Выбран сохраненный адрес
     if query.data.startswith("select_address_"):
         addr_id = int(query.data.replace("select_address_", ""))
-        addresses = get_addresses(update.effective_user.id)
+        addresses = await get_addresses(update.effective_user.id)
         address = next((addr[1] for addr in addresses if addr[0] == addr_id), None)
 
         if address:
@@ -673,7 +695,7 @@ async def flowers_enter_new_address(update: Update, context: ContextTypes.DEFAUL
 
     # Сохранить в БД
     try:
-        add_address(update.effective_user.id, address, is_default=False)
+        await add_address(update.effective_user.id, address, is_default=False)
         logger.info(f"Сохранен новый адрес для пользователя {update.effective_user.id}")
     except Exception as e:
         logger.error(f"Ошибка сохранения адреса: {e}")
@@ -928,18 +950,19 @@ async def flowers_ask_payment_method(update: Update, context: ContextTypes.DEFAU
     cart = context.user_data.get('cart', [])
 
     # Преобразовать корзину в формат для расчета
-    cart_items = [{'price': item['price'], 'quantity': item['quantity'], 'type': 'flower'} for item in cart]
+    cart_items = _cart_items(cart)
 
     delivery_type = context.user_data.get('delivery_type', 'Самовывоз')
     base_subtotal = sum(item['price'] * item['quantity'] for item in cart)
     delivery_cost = 0 if delivery_type == "Самовывоз" else calculate_delivery_cost(base_subtotal)
 
     # Рассчитать с учетом подписки
-    pricing_info = calculate_cart_total(user_id, cart_items, delivery_cost)
+    pricing_info = await _price_cart(update, context, cart_items, delivery_cost)
     total = pricing_info['final_total']
 
-    # Получить баланс бонусов
-    bonus_balance = get_bonus_balance(user_id)
+    # Баланс за вычетом резервов в других незавершённых заказах
+    await _release_bonus_hold(update, context)
+    bonus_balance = await get_available_bonus(user_id)
 
     # Максимум можно использовать 50% от суммы
     max_bonus_use = int(total * MAX_BONUS_PAYMENT_PERCENT / 100)
@@ -956,8 +979,9 @@ async def flowers_ask_payment_method(update: Update, context: ContextTypes.DEFAU
 
     text += "\nВыберите способ оплаты:"
 
-    # Сохранить информацию о ценах для последующего использования
+    # Сохранить информацию о ценах и доступных бонусах для следующих шагов
     context.user_data['pricing_info'] = pricing_info
+    context.user_data['bonus_available'] = available_bonus
 
     keyboard = [
         [InlineKeyboardButton("💳 Оплатить при получении", callback_data="payment_cash")]
@@ -979,6 +1003,34 @@ async def flowers_ask_payment_method(update: Update, context: ContextTypes.DEFAU
     return FLOWERS_PAYMENT
 
 
+async def _release_bonus_hold(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Снять резерв бонусов, сделанный ранее в этом оформлении."""
+    hold_id = context.user_data.pop('bonus_hold_id', None)
+    context.user_data['bonus_used'] = 0
+    if hold_id:
+        await release_bonus_hold(hold_id, update.effective_user.id)
+
+
+async def _hold_bonus(update: Update, context: ContextTypes.DEFAULT_TYPE, amount: int) -> bool:
+    """
+    Зарезервировать бонусы под заказ вместо предыдущего резерва.
+
+    Returns:
+        bool: False если баланс успели потратить в другой сессии
+    """
+    await _release_bonus_hold(update, context)
+    if amount <= 0:
+        return True
+
+    hold_id = await hold_bonus_points(update.effective_user.id, amount)
+    if not hold_id:
+        return False
+
+    context.user_data['bonus_hold_id'] = hold_id
+    context.user_data['bonus_used'] = amount
+    return True
+
+
 async def flowers_handle_payment_selection(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Обработка выбора способа оплаты"""
 
@@ -986,23 +1038,23 @@ async def flowers_handle_payment_selection(update: Update, context: ContextTypes
     await query.answer()
 
     if query.data == "payment_cash":
-        context.user_data['bonus_used'] = 0
+        await _release_bonus_hold(update, context)
         return await flowers_show_full_confirmation(update, context)
 
     elif query.data == "payment_bonus_max":
-        # Использовать максимум доступных бонусов
-        cart = context.user_data.get('cart', [])
-        subtotal = sum(item['price'] * item['quantity'] for item in cart)
-        delivery_type = context.user_data.get('delivery_type', 'Самовывоз')
-        delivery_cost = 0 if delivery_type == "Самовывоз" else calculate_delivery_cost(subtotal)
-        total = subtotal + delivery_cost
+        # Использовать максимум доступных бонусов (посчитан на экране оплаты)
+        available_bonus = context.user_data.get('bonus_available', 0)
 
-        user_id = update.effective_user.id
-        bonus_balance = get_bonus_balance(user_id)
-        max_bonus_use = int(total * MAX_BONUS_PAYMENT_PERCENT / 100)
-        available_bonus = min(bonus_balance, max_bonus_use)
+        if not await _hold_bonus(update, context, available_bonus):
+            await query.edit_message_text(
+                "❌ Бонусы уже использованы в другом заказе.\n"
+                "Выберите «Оплатить при получении» или начните оформление заново.",
+                reply_markup=InlineKeyboardMarkup([[
+                    InlineKeyboardButton("💳 Оплатить при получении", callback_data="payment_cash")
+                ]])
+            )
+            return FLOWERS_PAYMENT
 
-        context.user_data['bonus_used'] = available_bonus
         return await flowers_show_full_confirmation(update, context)
 
     elif query.data == "payment_bonus_partial":
@@ -1021,19 +1073,11 @@ async def flowers_enter_bonus_amount(update: Update, context: ContextTypes.DEFAU
 
     text = update.message.text.lower().strip()
 
-    cart = context.user_data.get('cart', [])
-    subtotal = sum(item['price'] * item['quantity'] for item in cart)
-    delivery_type = context.user_data.get('delivery_type', 'Самовывоз')
-    delivery_cost = 0 if delivery_type == "Самовывоз" else calculate_delivery_cost(subtotal)
-    total = subtotal + delivery_cost
-
-    user_id = update.effective_user.id
-    bonus_balance = get_bonus_balance(user_id)
-    max_bonus_use = int(total * MAX_BONUS_PAYMENT_PERCENT / 100)
-    available_bonus = min(bonus_balance, max_bonus_use)
+    # Доступно к оплате - посчитано на экране оплаты, резерв проверит баланс сам
+    available_bonus = context.user_data.get('bonus_available', 0)
 
     if text in ["все", "всё", "все бонусы"]:
-        context.user_data['bonus_used'] = available_bonus
+        amount = available_bonus
     else:
         try:
             amount = int(text)
@@ -1050,13 +1094,19 @@ async def flowers_enter_bonus_amount(update: Update, context: ContextTypes.DEFAU
                 )
                 return FLOWERS_PAYMENT
 
-            context.user_data['bonus_used'] = amount
         except ValueError:
             await update.message.reply_text(
                 "❌ Неверный формат. Введите число или 'все'"
             )
             return FLOWERS_PAYMENT
 
+    if not await _hold_bonus(update, context, amount):
+        await update.message.reply_text(
+            "❌ Бонусы уже использованы в другом заказе.\n"
+            "Введите меньшее количество или 0."
+        )
+        return FLOWERS_PAYMENT
+
     context.user_data.pop('waiting_for_bonus_input', None)
     return await flowers_show_full_confirmation(update, context)
 
@@ -1079,11 +1129,10 @@ async def flowers_show_full_confirmation(update: Update, context: ContextTypes.D
 
     if not pricing_info:
         # Если не сохранена, пересчитать
-        user_id = update.effective_user.id
-        cart_items = [{'price': item['price'], 'quantity': item['quantity'], 'type': 'flower'} for item in cart]
+        cart_items = _cart_items(cart)
         base_subtotal = sum(item['price'] * item['quantity'] for item in cart)
         delivery_cost = 0 if delivery_type == "Самовывоз" else calculate_delivery_cost(base_subtotal)
-        pricing_info = calculate_cart_total(user_id, cart_items, delivery_cost)
+        pricing_info = await _price_cart(update, context, cart_items, delivery_cost)
 
     total = pricing_info['final_total']
     total_after_bonus = total - bonus_used
@@ -1164,17 +1213,15 @@ async def flowers_create_full_order(update: Update, context: ContextTypes.DEFAUL
         # Создать строку состава
         composition = ", ".join([f"{item['name']} x{item['quantity']}" for item in cart])
 
-        # Получить телефон
-        user_data = get_user(user.id)
-        phone = recipient_phone or (user_data[3] if user_data else '')
+        # Начислить бонусы за заказ (5% если >= 3000)
+        bonus_earned = int(total * BONUS_PERCENT / 100) if total >= FREE_DELIVERY_THRESHOLD else 0
 
-        # Создать заказ в БД
+        # Заказ, отзыв, бонусы, реферальная награда и UTM - одной транзакцией
         items_json = json.dumps(cart, ensure_ascii=False)
 
-        order_id = add_flower_order(
+        checkout = await checkout_flower_order(
             user_id=user.id,
             user_name=user.first_name,
-            phone=phone,
             items=items_json,
             total_amount=total - bonus_used,
             delivery_type='delivery' if delivery_type == "Доставка" else 'pickup',
@@ -1183,44 +1230,36 @@ async def flowers_create_full_order(update: Update, context: ContextTypes.DEFAUL
             anonymous=is_anonymous,
             card_text=card_text,
             recipient_name=recipient_name,
-            recipient_phone=recipient_phone
+            recipient_phone=recipient_phone,
+            bonus_used=bonus_used,
+            bonus_earned=bonus_earned,
+            bonus_hold_id=context.user_data.get('bonus_hold_id')
         )
 
+        if checkout['error'] == 'insufficient_bonus':
+            await query.edit_message_text(
+                "❌ На бонусном счёте недостаточно баллов.\n"
+                "Оформите заказ заново, чтобы пересчитать сумму.",
+                reply_markup=InlineKeyboardMarkup([[
+                    InlineKeyboardButton("🏠 В меню", callback_data="main_menu")
+                ]])
+            )
+            return ConversationHandler.END
+
+        order_id = checkout['order_id']
         if not order_id:
             raise Exception("Не удалось создать заказ в БД")
 
-        # Запланировать запрос на отзыв
-        schedule_feedback_request(user.id, 'flower_order', order_id)
-
-        # Списать бонусы если использовались
         if bonus_used > 0:
-            subtract_bonus_points(user.id, bonus_used, f"Оплата заказа цветов #{order_id}")
             logger.info(f"Списано {bonus_used} бонусов у пользователя {user.id}")
 
-        # Начислить бонусы за заказ (5% если >= 3000)
-        if total >= FREE_DELIVERY_THRESHOLD:
-            bonus_earned = int(total * BONUS_PERCENT / 100)
-            add_bonus_points(user.id, bonus_earned, f"Заказ цветов #{order_id}")
+        if bonus_earned > 0:
             bonus_message = f"\n\n🎁 Вам начислено {bonus_earned} бонусов!"
         else:
             bonus_message = ""
 
-        # Проверить и начислить реферальный бонус
-        try:
-            check_and_award_referral_bonus(order_id, user.id, total - bonus_used)
-            logger.info(f"Проверен реферальный бонус для заказа #{order_id}")
-        except Exception as e:
-            logger.error(f"Ошибка проверки реферального бонуса: {e}")
-
-        # Обновить статистику конверсий UTM
-        try:
-            user_data = get_user(user.id)
-            if user_data and len(user_data) > 9 and user_data[9]:  # utm_source exists
-                utm_code = f"{user_data[9]}__{user_data[10] or ''}__{user_data[11] or ''}__{user_data[12] or ''}__{user_data[13] or ''}"
-                update_utm_campaign_stats(utm_code, 'conversion', total - bonus_used)
-                logger.info(f"Обновлена UTM-статистика конверсии: {utm_code}")
-        except Exception as e:
-            logger.error(f"Ошибка обновления UTM-статистики: {e}")
+        if checkout['referral']:
+            logger.info(f"Реферальный бонус по заказу #{order_id}: {checkout['referral']}")
 
         # Отправить в админ-группу
         admin_text = (
@@ -1233,7 +1272,7 @@ async def flowers_create_full_order(update: Update, context: ContextTypes.DEFAUL
             admin_text += f" (@{user.username})"
 
         admin_text += (
-            f"\n📞 Заказчик: {get_user(user.id)[3] if get_user(user.id) else 'Не указан'}\n\n"
+            f"\n📞 Заказчик: {checkout['customer_phone'] or 'Не указан'}\n\n"
             f"🛒 Состав:\n{composition}\n\n"
             f"💰 Сумма: {format_price(subtotal)}\n"
         )
@@ -1349,7 +1388,7 @@ async def custom_order_process(update: Update, context: ContextTypes.DEFAULT_TYP
     if user.username:
         admin_text += f" (@{user.username})"
 
-    user_data = get_user(user.id)
+    user_data = await get_user(user.id)
     if user_data and user_data[3]:
         admin_text += f"\n📞 Телефон: {user_data[3]}"
 
@@ -4,20 +4,37 @@
 """
 
 import logging
+import time
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes
-from database import (
-    get_user, get_addresses, get_bonus_balance,
-    get_loyalty_transactions, count_referrals, set_default_address, delete_address,
-    get_salon_appointments, get_flower_orders, is_profile_filled, update_user_profile,
-    get_user_active_subscription
+from database_async import (
+    get_addresses, get_profile_snapshot, get_bonus_balance,
+    get_loyalty_transactions, get_expiring_bonuses, set_default_address, delete_address,
+    get_user_appointments_by_status, get_user_flower_orders_by_status, update_user_profile
 )
 from utils.helpers import format_price, format_datetime
-from config import ADMIN_ID
+from config import ADMIN_ID, PROFILE_SNAPSHOT_TTL_SECONDS
 
 logger = logging.getLogger(__name__)
 
 
+async def _get_profile(update: Update, context: ContextTypes.DEFAULT_TYPE, fresh: bool = False):
+    """
+    Снимок профиля пользователя (см. get_profile_snapshot).
+
+    Главный экран профиля читает снимок заново, подэкраны используют
+    сохранённый, если он моложе PROFILE_SNAPSHOT_TTL_SECONDS.
+    """
+    cached = context.user_data.get('profile_snapshot')
+    if not fresh and cached and time.time() - cached[0] < PROFILE_SNAPSHOT_TTL_SECONDS:
+        return cached[1]
+
+    profile = await get_profile_snapshot(update.effective_user.id)
+    if profile:
+        context.user_data['profile_snapshot'] = (time.time(), profile)
+    return profile
+
+
 async def profile_view(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Показать профиль пользователя"""
 
@@ -25,26 +42,14 @@ async def profile_view(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
     await query.answer()
 
     user = update.effective_user
-    user_data = get_user(user.id)
+    profile = await _get_profile(update, context, fresh=True)
 
-    if not user_data:
+    if not profile:
         await query.edit_message_text(
             "Профиль не найден. Нажмите /start для регистрации."
         )
         return
 
-    bonus_balance = get_bonus_balance(user.id)
-    referral_code = user_data[6] if len(user_data) > 6 else "Нет"
-    referrals_count = count_referrals(user.id)
-
-    # Проверить индексы для birthday
-    birthday = None
-    if len(user_data) > 16:  # birthday должен быть после profile_filled
-        birthday = user_data[16]
-
-    # Получить активную подписку
-    active_sub = get_user_active_subscription(user.id)
-
     text = (
         "👤 МОЙ ПРОФИЛЬ\n\n"
         f"Имя: {user.first_name}\n"
@@ -53,31 +58,31 @@ async def profile_view(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
     if user.username:
         text += f"Telegram: @{user.username}\n"
 
-    if user_data[3]:  # phone
-        text += f"📞 Телефон: {user_data[3]}\n"
+    if profile.phone:
+        text += f"📞 Телефон: {profile.phone}\n"
 
-    if birthday:
-        text += f"🎂 День рождения: {birthday}\n"
+    if profile.birthday:
+        text += f"🎂 День рождения: {profile.birthday}\n"
 
-    text += f"\n🎁 Бонусов: {bonus_balance}\n"
+    text += f"\n🎁 Бонусов: {profile.bonus_points}\n"
 
     # Показать активную подписку если есть
-    if active_sub:
-        text += f"💎 Подписка: {active_sub['plan_name']}\n"
-        text += f"📅 Действует до: {active_sub['end_date']}\n"
+    if profile.plan_name:
+        text += f"💎 Подписка: {profile.plan_name}\n"
+        text += f"📅 Действует до: {profile.plan_end_date}\n"
 
         # Показать доступные преимущества кратко
-        if active_sub['monthly_flowers_included'] > 0:
-            used = active_sub['flowers_used_this_month']
-            total = active_sub['monthly_flowers_included']
+        if profile.monthly_flowers_included > 0:
+            used = profile.flowers_used_this_month
+            total = profile.monthly_flowers_included
             text += f"🌹 Букетов: {total - used}/{total}\n"
 
-        if active_sub['monthly_service_included'] and not active_sub['service_used_this_month']:
+        if profile.monthly_service_included and not profile.service_used_this_month:
             text += f"💅 Услуга: Доступна\n"
 
     text += (
-        f"\n💎 Реферальный код: {referral_code}\n"
-        f"👥 Приглашено друзей: {referrals_count}"
+        f"\n💎 Реферальный код: {profile.referral_code or 'Нет'}\n"
+        f"👥 Приглашено друзей: {profile.referrals_count}"
     )
 
     keyboard = [
@@ -89,13 +94,14 @@ async def profile_view(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
     ]
 
     # Добавить кнопку "Моя подписка" если есть активная
-    if active_sub:
+    if profile.plan_name:
         keyboard.append([InlineKeyboardButton("💎 Моя подписка", callback_data="subscriptions")])
 
     # Добавить кнопку редактирования, если профиль еще не заполнен
-    if not is_profile_filled(user.id):
+    if not profile.profile_filled:
         keyboard.append([InlineKeyboardButton("✏️ Заполнить профиль", callback_data="profile_edit")])
 
+
     keyboard.append([InlineKeyboardButton("◀️ Назад", callback_data="main_menu")])
 
     await query.edit_message_text(
@@ -113,21 +119,29 @@ async def profile_view_appointments(update: Update, context: ContextTypes.DEFAUL
     user_id = update.effective_user.id
 
     try:
-        # Получить записи пользователя из БД
-        appointments = get_salon_appointments(user_id=user_id)
+        # Счётчики по статусам и последние записи каждого статуса - на стороне БД
+        summary = await get_user_appointments_by_status(
+            user_id, {'pending': 5, 'confirmed': 5, 'completed': 3}
+        )
+        counts, top = summary['counts'], summary['top']
 
-        if not appointments:
+        if not counts:
             text = "📋 У вас пока нет записей в салон"
         else:
-            # Разделить на активные и завершенные
-            active = [a for a in appointments if a.get('status') in ['pending', 'confirmed']]
-            completed = [a for a in appointments if a.get('status') == 'completed']
+            # Активные: 5 последних из ожидающих и подтверждённых вместе
+            active = sorted(
+                top['pending'] + top['confirmed'],
+                key=lambda a: (a.get('appointment_date'), a.get('time_slot')),
+                reverse=True
+            )[:5]
+            completed = top['completed']
+            active_count = counts.get('pending', 0) + counts.get('confirmed', 0)
 
             text = "📋 МОИ ЗАПИСИ\n\n"
 
             if active:
-                text += "Активные:\n━━━━━━━━━━━━━━━\n"
-                for appt in active[:5]:
+                text += f"Активные ({active_count}):\n━━━━━━━━━━━━━━━\n"
+                for appt in active:
                     status_emoji = "✅" if appt.get('status') == 'confirmed' else "⏳"
                     date_time = f"{appt.get('appointment_date')} {appt.get('time_slot')}"
                     text += (
@@ -137,8 +151,8 @@ async def profile_view_appointments(update: Update, context: ContextTypes.DEFAUL
                     )
 
             if completed:
-                text += "\nИстория:\n━━━━━━━━━━━━━━━\n"
-                for appt in completed[:3]:
+                text += f"\nИстория ({counts.get('completed', 0)}):\n━━━━━━━━━━━━━━━\n"
+                for appt in completed:
                     date_time = f"{appt.get('appointment_date')} {appt.get('time_slot')}"
                     text += (
                         f"#{appt.get('id')} | {date_time}\n"
@@ -171,20 +185,28 @@ async def profile_view_orders(update: Update, context: ContextTypes.DEFAULT_TYPE
     user_id = update.effective_user.id
 
     try:
-        # Получить заказы пользователя из БД
-        orders = get_flower_orders(user_id=user_id)
+        # Счётчики по статусам и последние заказы каждого статуса - на стороне БД
+        summary = await get_user_flower_orders_by_status(
+            user_id, {'new': 5, 'processing': 5, 'completed': 3}
+        )
+        counts, top = summary['counts'], summary['top']
 
-        if not orders:
+        if not counts:
             text = "🛍️ У вас пока нет заказов"
         else:
-            active = [o for o in orders if o.get('status') in ['new', 'processing']]
-            completed = [o for o in orders if o.get('status') == 'completed']
+            active = sorted(
+                top['new'] + top['processing'],
+                key=lambda o: o.get('created_at') or '',
+                reverse=True
+            )[:5]
+            completed = top['completed']
+            active_count = counts.get('new', 0) + counts.get('processing', 0)
 
             text = "🛍️ МОИ ЗАКАЗЫ\n\n"
 
             if active:
-                text += "Активные:\n━━━━━━━━━━━━━━━\n"
-                for order in active[:5]:
+                text += f"Активные ({active_count}):\n━━━━━━━━━━━━━━━\n"
+                for order in active:
                     items_text = order.get('items', '')[:40]
                     text += (
                         f"#{order.get('id')} | {order.get('created_at', '')[:10]}\n"
@@ -194,8 +216,8 @@ async def profile_view_orders(update: Update, context: ContextTypes.DEFAULT_TYPE
                     )
 
             if completed:
-                text += "\nИстория:\n━━━━━━━━━━━━━━━\n"
-                for order in completed[:3]:
+                text += f"\nИстория ({counts.get('completed', 0)}):\n━━━━━━━━━━━━━━━\n"
+                for order in completed:
                     items_text = order.get('items', '')[:40]
                     text += (
                         f"#{order.get('id')} | {order.get('created_at', '')[:10]}\n"
@@ -227,7 +249,7 @@ async def profile_view_addresses(update: Update, context: ContextTypes.DEFAULT_T
     await query.answer()
 
     user_id = update.effective_user.id
-    addresses = get_addresses(user_id)
+    addresses = await get_addresses(user_id)
 
     if not addresses:
         text = "📍 У вас нет сохраненных адресов"
@@ -270,7 +292,7 @@ async def profile_set_default_address(update: Update, context: ContextTypes.DEFA
     user_id = update.effective_user.id
 
     try:
-        set_default_address(user_id, addr_id)
+        await set_default_address(user_id, addr_id)
         await query.answer("✅ Адрес установлен основным", show_alert=True)
         return await profile_view_addresses(update, context)
     except Exception as e:
@@ -287,7 +309,7 @@ async def profile_delete_address(update: Update, context: ContextTypes.DEFAULT_T
     addr_id = int(query.data.replace("delete_addr_", ""))
 
     try:
-        delete_address(addr_id)
+        await delete_address(addr_id)
         await query.answer("✅ Адрес удален", show_alert=True)
         return await profile_view_addresses(update, context)
     except Exception as e:
@@ -302,11 +324,20 @@ async def profile_view_bonuses(update: Update, context: ContextTypes.DEFAULT_TYP
     await query.answer()
 
     user_id = update.effective_user.id
-    balance = get_bonus_balance(user_id)
-    transactions = get_loyalty_transactions(user_id, limit=10)
+    # Баланс читаем заново, а не из снимка профиля: он должен сходиться
+    # с историей и сгорающими бонусами ниже
+    balance = await get_bonus_balance(user_id)
+    transactions = await get_loyalty_transactions(user_id, limit=10)
+    expiring = await get_expiring_bonuses(user_id, days=30)
 
     text = f"🎁 БОНУСЫ\n\nВаш баланс: {balance}\n\n1 бонус = 1 рубль\n\n"
 
+    if expiring:
+        text += "⏳ Скоро сгорят:\n"
+        for points, expires_at in expiring:
+            text += f"{points} — {expires_at[:10]}\n"
+        text += "\n"
+
     if transactions:
         text += "История:\n━━━━━━━━━━━━━━━\n"
         for points, description, created_at in transactions:
@@ -329,10 +360,9 @@ async def profile_view_referral(update: Update, context: ContextTypes.DEFAULT_TY
     query = update.callback_query
     await query.answer()
 
-    user = update.effective_user
-    user_data = get_user(user.id)
-    referral_code = user_data[6] if len(user_data) > 6 else "Нет"
-    referrals_count = count_referrals(user.id)
+    profile = await _get_profile(update, context)
+    referral_code = (profile.referral_code if profile else None) or "Нет"
+    referrals_count = profile.referrals_count if profile else 0
 
     text = (
         "👥 ПРИГЛАСИ ДРУГА\n\n"
@@ -368,10 +398,9 @@ async def profile_edit_start(update: Update, context: ContextTypes.DEFAULT_TYPE)
     query = update.callback_query
     await query.answer()
 
-    user_id = update.effective_user.id
-
     # Проверить, был ли уже заполнен профиль
-    if is_profile_filled(user_id):
+    profile = await _get_profile(update, context)
+    if profile and profile.profile_filled:
         await query.edit_message_text(
             "❌ Вы уже заполняли профиль.\n\n"
             "Для изменения данных обратитесь к администратору.",
@@ -488,7 +517,7 @@ async def profile_edit_birthday(update: Update, context: ContextTypes.DEFAULT_TY
     name = context.user_data.get('edit_name')
     phone = context.user_data.get('edit_phone')
 
-    success = update_user_profile(
+    success = await update_user_profile(
         user_id=user_id,
         first_name=name,
         phone=phone,
@@ -496,6 +525,7 @@ async def profile_edit_birthday(update: Update, context: ContextTypes.DEFAULT_TY
     )
 
     if success:
+        context.user_data.pop('profile_snapshot', None)
         await update.message.reply_text(
             "✅ ПРОФИЛЬ УСПЕШНО ЗАПОЛНЕН!\n\n"
             f"Имя: {name}\n"
@@ -13,7 +13,7 @@ from config import (
     SALON_PHONE, SALON_COMMENT, SALON_PAYMENT, SALON_CONFIRM,
     ADMIN_ID, ADMIN_GROUP_ID
 )
-from database import (
+from database_async import (
     get_user, update_user_phone, get_service_categories, get_services,
     get_service_by_id, add_salon_appointment, log_consent,
     schedule_feedback_request, check_and_award_referral_bonus, update_utm_campaign_stats
@@ -40,7 +40,7 @@ async def salon_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int
 
     try:
         # Получить категории из БД
-        categories = get_service_categories()
+        categories = await get_service_categories()
 
         if not categories:
             await query.edit_message_text(
@@ -103,7 +103,7 @@ async def salon_select_category(update: Update, context: ContextTypes.DEFAULT_TY
 
     try:
         # Получить услуги выбранной категории из БД
-        services = get_services(category=category, active_only=True)
+        services = await get_services(category=category, active_only=True)
 
         if not services:
             await query.edit_message_text(
@@ -153,7 +153,7 @@ async def salon_select_service(update: Update, context: ContextTypes.DEFAULT_TYP
 
     try:
         # Получить выбранную услугу из БД
-        service = get_service_by_id(service_id)
+        service = await get_service_by_id(service_id)
 
         if not service:
             await query.edit_message_text("❌ Услуга не найдена.")
@@ -298,7 +298,7 @@ async def salon_select_time(update: Update, context: ContextTypes.DEFAULT_TYPE)
     context.user_data['salon_time'] = time_slot
 
     # Проверить, есть ли телефон в БД
-    user = get_user(update.effective_user.id)
+    user = await get_user(update.effective_user.id)
 
     if user and user[3]:  # user[3] = phone
         context.user_data['salon_phone'] = user[3]
@@ -347,10 +347,10 @@ async def salon_enter_phone(update: Update, context: ContextTypes.DEFAULT_TYPE)
     context.user_data['salon_phone'] = formatted_phone
 
     # Обновить в БД
-    update_user_phone(update.effective_user.id, formatted_phone)
+    await update_user_phone(update.effective_user.id, formatted_phone)
 
     # Логировать согласие на обработку данных
-    log_consent(
+    await log_consent(
         user_id=update.effective_user.id,
         user_name=update.effective_user.first_name,
         phone=formatted_phone,
@@ -370,10 +370,10 @@ async def salon_contact_shared(update: Update, context: ContextTypes.DEFAULT_TYP
     formatted_phone = format_phone(phone)
 
     context.user_data['salon_phone'] = formatted_phone
-    update_user_phone(update.effective_user.id, formatted_phone)
+    await update_user_phone(update.effective_user.id, formatted_phone)
 
     # Логировать согласие на обработку данных
-    log_consent(
+    await log_consent(
         user_id=update.effective_user.id,
         user_name=update.effective_user.first_name,
         phone=formatted_phone,
@@ -531,7 +531,7 @@ async def salon_confirm_booking(update: Update, context: ContextTypes.DEFAULT_TY
         # Создать запись в БД
         prepaid = False if payment == "На месте" else True
 
-        appointment_id = add_salon_appointment(
+        appointment_id = await add_salon_appointment(
             user_id=user.id,
             user_name=user.first_name,
             phone=phone,
@@ -547,21 +547,21 @@ async def salon_confirm_booking(update: Update, context: ContextTypes.DEFAULT_TY
             raise Exception("Не удалось создать запись в БД")
 
         # Запланировать запрос на отзыв
-        schedule_feedback_request(user.id, 'appointment', appointment_id)
+        await schedule_feedback_request(user.id, 'appointment', appointment_id)
 
         # Проверить и начислить реферальный бонус
         try:
-            check_and_award_referral_bonus(appointment_id, user.id, service['price'])
+            await check_and_award_referral_bonus(appointment_id, user.id, service['price'])
             logger.info(f"Проверен реферальный бонус для записи #{appointment_id}")
         except Exception as e:
             logger.error(f"Ошибка проверки реферального бонуса: {e}")
 
         # Обновить статистику конверсий UTM
         try:
-            user_data = get_user(user.id)
+            user_data = await get_user(user.id)
             if user_data and len(user_data) > 9 and user_data[9]:  # utm_source exists
                 utm_code = f"{user_data[9]}__{user_data[10] or ''}__{user_data[11] or ''}__{user_data[12] or ''}__{user_data[13] or ''}"
-                update_utm_campaign_stats(utm_code, 'conversion', service['price'])
+                await update_utm_campaign_stats(utm_code, 'conversion', service['price'])
                 logger.info(f"Обновлена UTM-статистика конверсии: {utm_code}")
         except Exception as e:
             logger.error(f"Ошибка обновления UTM-статистики: {e}")
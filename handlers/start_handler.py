@@ -7,10 +7,7 @@ import logging
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes
 
-from database import (
-    add_user, get_user_by_referral_code, add_bonus_points, get_user,
-    parse_utm_from_start_param, save_user_utm, update_utm_campaign_stats
-)
+from database_async import register_user
 from config import REFERRAL_BONUS
 
 # Настройка логирования
@@ -58,75 +55,31 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # Получить параметр из deep link
         start_param = context.args[0] if context.args and len(context.args) > 0 else None
 
-        # Парсить UTM-метки из параметра
-        utm_params = parse_utm_from_start_param(start_param)
-
-        # Проверить реферальный код в аргументах
-        referred_by = None
         if start_param:
             logger.info(f"Получен start параметр: {start_param}")
 
-            # Если это реферальный код (формат REF...)
-            if start_param.startswith('REF'):
-                # Найти пользователя по реферальному коду
-                referred_by = get_user_by_referral_code(start_param)
-
-                if referred_by:
-                    logger.info(f"Найден реферер: {referred_by}")
-                else:
-                    logger.warning(f"Реферальный код {start_param} не найден")
-
-        # Попытаться зарегистрировать пользователя
-        is_new_user = add_user(user_id, username, first_name, referred_by)
-
-        # Если новый пользователь - сохранить UTM-метки и обновить статистику
-        if is_new_user:
-            try:
-                # Сохранить UTM-метки пользователя
-                save_user_utm(user_id, utm_params)
-                logger.info(f"Сохранены UTM-метки для пользователя {user_id}: {utm_params['source_type']}")
-
-                # Обновить статистику регистраций кампании
-                if utm_params['source_type'] == 'utm' and start_param:
-                    update_utm_campaign_stats(start_param, 'registration')
-                    logger.info(f"Обновлена статистика регистраций для кампании: {start_param}")
+        # Клик по UTM, реферер, регистрация, UTM-метки и бонусы - одной транзакцией
+        registration = await register_user(
+            user_id, username, first_name, start_param, referral_bonus=REFERRAL_BONUS
+        )
 
-            except Exception as e:
-                logger.error(f"Ошибка сохранения UTM-меток: {e}")
+        referred_by = registration['referred_by']
+        if start_param and start_param.startswith('REF') and registration['is_new'] and not referred_by:
+            logger.warning(f"Реферальный код {start_param} не найден")
 
         # Если новый пользователь и есть реферер
-        if is_new_user and referred_by:
-            try:
-                # Начислить бонусы рефереру
-                add_bonus_points(
-                    referred_by,
-                    REFERRAL_BONUS,
-                    f"Реферальная программа: пригласил пользователя {first_name}"
-                )
+        if registration['is_new'] and referred_by:
+            logger.info(f"Начислено {REFERRAL_BONUS} бонусов пользователю {user_id} и {referred_by}")
 
-                # Начислить бонусы новому пользователю
-                add_bonus_points(
-                    user_id,
-                    REFERRAL_BONUS,
-                    "Регистрация по реферальной ссылке"
+            # Отправить уведомление рефереру
+            try:
+                await context.bot.send_message(
+                    chat_id=referred_by,
+                    text=f"🎉 Ваш друг {first_name} зарегистрировался по вашей ссылке!\n"
+                         f"+{REFERRAL_BONUS} бонусов на ваш счёт!"
                 )
-
-                logger.info(f"Начислено {REFERRAL_BONUS} бонусов пользователю {user_id} и {referred_by}")
-
-                # Отправить уведомление рефереру
-                try:
-                    referrer_data = get_user(referred_by)
-                    if referrer_data:
-                        await context.bot.send_message(
-                            chat_id=referred_by,
-                            text=f"🎉 Ваш друг {first_name} зарегистрировался по вашей ссылке!\n"
-                                 f"+{REFERRAL_BONUS} бонусов на ваш счёт!"
-                        )
-                except Exception as e:
-                    logger.error(f"Ошибка отправки уведомления рефереру: {e}")
-
             except Exception as e:
-                logger.error(f"Ошибка начисления бонусов: {e}")
+                logger.error(f"Ошибка отправки уведомления рефереру: {e}")
 
         # Приветственное сообщение
         welcome_text = (
@@ -10,6 +10,7 @@ from database import (
     create_user_subscription
 )
 from utils.helpers import format_price
+from utils.pricing import pricing_profile_from_subscription, remember_pricing_profile
 
 logger = logging.getLogger(__name__)
 
@@ -28,6 +29,9 @@ async def subscriptions_menu(update: Update, context: ContextTypes.DEFAULT_TYPE)
     # Проверить активную подписку
     active_sub = get_user_active_subscription(user_id)
 
+    # Подписка прочитана заново - обновить профиль цен для оформления заказа
+    remember_pricing_profile(context.user_data, pricing_profile_from_subscription(active_sub))
+
     if active_sub:
         text = (
             f"💎 ВАША ПОДПИСКА\n\n"
@@ -36,6 +36,7 @@ from config import (
 
 # Импорт базы данных
 from database import init_db
+from database_async import shutdown_db
 
 # Импорт обработчиков
 from handlers import start, menu, help_command, coming_soon
@@ -78,7 +79,7 @@ from handlers.support_handlers import support_start, support_send_message, handl
 from handlers.admin_handlers import (
     admin_panel, admin_view_appointments, admin_view_orders,
     admin_view_reviews, admin_broadcast_start, admin_broadcast_enter_text,
-    admin_broadcast_confirm
+    admin_broadcast_confirm, admin_find_user
 )
 from handlers.subscription_handlers import (
     subscriptions_menu, subscription_view_plan, subscription_buy_confirm,
@@ -143,6 +144,7 @@ def main():
         application = Application.builder() \
             .token(TELEGRAM_BOT_TOKEN) \
             .persistence(persistence) \
+            .post_shutdown(shutdown_db) \
             .build()
 
         # =================================================================
@@ -425,10 +427,11 @@ def main():
 
         # Админ-панель
         application.add_handler(CommandHandler("admin", admin_panel))
+        application.add_handler(CommandHandler("find", admin_find_user))
         application.add_handler(CallbackQueryHandler(admin_panel, pattern='^admin_panel$'))
-        application.add_handler(CallbackQueryHandler(admin_view_appointments, pattern='^admin_appointments$'))
-        application.add_handler(CallbackQueryHandler(admin_view_orders, pattern='^admin_orders$'))
-        application.add_handler(CallbackQueryHandler(admin_view_reviews, pattern='^admin_reviews$'))
+        application.add_handler(CallbackQueryHandler(admin_view_appointments, pattern='^admin_appointments(:.*)?$'))
+        application.add_handler(CallbackQueryHandler(admin_view_orders, pattern='^admin_orders(:.*)?$'))
+        application.add_handler(CallbackQueryHandler(admin_view_reviews, pattern='^admin_reviews(:.*)?$'))
 
         # Возврат в главное меню
         application.add_handler(CallbackQueryHandler(menu, pattern='^main_menu$'))
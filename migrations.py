@@ -0,0 +1,1343 @@
+"""
+Версионные миграции схемы базы данных.
+
+Версия схемы хранится в PRAGMA user_version, история применения -
+в таблице schema_migrations. Если схема актуальна, запуск стоит одного
+чтения PRAGMA, независимо от числа накопленных миграций.
+
+Новая миграция - функция, принимающая cursor, добавленная в конец
+списка MIGRATIONS со следующим номером. Уже выпущенные миграции
+не меняются.
+
+CLI:
+    python migrations.py status   - текущая версия и ожидающие миграции
+    python migrations.py apply    - применить ожидающие миграции
+"""
+
+import os
+import sys
+import time
+import logging
+import argparse
+from typing import Callable, List, Optional, Tuple
+
+if __name__ == "__main__":
+    # CLI сам решает, когда применять миграции
+    os.environ.setdefault("DB_AUTO_MIGRATE", "0")
+
+import database
+from database import get_connection
+
+logger = logging.getLogger(__name__)
+
+
+def _column_exists(cursor, table: str, column: str) -> bool:
+    """Проверить наличие столбца в таблице."""
+    cursor.execute(f"PRAGMA table_info({table})")
+    return any(row[1] == column for row in cursor.fetchall())
+
+
+# =================================================================
+# МИГРАЦИИ
+# =================================================================
+
+def _m001_initial_schema(cursor):
+    """Базовые таблицы, индексы платежей и данные по умолчанию."""
+    # Таблица пользователей
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            first_name TEXT,
+            phone TEXT,
+            registration_date DATETIME DEFAULT CURRENT_TIMESTAMP,
+            bonus_points INTEGER DEFAULT 0,
+            referral_code TEXT UNIQUE,
+            referred_by INTEGER
+        )
+    ''')
+
+    # Таблица адресов доставки
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS addresses (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            address TEXT,
+            is_default BOOLEAN DEFAULT FALSE,
+            FOREIGN KEY (user_id) REFERENCES users(user_id)
+        )
+    ''')
+
+    # Таблица транзакций лояльности
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS loyalty_transactions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            points INTEGER,
+            description TEXT,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users(user_id)
+        )
+    ''')
+
+    # Таблица журнала уведомлений
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS notifications_log (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            notification_type TEXT,
+            sent_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users(user_id)
+        )
+    ''')
+
+    # Таблица услуг салона
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS services (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            category TEXT NOT NULL,
+            name TEXT NOT NULL,
+            price INTEGER NOT NULL,
+            description TEXT,
+            duration_minutes INTEGER NOT NULL,
+            active BOOLEAN DEFAULT TRUE
+        )
+    ''')
+
+    # Таблица товаров (цветы)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS products (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            category TEXT NOT NULL,
+            name TEXT NOT NULL,
+            price INTEGER NOT NULL,
+            photo_url TEXT,
+            description TEXT,
+            in_stock BOOLEAN DEFAULT TRUE,
+            active BOOLEAN DEFAULT TRUE
+        )
+    ''')
+
+    # Таблица записей в салон
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS salon_appointments (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            user_name TEXT NOT NULL,
+            phone TEXT NOT NULL,
+            service_id INTEGER NOT NULL,
+            service_name TEXT NOT NULL,
+            appointment_date TEXT NOT NULL,
+            time_slot TEXT NOT NULL,
+            status TEXT DEFAULT 'pending',
+            prepaid BOOLEAN DEFAULT FALSE,
+            comment TEXT,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users(user_id),
+            FOREIGN KEY (service_id) REFERENCES services(id)
+        )
+    ''')
+
+    # Таблица заказов цветов
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS flower_orders (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            user_name TEXT NOT NULL,
+            phone TEXT NOT NULL,
+            items TEXT NOT NULL,
+            total_amount INTEGER NOT NULL,
+            delivery_type TEXT NOT NULL,
+            delivery_address TEXT,
+            delivery_time TEXT,
+            anonymous BOOLEAN DEFAULT FALSE,
+            card_text TEXT,
+            recipient_name TEXT,
+            recipient_phone TEXT,
+            status TEXT DEFAULT 'new',
+            paid BOOLEAN DEFAULT FALSE,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users(user_id)
+        )
+    ''')
+
+    # Таблица сертификатов
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS certificates (
+            code TEXT PRIMARY KEY,
+            amount INTEGER NOT NULL,
+            buyer_user_id INTEGER NOT NULL,
+            purchase_date DATETIME DEFAULT CURRENT_TIMESTAMP,
+            used BOOLEAN DEFAULT FALSE,
+            used_by_user_id INTEGER,
+            used_date DATETIME,
+            FOREIGN KEY (buyer_user_id) REFERENCES users(user_id)
+        )
+    ''')
+
+    # Таблица галереи
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS gallery (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            category TEXT NOT NULL,
+            description TEXT,
+            photo_url TEXT NOT NULL,
+            price INTEGER DEFAULT 0,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    # Таблица реферальных наград
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS referral_rewards (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            referrer_user_id INTEGER NOT NULL,
+            referred_user_id INTEGER NOT NULL,
+            reward_type TEXT NOT NULL,
+            reward_amount INTEGER NOT NULL,
+            trigger_order_id INTEGER,
+            trigger_order_amount INTEGER,
+            status TEXT DEFAULT 'pending',
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            paid_at DATETIME,
+            FOREIGN KEY (referrer_user_id) REFERENCES users(user_id),
+            FOREIGN KEY (referred_user_id) REFERENCES users(user_id)
+        )
+    ''')
+
+    # Таблица UTM-кампаний (для генерации ссылок)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS utm_campaigns (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL UNIQUE,
+            utm_source TEXT NOT NULL,
+            utm_medium TEXT,
+            utm_campaign TEXT,
+            utm_content TEXT,
+            utm_term TEXT,
+            generated_link TEXT,
+            clicks INTEGER DEFAULT 0,
+            registrations INTEGER DEFAULT 0,
+            conversions INTEGER DEFAULT 0,
+            revenue INTEGER DEFAULT 0,
+            active BOOLEAN DEFAULT TRUE,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    # Таблица платежей
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS payments (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            order_id TEXT NOT NULL,
+            order_type TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            amount INTEGER NOT NULL,
+            currency TEXT DEFAULT 'RUB',
+            provider TEXT NOT NULL,
+            payment_method TEXT,
+            payment_id TEXT UNIQUE,
+            payment_url TEXT,
+            status TEXT DEFAULT 'pending',
+            paid_at DATETIME,
+            metadata TEXT,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users(user_id)
+        )
+    ''')
+
+    # Индексы для платежей
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_payments_order
+        ON payments(order_id, order_type)
+    ''')
+
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_payments_status
+        ON payments(status)
+    ''')
+
+    # Таблица настроек реферальной программы
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS referral_settings (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            enabled BOOLEAN DEFAULT TRUE,
+            reward_type TEXT DEFAULT 'fixed',
+            reward_amount INTEGER DEFAULT 500,
+            reward_percent INTEGER DEFAULT 10,
+            min_order_amount INTEGER DEFAULT 1000,
+            max_reward_amount INTEGER DEFAULT 5000,
+            reward_on_first_order_only BOOLEAN DEFAULT TRUE,
+            auto_approve BOOLEAN DEFAULT FALSE,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    # Вставить настройки реферальной программы по умолчанию
+    cursor.execute('''
+        INSERT OR IGNORE INTO referral_settings
+        (id, enabled, reward_type, reward_amount, min_order_amount, reward_on_first_order_only, auto_approve)
+        VALUES (1, 1, 'fixed', 500, 1000, 1, 0)
+    ''')
+
+    # Таблица отзывов
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS reviews (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            user_name TEXT NOT NULL,
+            rating INTEGER NOT NULL,
+            text TEXT,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users(user_id)
+        )
+    ''')
+
+    # Таблица логов согласия на обработку данных
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS consent_logs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            user_name TEXT NOT NULL,
+            phone TEXT NOT NULL,
+            consent_type TEXT NOT NULL,
+            ip_address TEXT,
+            user_agent TEXT,
+            consent_date DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users(user_id)
+        )
+    ''')
+
+    # Таблица настроек бонусной программы
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS bonus_settings (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            bonus_percent INTEGER DEFAULT 5,
+            bonus_threshold INTEGER DEFAULT 3000,
+            max_bonus_payment_percent INTEGER DEFAULT 50,
+            referral_bonus INTEGER DEFAULT 500,
+            bonus_expiry_days INTEGER DEFAULT 0,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    # Вставить настройки по умолчанию если их нет
+    cursor.execute('''
+        INSERT OR IGNORE INTO bonus_settings (id, bonus_percent, bonus_threshold, max_bonus_payment_percent, referral_bonus, bonus_expiry_days)
+        VALUES (1, 5, 3000, 50, 500, 0)
+    ''')
+
+    # Таблица запросов отзывов
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS feedback_requests (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            order_type TEXT NOT NULL,
+            order_id INTEGER NOT NULL,
+            scheduled_date DATE NOT NULL,
+            sent_at DATETIME,
+            status TEXT DEFAULT 'pending',
+            FOREIGN KEY (user_id) REFERENCES users(user_id)
+        )
+    ''')
+
+    # Таблица настроек рекомендательной системы
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS feedback_settings (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            enabled BOOLEAN DEFAULT TRUE,
+            delay_days INTEGER DEFAULT 1,
+            message_template TEXT DEFAULT 'Здравствуйте! Как вам наши услуги/товары? Будем рады вашему отзыву! 💐',
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    # Вставить настройки по умолчанию если их нет
+    cursor.execute('''
+        INSERT OR IGNORE INTO feedback_settings (id, enabled, delay_days, message_template)
+        VALUES (1, 1, 1, 'Здравствуйте! Как вам наши услуги/товары? Будем рады вашему отзыву! 💐')
+    ''')
+
+    # Таблица тарифных планов подписок
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS subscription_plans (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            description TEXT,
+            type TEXT NOT NULL,
+            price INTEGER NOT NULL,
+            duration_months INTEGER NOT NULL,
+            benefits TEXT,
+            monthly_flowers_included INTEGER DEFAULT 0,
+            monthly_service_included BOOLEAN DEFAULT FALSE,
+            service_discount_percent INTEGER DEFAULT 0,
+            flower_discount_percent INTEGER DEFAULT 0,
+            active BOOLEAN DEFAULT TRUE,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    # Таблица активных подписок пользователей
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS user_subscriptions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            plan_id INTEGER NOT NULL,
+            start_date DATE NOT NULL,
+            end_date DATE NOT NULL,
+            status TEXT DEFAULT 'active',
+            flowers_used_this_month INTEGER DEFAULT 0,
+            service_used_this_month BOOLEAN DEFAULT FALSE,
+            last_benefit_reset DATE,
+            payment_amount INTEGER NOT NULL,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users(user_id),
+            FOREIGN KEY (plan_id) REFERENCES subscription_plans(id)
+        )
+    ''')
+
+    # Таблица истории использования подписок
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS subscription_usage (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            subscription_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            usage_type TEXT NOT NULL,
+            order_id INTEGER,
+            used_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (subscription_id) REFERENCES user_subscriptions(id),
+            FOREIGN KEY (user_id) REFERENCES users(user_id)
+        )
+    ''')
+
+    # Добавить дефолтные планы подписок
+    cursor.execute('''
+        INSERT OR IGNORE INTO subscription_plans
+        (id, name, description, type, price, duration_months, benefits, monthly_flowers_included, monthly_service_included, service_discount_percent, flower_discount_percent)
+        VALUES
+        (1, 'Красота + Цветы', 'Годовая карта с букетом каждый месяц и скидками на услуги', 'premium', 5000, 12,
+         '✅ 1 букет в месяц (до 1500₽)\n✅ 15% скидка на все услуги салона\n✅ Приоритетная запись',
+         1, 0, 15, 0),
+        (2, 'Карта привилегий', 'Накопительные скидки и бонусы', 'privilege', 2000, 12,
+         '✅ 10% скидка на все услуги\n✅ 20% скидка на цветы\n✅ Двойные бонусы\n✅ Приоритетная поддержка',
+         0, 0, 10, 20),
+        (3, 'Цветочная VIP подписка', 'Премиум подписка с максимальными привилегиями', 'vip', 10000, 1,
+         '✅ 4 букета премиум класса в месяц\n✅ 1 услуга салона включена\n✅ Персональный менеджер\n✅ VIP обслуживание',
+         4, 1, 0, 0),
+        (4, 'Пакет для мужчин', 'Готовое решение: букет + услуга', 'gift_package', 4500, 0,
+         '✅ Премиум букет (до 2000₽)\n✅ Услуга на выбор (маникюр/педикюр)\n✅ Красивая упаковка',
+         1, 1, 0, 0)
+    ''')
+
+    # ====================================================================
+    # ТАБЛИЦЫ МАСТЕРОВ И ГРАФИКОВ
+    # ====================================================================
+
+    # Таблица мастеров
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS masters (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            phone TEXT,
+            specialization TEXT,
+            photo_url TEXT,
+            description TEXT,
+            color TEXT DEFAULT '#3498db',
+            active BOOLEAN DEFAULT TRUE,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    # Таблица графиков работы мастеров
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS master_schedules (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            master_id INTEGER NOT NULL,
+            work_date DATE NOT NULL,
+            start_time TIME NOT NULL,
+            end_time TIME NOT NULL,
+            is_day_off BOOLEAN DEFAULT FALSE,
+            note TEXT,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (master_id) REFERENCES masters(id),
+            UNIQUE(master_id, work_date)
+        )
+    ''')
+
+    # Добавить примерных мастеров
+    cursor.execute('''
+        INSERT OR IGNORE INTO masters
+        (id, name, phone, specialization, color, active)
+        VALUES
+        (1, 'Анна Иванова', '+79001234567', 'Маникюр, педикюр', '#e74c3c', TRUE),
+        (2, 'Мария Петрова', '+79001234568', 'Стрижки, окрашивание', '#3498db', TRUE),
+        (3, 'Елена Сидорова', '+79001234569', 'Визаж, брови', '#2ecc71', TRUE),
+        (4, 'Ольга Козлова', '+79001234570', 'Универсал', '#f39c12', TRUE)
+    ''')
+
+
+def _m002_gallery_created_at_and_price(cursor):
+    """Столбцы created_at и price в gallery (для старых баз)."""
+    if not _column_exists(cursor, 'gallery', 'created_at'):
+        # SQLite не позволяет DEFAULT CURRENT_TIMESTAMP при ALTER TABLE
+        # Используем NULL как значение по умолчанию, а затем обновим существующие записи
+        cursor.execute("ALTER TABLE gallery ADD COLUMN created_at DATETIME")
+        cursor.execute("UPDATE gallery SET created_at = CURRENT_TIMESTAMP WHERE created_at IS NULL")
+        logger.info("Добавлен столбец created_at в таблицу gallery")
+
+    if not _column_exists(cursor, 'gallery', 'price'):
+        cursor.execute("ALTER TABLE gallery ADD COLUMN price INTEGER DEFAULT 0")
+        logger.info("Добавлен столбец price в таблицу gallery")
+
+
+def _m003_appointment_price_and_duration(cursor):
+    """Столбцы price и duration_minutes в salon_appointments."""
+    if not _column_exists(cursor, 'salon_appointments', 'price'):
+        cursor.execute("ALTER TABLE salon_appointments ADD COLUMN price INTEGER DEFAULT 0")
+        # Обновить цены из услуг
+        cursor.execute("""
+            UPDATE salon_appointments
+            SET price = (SELECT price FROM services WHERE services.id = salon_appointments.service_id)
+            WHERE price = 0 OR price IS NULL
+        """)
+        logger.info("Добавлен столбец price в таблицу salon_appointments")
+
+    if not _column_exists(cursor, 'salon_appointments', 'duration_minutes'):
+        cursor.execute("ALTER TABLE salon_appointments ADD COLUMN duration_minutes INTEGER DEFAULT 60")
+        # Обновить длительность из услуг
+        cursor.execute("""
+            UPDATE salon_appointments
+            SET duration_minutes = (SELECT duration_minutes FROM services WHERE services.id = salon_appointments.service_id)
+            WHERE duration_minutes = 60 OR duration_minutes IS NULL
+        """)
+        logger.info("Добавлен столбец duration_minutes в таблицу salon_appointments")
+
+
+def _m004_users_utm_columns(cursor):
+    """Поля источников привлечения в users."""
+    if not _column_exists(cursor, 'users', 'utm_source'):
+        cursor.execute("ALTER TABLE users ADD COLUMN utm_source TEXT")
+        cursor.execute("ALTER TABLE users ADD COLUMN utm_medium TEXT")
+        cursor.execute("ALTER TABLE users ADD COLUMN utm_campaign TEXT")
+        cursor.execute("ALTER TABLE users ADD COLUMN utm_content TEXT")
+        cursor.execute("ALTER TABLE users ADD COLUMN utm_term TEXT")
+        cursor.execute("ALTER TABLE users ADD COLUMN source_type TEXT DEFAULT 'organic'")
+        logger.info("Добавлены столбцы UTM-меток в таблицу users")
+
+
+def _m005_users_birthday_profile(cursor):
+    """Поле дня рождения и флаг заполнения профиля в users."""
+    if not _column_exists(cursor, 'users', 'birthday'):
+        cursor.execute("ALTER TABLE users ADD COLUMN birthday DATE")
+        cursor.execute("ALTER TABLE users ADD COLUMN profile_filled BOOLEAN DEFAULT FALSE")
+        logger.info("Добавлены поля birthday и profile_filled в таблицу users")
+
+
+def _m006_appointment_master(cursor):
+    """Поля master_id и master_name в salon_appointments."""
+    if not _column_exists(cursor, 'salon_appointments', 'master_id'):
+        cursor.execute("ALTER TABLE salon_appointments ADD COLUMN master_id INTEGER")
+        cursor.execute("ALTER TABLE salon_appointments ADD COLUMN master_name TEXT")
+        logger.info("Добавлены поля master_id и master_name в salon_appointments")
+
+
+def _m007_hot_path_indexes(cursor):
+    """Индексы для выборок по пользователю, статусу, мастеру и дате."""
+    # Записи: история клиента, календарь мастера, расписание на день
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_appointments_user
+        ON salon_appointments(user_id, appointment_date, time_slot)
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_appointments_master_date
+        ON salon_appointments(master_id, appointment_date, time_slot)
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_appointments_date
+        ON salon_appointments(appointment_date, time_slot)
+    ''')
+
+    # Заказы цветов: история клиента и фильтр по статусу
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_flower_orders_user
+        ON flower_orders(user_id, created_at)
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_flower_orders_status
+        ON flower_orders(status, created_at)
+    ''')
+
+    # История бонусов
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_loyalty_user
+        ON loyalty_transactions(user_id, created_at)
+    ''')
+
+    # Подсчёт рефералов
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_users_referred_by
+        ON users(referred_by)
+    ''')
+
+    # Очередь запросов отзывов
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_feedback_status_date
+        ON feedback_requests(status, scheduled_date)
+    ''')
+
+    # Журнал уведомлений
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_notifications_user_type
+        ON notifications_log(user_id, notification_type, sent_at)
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_notifications_sent_at
+        ON notifications_log(sent_at)
+    ''')
+
+    # Активная подписка (проверяется при каждом расчёте цены)
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_user_subscriptions_user
+        ON user_subscriptions(user_id, status, end_date)
+    ''')
+
+    # Реферальные награды по приглашённому
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_referral_rewards_referred
+        ON referral_rewards(referred_user_id, status)
+    ''')
+
+    # Платежи пользователя
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_payments_user
+        ON payments(user_id, created_at)
+    ''')
+
+    # Обновить статистику для планировщика запросов (только рабочая БД:
+    # к соединениям пула подключён архив, его не трогаем)
+    cursor.execute("ANALYZE main")
+
+
+def _m008_keyset_pagination_indexes(cursor):
+    """Индексы по дате создания для постраничных списков."""
+    # id (rowid) неявно входит в каждый индекс, поэтому ключ (дата, id) покрыт
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_flower_orders_created
+        ON flower_orders(created_at)
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_appointments_created
+        ON salon_appointments(created_at)
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_appointments_status_created
+        ON salon_appointments(status, created_at)
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_appointments_user_created
+        ON salon_appointments(user_id, created_at)
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_reviews_created
+        ON reviews(created_at)
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_users_registration
+        ON users(registration_date)
+    ''')
+
+
+# Телефон только из цифр: полный номер и последние 10 цифр (без кода страны)
+_PHONE_DIGITS_SQL = (
+    "replace(replace(replace(replace(replace(replace("
+    "COALESCE({col}, ''), '+', ''), ' ', ''), '-', ''), '(', ''), ')', ''), '.', '')"
+)
+_PHONE_TOKENS_SQL = (
+    f"{_PHONE_DIGITS_SQL} || ' ' || substr({_PHONE_DIGITS_SQL}, -10)"
+)
+
+
+def _m009_full_text_search(cursor):
+    """FTS5-индексы по клиентам, товарам и отзывам с триггерами синхронизации."""
+    new_phone = _PHONE_TOKENS_SQL.format(col='new.phone')
+
+    # Клиенты: имя, username, телефон (отдельная таблица - телефон нормализуется)
+    cursor.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS users_fts USING fts5(
+            name, username, phone,
+            tokenize = "unicode61 remove_diacritics 2"
+        )
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS users_fts_insert AFTER INSERT ON users BEGIN
+            INSERT INTO users_fts (rowid, name, username, phone)
+            VALUES (new.user_id, new.first_name, new.username, {new_phone});
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS users_fts_delete AFTER DELETE ON users BEGIN
+            DELETE FROM users_fts WHERE rowid = old.user_id;
+        END
+    ''')
+    # Только при изменении искомых полей (бонусы меняются намного чаще)
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS users_fts_update
+        AFTER UPDATE OF first_name, username, phone ON users BEGIN
+            DELETE FROM users_fts WHERE rowid = old.user_id;
+            INSERT INTO users_fts (rowid, name, username, phone)
+            VALUES (new.user_id, new.first_name, new.username, {new_phone});
+        END
+    ''')
+    cursor.execute("DELETE FROM users_fts")
+    cursor.execute(f'''
+        INSERT INTO users_fts (rowid, name, username, phone)
+        SELECT user_id, first_name, username, {_PHONE_TOKENS_SQL.format(col='phone')}
+        FROM users
+    ''')
+
+    # Товары: external content поверх products
+    cursor.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS products_fts USING fts5(
+            name, description,
+            content = 'products', content_rowid = 'id',
+            tokenize = "unicode61 remove_diacritics 2"
+        )
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS products_fts_insert AFTER INSERT ON products BEGIN
+            INSERT INTO products_fts (rowid, name, description)
+            VALUES (new.id, new.name, new.description);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS products_fts_delete AFTER DELETE ON products BEGIN
+            INSERT INTO products_fts (products_fts, rowid, name, description)
+            VALUES ('delete', old.id, old.name, old.description);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS products_fts_update
+        AFTER UPDATE OF name, description ON products BEGIN
+            INSERT INTO products_fts (products_fts, rowid, name, description)
+            VALUES ('delete', old.id, old.name, old.description);
+            INSERT INTO products_fts (rowid, name, description)
+            VALUES (new.id, new.name, new.description);
+        END
+    ''')
+    cursor.execute("INSERT INTO products_fts (products_fts) VALUES ('rebuild')")
+
+    # Отзывы: external content поверх reviews
+    cursor.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS reviews_fts USING fts5(
+            text,
+            content = 'reviews', content_rowid = 'id',
+            tokenize = "unicode61 remove_diacritics 2"
+        )
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS reviews_fts_insert AFTER INSERT ON reviews BEGIN
+            INSERT INTO reviews_fts (rowid, text) VALUES (new.id, new.text);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS reviews_fts_delete AFTER DELETE ON reviews BEGIN
+            INSERT INTO reviews_fts (reviews_fts, rowid, text) VALUES ('delete', old.id, old.text);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS reviews_fts_update AFTER UPDATE OF text ON reviews BEGIN
+            INSERT INTO reviews_fts (reviews_fts, rowid, text) VALUES ('delete', old.id, old.text);
+            INSERT INTO reviews_fts (rowid, text) VALUES (new.id, new.text);
+        END
+    ''')
+    cursor.execute("INSERT INTO reviews_fts (reviews_fts) VALUES ('rebuild')")
+
+
+def _m010_bonus_ledger(cursor):
+    """
+    Бонусный реестр: остаток и срок действия по каждому начислению.
+
+    Списание идёт с самых старых начислений (FIFO), просроченные
+    находятся по частичному индексу expires_at. Остаток пользователя
+    (users.bonus_points) всегда равен сумме remaining его начислений.
+    """
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS bonus_credits (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            transaction_id INTEGER,
+            points INTEGER NOT NULL,
+            remaining INTEGER NOT NULL,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            expires_at DATETIME,
+            FOREIGN KEY (user_id) REFERENCES users(user_id),
+            FOREIGN KEY (transaction_id) REFERENCES loyalty_transactions(id)
+        )
+    ''')
+
+    # Очередь FIFO: открытые начисления пользователя от старых к новым
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_bonus_credits_open
+        ON bonus_credits(user_id, created_at)
+        WHERE remaining > 0
+    ''')
+
+    # Проверка сроков читает только открытые начисления со сроком
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_bonus_credits_expiry
+        ON bonus_credits(expires_at)
+        WHERE remaining > 0 AND expires_at IS NOT NULL
+    ''')
+
+    # Заполнение по текущим балансам. При FIFO-списании непотраченными
+    # остаются самые свежие начисления: раздаём баланс от новых к старым,
+    # непокрытый остаток (ручные корректировки) - отдельным начислением.
+    # Вставляем от старых к новым, чтобы порядок id совпадал с порядком
+    # (created_at, id) и при равных created_at; остаток получает самую
+    # раннюю дату пользователя и списывается первым.
+    row = cursor.execute('SELECT bonus_expiry_days FROM bonus_settings WHERE id = 1').fetchone()
+    expiry_days = row[0] if row and row[0] else 0
+
+    balances = cursor.execute('''
+        SELECT user_id, bonus_points, registration_date FROM users WHERE bonus_points > 0
+    ''').fetchall()
+
+    for user_id, balance, registration_date in balances:
+        credits = cursor.execute('''
+            SELECT id, points, created_at FROM loyalty_transactions
+            WHERE user_id = ? AND points > 0
+            ORDER BY created_at DESC, id DESC
+        ''', (user_id,)).fetchall()
+
+        chosen = []
+        for transaction_id, points, created_at in credits:
+            if balance <= 0:
+                break
+            remaining = min(points, balance)
+            balance -= remaining
+            chosen.append((transaction_id, points, remaining, created_at))
+
+        if balance > 0:
+            created_at = cursor.execute('''
+                SELECT COALESCE(MIN(created_at), ?, CURRENT_TIMESTAMP)
+                FROM loyalty_transactions WHERE user_id = ?
+            ''', (registration_date, user_id)).fetchone()[0]
+            chosen.append((None, balance, balance, created_at))
+
+        for transaction_id, points, remaining, created_at in reversed(chosen):
+            cursor.execute('''
+                INSERT INTO bonus_credits (user_id, transaction_id, points, remaining, created_at, expires_at)
+                VALUES (?, ?, ?, ?, ?, CASE WHEN ? > 0 THEN datetime(?, '+' || ? || ' days') END)
+            ''', (user_id, transaction_id, points, remaining, created_at,
+                  expiry_days, created_at, expiry_days))
+
+    if balances:
+        logger.info(f"Бонусный реестр заполнен по балансам {len(balances)} пользователей")
+
+
+def _m011_bonus_holds(cursor):
+    """Резервирование бонусов на время оформления заказа."""
+    # Сумма активных резервов: доступно = bonus_points - bonus_held
+    if not _column_exists(cursor, 'users', 'bonus_held'):
+        cursor.execute("ALTER TABLE users ADD COLUMN bonus_held INTEGER NOT NULL DEFAULT 0")
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS bonus_holds (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            points INTEGER NOT NULL,
+            status TEXT NOT NULL DEFAULT 'active',
+            order_id INTEGER,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            expires_at DATETIME NOT NULL,
+            FOREIGN KEY (user_id) REFERENCES users(user_id)
+        )
+    ''')
+
+    # Активные резервы: по пользователю и по сроку (для освобождения просроченных)
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_bonus_holds_user_active
+        ON bonus_holds(user_id, expires_at)
+        WHERE status = 'active'
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_bonus_holds_expiry
+        ON bonus_holds(expires_at)
+        WHERE status = 'active'
+    ''')
+
+
+def _m012_code_sequences(cursor):
+    """Последовательности для генерации уникальных кодов (см. codes.py)."""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS code_sequences (
+            name TEXT PRIMARY KEY,
+            next_value INTEGER NOT NULL DEFAULT 0,
+            secret TEXT NOT NULL
+        )
+    ''')
+
+
+def _m013_utm_campaign_code(cursor):
+    """Код кампании из deep link отдельной индексированной колонкой."""
+    if not _column_exists(cursor, 'utm_campaigns', 'utm_code'):
+        cursor.execute("ALTER TABLE utm_campaigns ADD COLUMN utm_code TEXT")
+
+    # Код - всё после start= в сгенерированной ссылке (utm_source__medium__...)
+    cursor.execute('''
+        UPDATE utm_campaigns
+        SET utm_code = substr(generated_link, instr(generated_link, 'start=') + 6)
+        WHERE utm_code IS NULL AND instr(generated_link, 'start=') > 0
+    ''')
+
+    # Не UNIQUE: кампании с разными названиями могут иметь одинаковые метки
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_utm_campaigns_code
+        ON utm_campaigns(utm_code)
+    ''')
+
+
+def _m014_change_log(cursor):
+    """Версии разделов для инвалидации кэшей между процессами (бот, админка)."""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS change_log (
+            section TEXT PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+
+    # Любая запись в таблицу (из бота, админки или вручную) увеличивает версию раздела
+    tables = {
+        'services': 'services',
+        'products': 'products',
+        'gallery': 'gallery',
+        'bonus_settings': 'settings',
+        'referral_settings': 'settings',
+        'feedback_settings': 'settings',
+    }
+    for section in sorted(set(tables.values())):
+        cursor.execute('INSERT OR IGNORE INTO change_log (section, version) VALUES (?, 0)', (section,))
+
+    for table, section in tables.items():
+        for event in ('INSERT', 'UPDATE', 'DELETE'):
+            cursor.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS {table}_change_log_{event.lower()}
+                AFTER {event} ON {table}
+                BEGIN
+                    UPDATE change_log SET version = version + 1 WHERE section = '{section}';
+                END
+            ''')
+
+
+def _m015_user_status_indexes(cursor):
+    """Индексы для списков профиля: счётчики и последние строки по статусу."""
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_appointments_user_status
+        ON salon_appointments(user_id, status, appointment_date, time_slot)
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_flower_orders_user_status
+        ON flower_orders(user_id, status, created_at)
+    ''')
+
+
+# Источники роллапов статистики: таблица -> (столбцы с датой события,
+# столбцы, изменение которых меняет статистику)
+_STATS_SOURCES = {
+    'users': (('registration_date',), 'registration_date, referred_by, source_type'),
+    'flower_orders': (('created_at',), 'created_at, status, total_amount, user_id'),
+    'salon_appointments': (('appointment_date', 'created_at'),
+                           'appointment_date, time_slot, created_at, status, price, service_id, user_id'),
+    'certificates': (('purchase_date',), 'purchase_date, amount'),
+    'user_subscriptions': (('created_at',), 'created_at, plan_id, payment_amount'),
+    'subscription_usage': (('used_at',), 'used_at, usage_type'),
+    'loyalty_transactions': (('created_at',), 'created_at, points, description, user_id'),
+}
+
+
+def _m016_stats_rollups(cursor):
+    """Почасовые и дневные роллапы статистики с очередью пересчёта по дням."""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS stats_hourly (
+            hour TEXT NOT NULL,
+            metric TEXT NOT NULL,
+            value INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (hour, metric)
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS stats_daily (
+            day TEXT NOT NULL,
+            metric TEXT NOT NULL,
+            value INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, metric)
+        ) WITHOUT ROWID
+    ''')
+
+    # Дни, роллапы которых устарели. NULL-даты отбрасывает INSERT OR IGNORE
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS stats_dirty (
+            day TEXT PRIMARY KEY NOT NULL
+        ) WITHOUT ROWID
+    ''')
+
+    # Пересчёт дня читает исходные таблицы диапазоном по дате
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_loyalty_created
+        ON loyalty_transactions(created_at)
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_user_subscriptions_created
+        ON user_subscriptions(created_at)
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_subscription_usage_used
+        ON subscription_usage(used_at)
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_certificates_purchase
+        ON certificates(purchase_date)
+    ''')
+
+    # Любая запись, влияющая на статистику, помечает дни события устаревшими
+    for table, (date_columns, watched) in _STATS_SOURCES.items():
+        for event, rows in (('INSERT', ('NEW',)), ('UPDATE', ('OLD', 'NEW')), ('DELETE', ('OLD',))):
+            values = ', '.join(
+                f'(substr({row}.{column}, 1, 10))' for row in rows for column in date_columns
+            )
+            target = f'UPDATE OF {watched} ON {table}' if event == 'UPDATE' else f'{event} ON {table}'
+            cursor.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS {table}_stats_{event.lower()}
+                AFTER {target}
+                BEGIN
+                    INSERT OR IGNORE INTO stats_dirty (day) VALUES {values};
+                END
+            ''')
+
+    # Накопленная история считается при первом пересчёте (refresh_stats_rollups)
+    for table, (date_columns, _) in _STATS_SOURCES.items():
+        for column in date_columns:
+            cursor.execute(f'''
+                INSERT OR IGNORE INTO stats_dirty (day)
+                SELECT DISTINCT substr({column}, 1, 10) FROM {table}
+            ''')
+
+
+def _m017_order_items(cursor):
+    """Позиции заказов цветов отдельной таблицей (вместо разбора JSON из flower_orders.items)."""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS order_items (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            order_id INTEGER NOT NULL,
+            product_id INTEGER,
+            quantity INTEGER NOT NULL DEFAULT 1,
+            unit_price INTEGER NOT NULL DEFAULT 0,
+            created_at DATETIME NOT NULL,
+            FOREIGN KEY (order_id) REFERENCES flower_orders(id),
+            FOREIGN KEY (product_id) REFERENCES products(id)
+        )
+    ''')
+
+    # Продажи товара за период, позиции заказа, продажи за день
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_order_items_product_created
+        ON order_items(product_id, created_at)
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_order_items_order
+        ON order_items(order_id)
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_order_items_created
+        ON order_items(created_at)
+    ''')
+
+    # Удаление заказа удаляет его позиции (внешние ключи SQLite не включены)
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS flower_orders_order_items_delete
+        AFTER DELETE ON flower_orders
+        BEGIN
+            DELETE FROM order_items WHERE order_id = OLD.id;
+        END
+    ''')
+
+    # Перенести позиции существующих заказов из JSON; битый JSON и
+    # элементы не-объекты пропускаются
+    cursor.execute('''
+        INSERT INTO order_items (order_id, product_id, quantity, unit_price, created_at)
+        SELECT fo.id,
+               json_extract(item.value, '$.id'),
+               COALESCE(json_extract(item.value, '$.quantity'), 1),
+               COALESCE(json_extract(item.value, '$.price'), 0),
+               COALESCE(fo.created_at, CURRENT_TIMESTAMP)
+        FROM flower_orders fo,
+             json_each(CASE WHEN json_valid(fo.items) THEN
+                           CASE WHEN json_type(fo.items) = 'array' THEN fo.items END
+                       END) AS item
+        WHERE item.type = 'object'
+          AND NOT EXISTS (SELECT 1 FROM order_items oi WHERE oi.order_id = fo.id)
+    ''')
+    logger.info(f"Перенесено позиций заказов в order_items: {cursor.rowcount}")
+
+
+def _m018_lookup_indexes(cursor):
+    """Индексы для адресов, журнала согласий, отзывов и наград реферера."""
+    # Адреса пользователя (шаг адреса в оформлении заказа): порядок
+    # is_default DESC, id DESC идёт по индексу (id - rowid)
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_addresses_user
+        ON addresses(user_id, is_default)
+    ''')
+
+    # Журнал согласий: по пользователю и последние записи (как в архиве)
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_consent_logs_user_date
+        ON consent_logs(user_id, consent_date)
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_consent_logs_date
+        ON consent_logs(consent_date)
+    ''')
+
+    # Статистика профиля: число отзывов пользователя
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_reviews_user
+        ON reviews(user_id)
+    ''')
+
+    # Награды реферера (фильтр списка наград в админке)
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_referral_rewards_referrer
+        ON referral_rewards(referrer_user_id, status)
+    ''')
+
+
+# Упорядоченный список миграций: (версия, имя, функция)
+MIGRATIONS: List[Tuple[int, str, Callable]] = [
+    (1, "initial_schema", _m001_initial_schema),
+    (2, "gallery_created_at_and_price", _m002_gallery_created_at_and_price),
+    (3, "appointment_price_and_duration", _m003_appointment_price_and_duration),
+    (4, "users_utm_columns", _m004_users_utm_columns),
+    (5, "users_birthday_profile", _m005_users_birthday_profile),
+    (6, "appointment_master", _m006_appointment_master),
+    (7, "hot_path_indexes", _m007_hot_path_indexes),
+    (8, "keyset_pagination_indexes", _m008_keyset_pagination_indexes),
+    (9, "full_text_search", _m009_full_text_search),
+    (10, "bonus_ledger", _m010_bonus_ledger),
+    (11, "bonus_holds", _m011_bonus_holds),
+    (12, "code_sequences", _m012_code_sequences),
+    (13, "utm_campaign_code", _m013_utm_campaign_code),
+    (14, "change_log", _m014_change_log),
+    (15, "user_status_indexes", _m015_user_status_indexes),
+    (16, "stats_rollups", _m016_stats_rollups),
+    (17, "order_items", _m017_order_items),
+    (18, "lookup_indexes", _m018_lookup_indexes),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+# Версии, уже подтверждённые в этом процессе, по пути к БД
+# (повторный init_db ничего не делает, переключение DB_PATH - проверяется заново)
+_verified_versions = {}
+
+
+# =================================================================
+# ДВИЖОК МИГРАЦИЙ
+# =================================================================
+
+def get_schema_version(conn=None) -> int:
+    """
+    Получить текущую версию схемы.
+
+    Args:
+        conn: Открытое соединение (если None - берётся из пула)
+
+    Returns:
+        int: Значение PRAGMA user_version
+    """
+    own = conn is None
+    if own:
+        conn = get_connection()
+    try:
+        return conn.execute("PRAGMA user_version").fetchone()[0]
+    finally:
+        if own:
+            conn.close()
+
+
+def get_pending_migrations(version: Optional[int] = None) -> List[Tuple[int, str]]:
+    """
+    Получить список миграций, ещё не применённых к базе.
+
+    Args:
+        version: Текущая версия схемы (если None - читается из БД)
+
+    Returns:
+        List[Tuple[int, str]]: Список (версия, имя)
+    """
+    if version is None:
+        version = get_schema_version()
+    return [(num, name) for num, name, _ in MIGRATIONS if num > version]
+
+
+def get_applied_migrations() -> List[dict]:
+    """
+    Получить историю применённых миграций.
+
+    Returns:
+        List[dict]: Список миграций с version, name, applied_at, duration_ms
+    """
+    conn = get_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'schema_migrations'"
+        )
+        if not cursor.fetchone():
+            return []
+        cursor.execute(
+            "SELECT version, name, applied_at, duration_ms FROM schema_migrations ORDER BY version"
+        )
+        return [
+            {'version': row[0], 'name': row[1], 'applied_at': row[2], 'duration_ms': row[3]}
+            for row in cursor.fetchall()
+        ]
+    finally:
+        conn.close()
+
+
+def apply_migrations(target: Optional[int] = None) -> List[int]:
+    """
+    Применить ожидающие миграции.
+
+    Каждая миграция выполняется в своей транзакции (BEGIN IMMEDIATE),
+    поэтому параллельно стартующие процессы не применят её дважды.
+
+    Args:
+        target: Версия, до которой применять (по умолчанию - последняя)
+
+    Returns:
+        List[int]: Номера применённых миграций
+    """
+    target = LATEST_VERSION if target is None else min(target, LATEST_VERSION)
+    db_path = database.DB_PATH
+    if _verified_versions.get(db_path, 0) >= target:
+        return []
+
+    conn = get_connection()
+    applied = []
+    try:
+        cursor = conn.cursor()
+        version = cursor.execute("PRAGMA user_version").fetchone()[0]
+
+        # Быстрый путь: схема актуальна
+        if version >= target:
+            _verified_versions[db_path] = max(_verified_versions.get(db_path, 0), version)
+            return []
+
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                version INTEGER PRIMARY KEY,
+                name TEXT NOT NULL,
+                applied_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                duration_ms INTEGER
+            )
+        ''')
+        conn.commit()
+
+        for num, name, migrate in MIGRATIONS:
+            if num > target:
+                break
+
+            cursor.execute("BEGIN IMMEDIATE")
+            # Другой процесс мог успеть применить миграцию
+            version = cursor.execute("PRAGMA user_version").fetchone()[0]
+            if num <= version:
+                conn.rollback()
+                continue
+
+            started = time.perf_counter()
+            try:
+                migrate(cursor)
+                duration_ms = int((time.perf_counter() - started) * 1000)
+                cursor.execute(
+                    "INSERT OR REPLACE INTO schema_migrations (version, name, duration_ms) VALUES (?, ?, ?)",
+                    (num, name, duration_ms)
+                )
+                cursor.execute(f"PRAGMA user_version = {int(num)}")
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                logger.error(f"Ошибка применения миграции {num:03d}_{name}")
+                raise
+
+            applied.append(num)
+            logger.info(f"Применена миграция {num:03d}_{name} ({duration_ms} мс)")
+
+        _verified_versions[db_path] = target
+        return applied
+
+    finally:
+        conn.close()
+
+
+# =================================================================
+# CLI
+# =================================================================
+
+def _print_status():
+    """Вывести текущую версию схемы и ожидающие миграции."""
+    version = get_schema_version()
+    applied = {m['version']: m for m in get_applied_migrations()}
+    pending = get_pending_migrations(version)
+
+    print(f"Версия схемы: {version} (последняя: {LATEST_VERSION})")
+    print()
+    for num, name, _ in MIGRATIONS:
+        if num <= version:
+            info = applied.get(num)
+            when = f" - {info['applied_at']}" if info else ""
+            print(f"  ✅ {num:03d}_{name}{when}")
+        else:
+            print(f"  ⏳ {num:03d}_{name}")
+
+    print()
+    if pending:
+        print(f"Ожидают применения: {len(pending)}")
+    else:
+        print("Схема актуальна")
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    """
+    Точка входа CLI.
+
+    Args:
+        argv: Аргументы командной строки
+
+    Returns:
+        int: Код возврата
+    """
+    parser = argparse.ArgumentParser(description="Миграции схемы базы данных")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.add_parser("status", help="показать версию схемы и ожидающие миграции")
+    apply_parser = subparsers.add_parser("apply", help="применить ожидающие миграции")
+    apply_parser.add_argument("--to", type=int, default=None, help="целевая версия")
+
+    args = parser.parse_args(argv)
+
+    if args.command == "apply":
+        applied = apply_migrations(args.to)
+        if applied:
+            print(f"✅ Применено миграций: {len(applied)} (версия {get_schema_version()})")
+        else:
+            print("Нечего применять, схема актуальна")
+        return 0
+
+    _print_status()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,195 @@
+"""
+Типизированные записи для строк из базы данных.
+
+Вместо словаря на каждую строку списки возвращают лёгкие записи на основе
+namedtuple (без __dict__, __slots__ = ()). Сопоставление столбцов по именам
+выполняется один раз на запрос, дальше строка превращается в запись
+одним вызовом _make.
+
+Записи остаются совместимыми со словарями там, где это нужно шаблонам
+и обработчикам: record['status'], record.get('price', 0), 'id' in record,
+keys(), values(), items(), dict(record). В шаблонах Jinja работает и
+order.status, и order['status'].
+"""
+
+from collections import namedtuple
+from operator import itemgetter
+from typing import Dict, Optional, Sequence, Tuple
+
+# Классы записей для произвольных наборов столбцов (кэш по именам столбцов)
+_ad_hoc_types: Dict[Tuple[str, ...], type] = {}
+
+
+def record_type(name: str, fields: Sequence[str]) -> type:
+    """
+    Создать класс записи с доступом по атрибутам и по ключам.
+
+    Args:
+        name: Имя класса (должно совпадать с именем в модуле для pickle)
+        fields: Имена полей в порядке столбцов
+
+    Returns:
+        type: Класс записи
+    """
+    base = namedtuple(f"_{name}Base", fields)
+    tuple_getitem = tuple.__getitem__
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key) from None
+        return tuple_getitem(self, key)
+
+    def __contains__(self, key):
+        return key in self._fields
+
+    def get(self, key, default=None):
+        """Значение поля или default, как у dict.get."""
+        return getattr(self, key, default) if key in self._fields else default
+
+    def keys(self):
+        """Имена полей."""
+        return self._fields
+
+    def values(self):
+        """Значения полей."""
+        return tuple(self)
+
+    def items(self):
+        """Пары (поле, значение)."""
+        return zip(self._fields, self)
+
+    def as_dict(self) -> dict:
+        """Обычный словарь (например, для json)."""
+        return dict(zip(self._fields, self))
+
+    namespace = {
+        '__slots__': (),
+        '__module__': __name__,
+        '__qualname__': name,
+        '__getitem__': __getitem__,
+        '__contains__': __contains__,
+        'get': get,
+        'keys': keys,
+        'values': values,
+        'as_dict': as_dict,
+    }
+    # Поле с именем items (например, состав заказа) важнее метода
+    if 'items' not in fields:
+        namespace['items'] = items
+
+    return type(name, (base,), namespace)
+
+
+def fetch_records(cursor, record_cls: Optional[type] = None) -> list:
+    """
+    Прочитать все строки курсора как записи.
+
+    Столбцы сопоставляются с полями по именам один раз на запрос.
+    Если record_cls не задан, класс создаётся по именам столбцов.
+
+    Args:
+        cursor: Курсор после execute()
+        record_cls: Класс записи из этого модуля
+
+    Returns:
+        list: Список записей
+    """
+    columns = tuple(d[0] for d in cursor.description)
+
+    if record_cls is None:
+        record_cls = _ad_hoc_types.get(columns)
+        if record_cls is None:
+            record_cls = record_type("Row", columns)
+            _ad_hoc_types[columns] = record_cls
+
+    make = record_cls._make
+    rows = cursor.fetchall()
+
+    if columns == record_cls._fields:
+        return [make(row) for row in rows]
+
+    # Порядок столбцов отличается: перестановка вычисляется один раз
+    try:
+        positions = [columns.index(field) for field in record_cls._fields]
+    except ValueError as e:
+        raise ValueError(f"{record_cls.__name__}: в запросе нет столбца ({e})") from None
+    pick = itemgetter(*positions)
+    return [make(pick(row)) for row in rows]
+
+
+def fetch_record(cursor, record_cls: Optional[type] = None):
+    """
+    Прочитать одну строку курсора как запись.
+
+    Args:
+        cursor: Курсор после execute()
+        record_cls: Класс записи из этого модуля
+
+    Returns:
+        Запись или None, если строк нет
+    """
+    records = fetch_records(cursor, record_cls)
+    return records[0] if records else None
+
+
+# =================================================================
+# ТИПЫ ЗАПИСЕЙ
+# =================================================================
+
+Product = record_type('Product', (
+    'id', 'category', 'name', 'price', 'photo_url', 'description', 'in_stock', 'active',
+))
+
+Appointment = record_type('Appointment', (
+    'id', 'user_id', 'user_name', 'phone', 'service_id', 'service_name',
+    'appointment_date', 'time_slot', 'status', 'prepaid', 'comment', 'created_at',
+    'price', 'duration_minutes',
+))
+
+# Запись в календаре мастеров (с данными мастера)
+ScheduleAppointment = record_type('ScheduleAppointment', (
+    'id', 'user_id', 'user_name', 'phone', 'service_id', 'service_name',
+    'appointment_date', 'time_slot', 'status', 'duration_minutes', 'price', 'comment',
+    'master_id', 'master_name', 'master_color',
+))
+
+FlowerOrder = record_type('FlowerOrder', (
+    'id', 'user_id', 'user_name', 'phone', 'items', 'total_amount', 'delivery_type',
+    'delivery_address', 'delivery_time', 'anonymous', 'card_text', 'recipient_name',
+    'recipient_phone', 'status', 'paid', 'created_at',
+))
+
+Review = record_type('Review', (
+    'id', 'user_id', 'user_name', 'rating', 'text', 'created_at',
+))
+
+# Строка списка пользователей в админ-панели
+UserSummary = record_type('UserSummary', (
+    'user_id', 'user_name', 'username', 'phone', 'bonus_points', 'created_at',
+))
+
+# Настройки программ (одна строка в таблице, снимок из реестра настроек)
+BonusSettings = record_type('BonusSettings', (
+    'bonus_percent', 'bonus_threshold', 'max_bonus_payment_percent', 'referral_bonus',
+    'bonus_expiry_days', 'updated_at',
+))
+
+ReferralSettings = record_type('ReferralSettings', (
+    'enabled', 'reward_type', 'reward_amount', 'reward_percent', 'min_order_amount',
+    'max_reward_amount', 'reward_on_first_order_only', 'auto_approve', 'updated_at',
+))
+
+FeedbackSettings = record_type('FeedbackSettings', (
+    'enabled', 'delay_days', 'message_template', 'updated_at',
+))
+
+# Экран профиля: пользователь, число рефералов и активная подписка одной строкой
+ProfileSnapshot = record_type('ProfileSnapshot', (
+    'user_id', 'username', 'first_name', 'phone', 'birthday', 'profile_filled',
+    'referral_code', 'bonus_points', 'bonus_held', 'referrals_count',
+    'plan_name', 'plan_end_date', 'monthly_flowers_included', 'flowers_used_this_month',
+    'monthly_service_included', 'service_used_this_month',
+))
@@ -1,29 +1,102 @@
 """
 Модуль для расчета цен с учетом привилегий пользователя
+
+Расчёт идёт в два шага: профиль цен пользователя (скидки по активной
+подписке) читается из БД одним запросом, дальше корзина любой длины
+считается по профилю без обращений к БД. Профиль и результат для той же
+корзины переиспользуются между экранами оформления заказа.
 """
 
+import time
+from collections import namedtuple
+from typing import Optional
+
+from config import PRICING_PROFILE_TTL_SECONDS
 from database import get_user_active_subscription
 from utils.helpers import format_price
 
+# Профиль цен пользователя. Неизменяемый и сравнимый по значению:
+# сам профиль служит его версией в ключе кэша расчётов
+PricingProfile = namedtuple('PricingProfile', (
+    'subscription_id', 'subscription_name', 'service_discount_percent', 'flower_discount_percent',
+))
 
-def calculate_final_price(user_id: int, base_price: int, item_type: str = 'service') -> dict:
+NO_SUBSCRIPTION = PricingProfile(None, None, 0, 0)
+
+
+def pricing_profile_from_subscription(subscription: dict) -> PricingProfile:
     """
-    Рассчитать финальную цену с учетом статуса пользователя.
+    Построить профиль цен по уже полученной подписке.
+
+    Args:
+        subscription: Результат get_user_active_subscription() или None
+
+    Returns:
+        PricingProfile: Профиль цен
+    """
+    if not subscription:
+        return NO_SUBSCRIPTION
+
+    return PricingProfile(
+        subscription.get('id'),
+        subscription.get('plan_name'),
+        subscription.get('service_discount_percent') or 0,
+        subscription.get('flower_discount_percent') or 0,
+    )
+
+
+def get_pricing_profile(user_id: int) -> PricingProfile:
+    """
+    Получить профиль цен пользователя (один запрос к БД).
 
     Args:
         user_id: ID пользователя
+
+    Returns:
+        PricingProfile: Профиль цен
+    """
+    return pricing_profile_from_subscription(get_user_active_subscription(user_id))
+
+
+def remember_pricing_profile(store: dict, profile: PricingProfile):
+    """
+    Сохранить профиль цен для следующих экранов оформления заказа.
+
+    Args:
+        store: Хранилище (например, context.user_data)
+        profile: Профиль цен пользователя
+    """
+    store['pricing_profile'] = (time.time(), profile)
+
+
+def cached_pricing_profile(store: dict) -> Optional[PricingProfile]:
+    """
+    Сохранённый профиль цен, если он моложе PRICING_PROFILE_TTL_SECONDS.
+
+    Args:
+        store: Хранилище (например, context.user_data)
+
+    Returns:
+        PricingProfile: Профиль или None (нужно прочитать из БД)
+    """
+    cached = store.get('pricing_profile')
+    if cached and time.time() - cached[0] < PRICING_PROFILE_TTL_SECONDS:
+        return cached[1]
+    return None
+
+
+def price_item(profile: PricingProfile, base_price: int, item_type: str = 'service') -> dict:
+    """
+    Рассчитать финальную цену позиции по профилю (без обращений к БД).
+
+    Args:
+        profile: Профиль цен пользователя
         base_price: Базовая цена
         item_type: Тип товара ('service' или 'flower')
 
     Returns:
-        dict: {
-            'base_price': int,
-            'final_price': int,
-            'discount_percent': int,
-            'discount_amount': int,
-            'subscription_name': str or None,
-            'saved': int
-        }
+        dict: base_price, final_price, discount_percent, discount_amount,
+              subscription_name, saved
     """
     result = {
         'base_price': base_price,
@@ -34,18 +107,12 @@ def calculate_final_price(user_id: int, base_price: int, item_type: str = 'servi
         'saved': 0
     }
 
-    # Получить активную подписку
-    subscription = get_user_active_subscription(user_id)
-
-    if not subscription:
-        return result
-
     # Определить процент скидки
     discount_percent = 0
     if item_type == 'service':
-        discount_percent = subscription.get('service_discount_percent', 0)
+        discount_percent = profile.service_discount_percent
     elif item_type == 'flower':
-        discount_percent = subscription.get('flower_discount_percent', 0)
+        discount_percent = profile.flower_discount_percent
 
     if discount_percent > 0:
         discount_amount = int(base_price * discount_percent / 100)
@@ -55,35 +122,26 @@ def calculate_final_price(user_id: int, base_price: int, item_type: str = 'servi
             'final_price': final_price,
             'discount_percent': discount_percent,
             'discount_amount': discount_amount,
-            'subscription_name': subscription.get('plan_name'),
+            'subscription_name': profile.subscription_name,
             'saved': discount_amount
         })
 
     return result
 
 
-def calculate_cart_total(user_id: int, cart_items: list, delivery_cost: int = 0) -> dict:
+def price_cart(profile: PricingProfile, cart_items: list, delivery_cost: int = 0) -> dict:
     """
-    Рассчитать итоговую стоимость корзины с учетом привилегий.
+    Рассчитать итоговую стоимость корзины по профилю (без обращений к БД).
 
     Args:
-        user_id: ID пользователя
+        profile: Профиль цен пользователя
         cart_items: Список товаров [{'price': int, 'quantity': int, 'type': 'flower/service'}]
         delivery_cost: Стоимость доставки
 
     Returns:
-        dict: {
-            'subtotal': int,
-            'total_discount': int,
-            'delivery_cost': int,
-            'final_total': int,
-            'items_with_discount': list,
-            'subscription_name': str or None,
-            'total_saved': int
-        }
+        dict: subtotal, total_discount, delivery_cost, final_total,
+              items_with_discount, subscription_name, total_saved
     """
-    subscription = get_user_active_subscription(user_id)
-
     subtotal = 0
     total_discount = 0
     items_with_discount = []
@@ -92,7 +150,7 @@ def calculate_cart_total(user_id: int, cart_items: list, delivery_cost: int = 0)
         item_base = item['price'] * item['quantity']
         item_type = item.get('type', 'flower')
 
-        price_info = calculate_final_price(user_id, item['price'], item_type)
+        price_info = price_item(profile, item['price'], item_type)
 
         items_with_discount.append({
             **item,
@@ -113,11 +171,98 @@ def calculate_cart_total(user_id: int, cart_items: list, delivery_cost: int = 0)
         'delivery_cost': delivery_cost,
         'final_total': final_total,
         'items_with_discount': items_with_discount,
-        'subscription_name': subscription.get('plan_name') if subscription else None,
+        'subscription_name': profile.subscription_name,
         'total_saved': total_discount
     }
 
 
+def cart_version(cart_items: list, delivery_cost: int = 0) -> tuple:
+    """
+    Версия корзины для кэша расчётов: меняется при любом изменении
+    состава, количества, цены или стоимости доставки.
+    """
+    return (
+        tuple(tuple(sorted(item.items())) for item in cart_items),
+        delivery_cost,
+    )
+
+
+def price_cart_memoized(store: dict, profile: PricingProfile, cart_items: list,
+                        delivery_cost: int = 0) -> dict:
+    """
+    Рассчитать корзину, переиспользуя последний расчёт из store.
+
+    Экраны корзины, оплаты и подтверждения показывают одну и ту же
+    корзину: расчёт выполняется заново, только если изменилась корзина
+    (cart_version) или профиль цен.
+
+    Args:
+        store: Хранилище расчёта (например, context.user_data)
+        profile: Профиль цен пользователя
+        cart_items: Список товаров
+        delivery_cost: Стоимость доставки
+
+    Returns:
+        dict: Результат price_cart()
+    """
+    key = (cart_version(cart_items, delivery_cost), profile)
+
+    cached = store.get('pricing_memo')
+    if cached is not None and cached[0] == key:
+        return cached[1]
+
+    result = price_cart(profile, cart_items, delivery_cost)
+    store['pricing_memo'] = (key, result)
+    return result
+
+
+def calculate_final_price(user_id: int, base_price: int, item_type: str = 'service') -> dict:
+    """
+    Рассчитать финальную цену с учетом статуса пользователя.
+
+    Args:
+        user_id: ID пользователя
+        base_price: Базовая цена
+        item_type: Тип товара ('service' или 'flower')
+
+    Returns:
+        dict: {
+            'base_price': int,
+            'final_price': int,
+            'discount_percent': int,
+            'discount_amount': int,
+            'subscription_name': str or None,
+            'saved': int
+        }
+    """
+    return price_item(get_pricing_profile(user_id), base_price, item_type)
+
+
+def calculate_cart_total(user_id: int, cart_items: list, delivery_cost: int = 0) -> dict:
+    """
+    Рассчитать итоговую стоимость корзины с учетом привилегий.
+
+    Подписка читается один раз на корзину (см. price_cart).
+
+    Args:
+        user_id: ID пользователя
+        cart_items: Список товаров [{'price': int, 'quantity': int, 'type': 'flower/service'}]
+        delivery_cost: Стоимость доставки
+
+    Returns:
+        dict: {
+            'subtotal': int,
+            'total_discount': int,
+            'delivery_cost': int,
+            'final_total': int,
+            'items_with_discount': list,
+            'subscription_name': str or None,
+            'total_saved': int
+        }
+    """
+    return price_cart(get_pricing_profile(user_id), cart_items, delivery_cost)
+
+
 def format_price_summary(pricing_info: dict, show_delivery: bool = True) -> str:
     """
     Форматировать сводку цен для отображения пользователю.